@@ -0,0 +1,123 @@
+"""
+Benchmark of the fast ICA fit modes (utils.processing.fit_ica) against the full fit
+used by eeg_preprocessing.py (extended infomax on every clean sample).
+
+For each configuration it reports fit time, number of components and similarity to
+the full fit: components are paired one-to-one (Hungarian matching on the absolute
+correlation of their topographies) and the mean and worst paired correlations are
+reported. On the synthetic recording, the similarity to the true mixing is reported too.
+
+Run from the repository root, on a synthetic recording:
+    python -m benchmarks.ica_fit_benchmark --seconds 300
+or on a rereferenced checkpoint of eeg_preprocessing.py (no-task spans are not annotated):
+    python -m benchmarks.ica_fit_benchmark --fif data/EEG/preprocessed/checkpoints/<subject>/rereferenced-<key>/checkpoint_raw.fif
+"""
+from scipy.optimize import linear_sum_assignment
+from typing import Union
+import argparse
+import time
+
+import numpy as np
+import mne
+
+from utils.processing import fit_ica
+import config
+
+SAMPLE_RATE = 512 # Hz
+N_SOURCES = 20
+
+def synthetic_raw(
+    seconds: float,
+    seed: int
+) -> tuple[mne.io.RawArray, np.ndarray]:
+    """
+    64-channel recording mixing super-Gaussian (spiky), sub-Gaussian (oscillatory, uniform)
+    and Gaussian sources through a random mixing matrix, plus sensor noise.
+    Returns the recording and the true mixing matrix (channels, sources).
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * SAMPLE_RATE)
+    times = np.arange(n_samples) / SAMPLE_RATE
+    sources = []
+    for i in range(N_SOURCES):
+        kind = i % 4
+        if kind == 0:
+            source = rng.laplace(size=n_samples)
+        elif kind == 1:
+            source = np.sin(2 * np.pi * rng.uniform(4, 30) * times + rng.uniform(0, 2 * np.pi))
+        elif kind == 2:
+            source = rng.uniform(-1, 1, size=n_samples)
+        else:
+            source = rng.standard_t(3, size=n_samples)
+        sources.append((source - source.mean()) / source.std())
+    ch_names = mne.channels.make_standard_montage('biosemi64').ch_names
+    mixing = rng.standard_normal((len(ch_names), N_SOURCES))
+    data = mixing @ np.array(sources) + 0.05 * rng.standard_normal((len(ch_names), n_samples))
+    info = mne.create_info(ch_names, SAMPLE_RATE, ch_types='eeg')
+    return mne.io.RawArray(data * 1e-5, info, verbose='CRITICAL'), mixing
+
+def similarity(
+    patterns_a: np.ndarray,
+    patterns_b: np.ndarray
+) -> tuple[float, float]:
+    """Mean and minimum absolute correlation of one-to-one matched columns (topographies)."""
+    a = (patterns_a - patterns_a.mean(axis=0)) / patterns_a.std(axis=0)
+    b = (patterns_b - patterns_b.mean(axis=0)) / patterns_b.std(axis=0)
+    correlation = np.abs(a.T @ b) / a.shape[0]
+    rows, cols = linear_sum_assignment(-correlation)
+    matched = correlation[rows, cols]
+    return float(matched.mean()), float(matched.min())
+
+def run(
+    raw: mne.io.BaseRaw,
+    **kwargs
+) -> tuple[Union[mne.preprocessing.ICA, None], float, str]:
+    """Fit an ICA returning (ica, seconds, error message)."""
+    start = time.perf_counter()
+    try:
+        ica = fit_ica(raw, random_state=config.RANDOM_SEED, verbose='CRITICAL', **kwargs)
+    except (ImportError, ValueError, RuntimeError) as error:
+        return None, float('nan'), str(error).splitlines()[0]
+    return ica, time.perf_counter() - start, ''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=300, help='Duration of the synthetic recording in seconds.')
+    parser.add_argument('--fif', type=str, default=None, help='Benchmark on this recording instead of a synthetic one.')
+    parser.add_argument('--n-components', type=int, default=15, help='Components of the PCA pre-reduction configuration.')
+    args = parser.parse_args()
+
+    if args.fif is not None:
+        raw = mne.io.read_raw_fif(args.fif, preload=True, verbose='CRITICAL')
+        true_mixing = None
+    else:
+        raw, true_mixing = synthetic_raw(args.seconds, config.RANDOM_SEED)
+    n_eeg = len(mne.pick_types(raw.info, eeg=True))
+    print(f'\n{raw.times[-1]:.0f} s, {n_eeg} EEG channels at {raw.info["sfreq"]:.0f} Hz\n')
+
+    configurations = {
+        'full (infomax)': {},
+        'decim 4': {'decim': 4},
+        'decim 8': {'decim': 8},
+        '30% of 2 s segments': {'segment_fraction': 0.3},
+        '30% segments + decim 2': {'segment_fraction': 0.3, 'decim': 2},
+        f'PCA {args.n_components} + decim 4': {'n_components': args.n_components, 'decim': 4},
+        'picard + decim 4': {'method': 'picard', 'decim': 4},
+        'fastica + decim 4': {'method': 'fastica', 'decim': 4},
+    }
+    header = f"{'configuration':<28}{'time (s)':>10}{'speedup':>9}{'comps':>7}{'sim mean':>10}{'sim min':>9}"
+    print(header + (f"{'truth mean':>12}" if true_mixing is not None else ''))
+    reference, reference_time = None, None
+    for name, kwargs in configurations.items():
+        ica, elapsed, error = run(raw, **{'n_components': config.ICA_PERCENTAGE, **kwargs})
+        if ica is None:
+            print(f'{name:<28}  skipped: {error}')
+            continue
+        patterns = ica.get_components()
+        if reference is None:
+            reference, reference_time = patterns, elapsed
+        sim_mean, sim_min = similarity(reference, patterns)
+        line = f'{name:<28}{elapsed:>10.2f}{reference_time / elapsed:>9.1f}{ica.n_components_:>7d}{sim_mean:>10.3f}{sim_min:>9.3f}'
+        if true_mixing is not None:
+            line += f'{similarity(true_mixing, patterns)[0]:>12.3f}'
+        print(line)
@@ -0,0 +1,88 @@
+"""
+Validation of the single precision mode (config.PROCESSING_DTYPE = 'float32') of the filtering
+stage: fir_filter_decimate, fir_filter (reflected mode, blockwise) and custom_resample with
+dtype=np.float32 against the same calls in float64. The filters are designed and each block
+is filtered in float64 either way, only the output is kept in float32.
+
+For each path it reports run time, peak traced memory and the deviation from the float64 output:
+maximum absolute error relative to the peak amplitude, and signal-to-error ratio in dB.
+The 'float64 rounded' row is the floor of the mode: the float64 output cast to float32
+(as eeg_preprocessing stores the recording, in FIF calibrated units).
+
+Run from the repository root:
+    python -m benchmarks.precision_benchmark --minutes 10 --channels 64
+"""
+import tracemalloc
+import argparse
+import time
+
+import numpy as np
+
+from utils.processing import fir_filter, custom_resample, fir_filter_decimate
+import config
+
+SAMPLE_RATE = 2048 # Hz, Biosemi recordings
+L_FREQ, H_FREQ = 1, 40 # Hz
+
+def run(
+    function,
+    *args,
+    **kwargs
+) -> tuple[np.ndarray, float, float]:
+    """Run function returning (result, seconds, peak traced MiB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+def deviation(
+    output: np.ndarray,
+    reference: np.ndarray
+) -> tuple[float, float]:
+    """Maximum absolute error relative to the peak amplitude, and signal-to-error ratio in dB."""
+    error = output.astype(np.float64) - reference
+    max_error = np.abs(error).max() / np.abs(reference).max()
+    error_power = np.mean(error**2)
+    snr = 10 * np.log10(np.mean(reference**2) / error_power) if error_power > 0 else np.inf
+    return float(max_error), float(snr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, default=10, help='Duration of the synthetic recording in minutes.')
+    parser.add_argument('--channels', type=int, default=64, help='Number of channels.')
+    args = parser.parse_args()
+
+    # Brown noise plus alpha and line noise, in volts, with a DC offset as in raw BDF data
+    rng = np.random.default_rng(config.RANDOM_SEED)
+    n_samples = int(args.minutes * 60 * SAMPLE_RATE)
+    times = np.arange(n_samples) / SAMPLE_RATE
+    data = np.cumsum(rng.standard_normal((args.channels, n_samples)), axis=1) * 1e-7
+    data += 1e-5 * np.sin(2 * np.pi * 10 * times) + 5e-6 * np.sin(2 * np.pi * 50 * times) + 1e-3
+
+    print(f'\n{args.minutes:.0f} min, {args.channels} channels at {SAMPLE_RATE} Hz -> {config.TARGET_SAMPLING_RATE} Hz')
+    print(f'Input buffer: {data.nbytes / 2**20:.1f} MiB\n')
+    print(f"{'path':<40}{'time (s)':>10}{'peak MiB':>10}{'max error':>12}{'SNR (dB)':>10}")
+    stages = {
+        'fir_filter_decimate': lambda dtype: fir_filter_decimate(
+            data, SAMPLE_RATE, config.TARGET_SAMPLING_RATE, L_FREQ, H_FREQ, axis=1,
+            block_size=config.FILTER_BLOCK_SIZE, dtype=dtype
+        ),
+        'fir_filter (blockwise)': lambda dtype: fir_filter(
+            data, SAMPLE_RATE, L_FREQ, H_FREQ, axis=1, call_type='forward_compensated_reflected',
+            block_size=config.FILTER_BLOCK_SIZE, dtype=dtype
+        ),
+        'custom_resample': lambda dtype: custom_resample(
+            data, SAMPLE_RATE, config.TARGET_SAMPLING_RATE, axis=1, dtype=dtype
+        ),
+    }
+    for name, stage in stages.items():
+        reference, elapsed, peak_mib = run(stage, np.float64)
+        print(f"{name + ' float64':<40}{elapsed:>10.2f}{peak_mib:>10.1f}{0:>12.2e}{np.inf:>10.1f}")
+        output, elapsed, peak_mib = run(stage, np.float32)
+        max_error, snr = deviation(output, reference)
+        print(f"{name + ' float32':<40}{elapsed:>10.2f}{peak_mib:>10.1f}{max_error:>12.2e}{snr:>10.1f}")
+        max_error, snr = deviation(reference.astype(np.float32), reference)
+        print(f"{name + ' float64 rounded':<40}{'':>10}{'':>10}{max_error:>12.2e}{snr:>10.1f}")
@@ -0,0 +1,115 @@
+"""
+Benchmark of the time-stretch engine (utils.audio_helpers.time_stretch) against the
+legacy whole-file linear interpolation of `scale_audio`.
+
+For each method it reports run time, peak traced memory and quality on a synthetic
+stereo signal:
+- SNR (dB) against the analytically resampled signal, for pitch-changing methods.
+- Fundamental frequency error (cents) of a harmonic, speech-like signal, for every method.
+  Pitch-changing methods shift the pitch by the stretch ratio; 'wsola' should stay close to 0.
+
+Run from the repository root:
+    python -m benchmarks.time_stretch_benchmark --seconds 120 --delta-seconds 3
+"""
+import tracemalloc
+import argparse
+import time
+
+import numpy as np
+
+from utils.audio_helpers import time_stretch
+
+SAMPLE_RATE = 48000 # Hz
+TONES = ((220, 1.0), (1250, 0.5), (6100, 0.25)) # (frequency Hz, amplitude) of the SNR test signal
+F0 = 150 # Hz, fundamental of the harmonic test signal
+N_HARMONICS = 20
+
+def legacy_interp(
+    data: np.ndarray,
+    target_frames: int
+) -> np.ndarray:
+    """Whole-file linear interpolation as in the original `scale_audio` (stereo averaged to mono)."""
+    original_frames = data.shape[0]
+    data = data.mean(axis=1) if data.ndim != 1 else data
+    original_idx = np.arange(original_frames, dtype=np.float32)
+    target_idx = np.linspace(0, original_frames - 1, target_frames, dtype=np.float32)
+    return np.interp(target_idx, original_idx, data.astype(np.float32))
+
+def tones(
+    positions: np.ndarray
+) -> np.ndarray:
+    """Sum of sinusoids evaluated at (fractional) sample positions."""
+    return sum(amp * np.sin(2 * np.pi * freq * positions / SAMPLE_RATE) for freq, amp in TONES)
+
+def harmonic(
+    positions: np.ndarray
+) -> np.ndarray:
+    """Harmonic signal with 1/k amplitudes, evaluated at sample positions."""
+    return sum(np.sin(2 * np.pi * k * F0 * positions / SAMPLE_RATE) / k for k in range(1, N_HARMONICS + 1))
+
+def fundamental(
+    data: np.ndarray
+) -> float:
+    """Fundamental frequency estimated from the autocorrelation peak (with parabolic interpolation)."""
+    segment = data[:SAMPLE_RATE].astype(np.float64)
+    spectrum = np.fft.rfft(segment, n=2 * len(segment))
+    autocorr = np.fft.irfft(np.abs(spectrum) ** 2)[:len(segment)]
+    min_lag, max_lag = SAMPLE_RATE // 400, SAMPLE_RATE // 60
+    lag = min_lag + int(np.argmax(autocorr[min_lag:max_lag]))
+    y0, y1, y2 = autocorr[lag - 1], autocorr[lag], autocorr[lag + 1]
+    lag = lag + 0.5 * (y0 - y2) / (y0 - 2 * y1 + y2)
+    return SAMPLE_RATE / lag
+
+def run(
+    function,
+    *args,
+    **kwargs
+) -> tuple[np.ndarray, float, float]:
+    """Run function returning (result, seconds, peak traced MiB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=120, help='Duration of the test signal in seconds.')
+    parser.add_argument('--delta-seconds', type=float, default=3, help='Stretch (positive) or compression (negative) in seconds.')
+    args = parser.parse_args()
+
+    n_frames = int(args.seconds * SAMPLE_RATE)
+    target_frames = n_frames + int(args.delta_seconds * SAMPLE_RATE)
+    ratio = (n_frames - 1) / (target_frames - 1)
+    positions = np.arange(n_frames)
+    target_positions = np.arange(target_frames) * ratio
+    input_f0 = fundamental(harmonic(positions))
+
+    tone_signal = np.stack([tones(positions)] * 2, axis=1).astype(np.float32)
+    tone_reference = tones(target_positions)
+    harmonic_signal = np.stack([harmonic(positions)] * 2, axis=1).astype(np.float32)
+
+    methods = {
+        'legacy interp (whole file)': lambda data: legacy_interp(data, target_frames),
+        'interp (chunked)': lambda data: time_stretch(data, target_frames, method='interp'),
+        'polyphase (chunked)': lambda data: time_stretch(data, target_frames, method='polyphase'),
+        'wsola (pitch preserving)': lambda data: time_stretch(data, target_frames, method='wsola'),
+    }
+    print(f'\n{args.seconds:.0f} s stereo at {SAMPLE_RATE} Hz, stretched by {args.delta_seconds:+.2f} s')
+    print(f'Input buffer: {tone_signal.nbytes / 2**20:.1f} MiB\n')
+    print(f"{'method':<28}{'time (s)':>10}{'peak MiB':>10}{'SNR (dB)':>10}{'f0 error (cents)':>18}{'channels':>10}")
+    for name, method in methods.items():
+        stretched, elapsed, peak_mib = run(method, tone_signal)
+        channels = 1 if stretched.ndim == 1 else stretched.shape[1]
+        if name.startswith('wsola'):
+            snr = float('nan') # WSOLA does not resample, there is no sample-wise reference
+        else:
+            left = stretched if stretched.ndim == 1 else stretched[:, 0]
+            error = (left - tone_reference)[1000:-1000]
+            snr = 10 * np.log10(np.mean(tone_reference ** 2) / max(np.mean(error ** 2), 1e-30))
+        harmonic_out = method(harmonic_signal)
+        harmonic_out = harmonic_out if harmonic_out.ndim == 1 else harmonic_out[:, 0]
+        cents = 1200 * np.log2(fundamental(harmonic_out[SAMPLE_RATE:]) / input_f0)
+        print(f'{name:<28}{elapsed:>10.3f}{peak_mib:>10.1f}{snr:>10.1f}{cents:>18.2f}{channels:>10d}')
@@ -14,13 +14,24 @@ FIGURES_DIR = Path("figures")
 VERBOSE_LEVEL = 'CRITICAL'
 UNUSED_EXT_CH = ['EXG6', 'EXG7', 'EXG8']
 TARGET_SAMPLING_RATE = 512  # Hz
+FILTER_BLOCK_SIZE = 2**16 # samples filtered at a time (overlap-save) by fir_filter_decimate
+PROCESSING_DTYPE = 'float64' # 'float32' rounds the filtered data and checkpoints to single precision (filters stay in float64)
 ICA_PERCENTAGE = 0.98  
+# ICA fit (defaults reproduce the full fit: extended infomax on every clean sample)
+ICA_METHOD = 'infomax' # 'infomax', 'picard' (requires python-picard) or 'fastica' (requires scikit-learn)
+ICA_N_COMPONENTS = None # fixed number of PCA components (pre-reduction), overrides ICA_PERCENTAGE
+ICA_DECIM = None # fit on every ICA_DECIM-th sample only (e.g. 4)
+ICA_SEGMENT_FRACTION = None # fit on a random fraction of the clean segments (e.g. 0.3)
+ICA_SEGMENT_SECONDS = 2.0 # length of those segments
 RANDOM_SEED = 42
 TRIGGER_IDS = {
     'listening': (100, 105), # start and end triggers for listening periods
     'bips1': (45, 3, 10), # start, step, number of bips for first block
     'bips2': (150, 3, 10)  # start, step, number of bips for second block
 }
+TRIGGER_BITS = 8 # the stimulation PC writes single bytes, upper bits of the Status channel are status flags
+TRIGGER_MIN_SAMPLES = 3 # shorter trigger values are glitches, merged into the previous value
+BIP_DEFAULT_DURATION = 1.0 # seconds, duration of the bips whose offset trigger is missing
 
 # Rename EEG channels to standard 10-20 names
 BIOSEMI_MAPPING = {
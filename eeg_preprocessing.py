@@ -8,6 +8,21 @@ This script preprocesses raw EEG data files in BDF format. The preprocessing ste
 - Rereferencing to mastoids.
 - Performing ICA to remove artifacts, with visualizations saved for inspection.
 - Saving the preprocessed data and event times.
+
+Subjects are independent, so they are processed by a pool of worker processes
+(one subject per worker, failures isolated, one log file per subject):
+
+    python eeg_preprocessing.py --jobs 4
+
+The fitted ICA of each subject is saved (data/EEG/preprocessed/ica/<subject>-ica.fif,
+with its fit parameters in <subject>_ica.json). After editing config.ICA_REMOVAL,
+the cleaned recordings can be rewritten from the saved solutions without refitting:
+
+    python eeg_preprocessing.py --apply-only
+
+ICA figures are rendered by parallel workers (--figure-jobs), only when the ICA
+solution changed; --no-figures skips them entirely. The channels of each subject are
+filtered by a pool of threads (--filter-jobs).
 """
 # 1. TODO usar el mismo nombre para psychopy y biosemi--> sugerir sin guión bajo --> DICHOTIC001
 # 2. TODO mne.find_events no funciona bien porque no se escribieron bien los triggers
@@ -15,77 +30,115 @@ This script preprocesses raw EEG data files in BDF format. The preprocessing ste
 # 4. TODO: se generan marcas no esperadas 
 # 5. TODO: hubo que hacer hacks porque aparecieron marcas esperadas, pero en momentos extraños
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 import matplotlib.pyplot as plt
 from pathlib import Path
+from typing import Union
 from tqdm import tqdm
 import numpy as np
+import multiprocessing
+import traceback
+import argparse
+import os
 import mne
 
+from utils.events_helpers import save_event_store, load_event_store, encode_trigger_runs, EVENT_STORE_SCHEMA_VERSION
+from utils.cache_helpers import cached_stage, stage_key, hash_file
+from utils.figures_helpers import save_ica_figures
 from utils.processing import (
-    find_first_event_on_id,
+    clean_trigger_events,
+    trigger_protocol,
+    get_events,
     dump_dict_to_json,
     load_json_to_dict,
     get_no_task_times,
-    fir_filter,
-    custom_resample
+    fir_filter_decimate,
+    LazyRawArray,
+    custom_resample,
+    fit_ica
 )
 import config
 
-PREPROCESSED_DIR_TRIGGERS = config.PREPROCESSED_DIR / "triggers"
 PREPROCESSED_DIR_ANNOT = config.PREPROCESSED_DIR / "annotations"
 PREPROCESSED_DIR_FIF = config.PREPROCESSED_DIR / "fif"
 FIGURES_ICA = config.FIGURES_DIR / "ICA"
+LOGS_DIR = config.PREPROCESSED_DIR / "logs"
+CHECKPOINTS_DIR = config.PREPROCESSED_DIR / "checkpoints"
+FILTERS_CACHE_DIR = CHECKPOINTS_DIR / "filters" # filter designs, shared across subjects
+PREPROCESSED_DIR_ICA = config.PREPROCESSED_DIR / "ica"
+MAX_DEFAULT_FIGURE_JOBS = 4 # each figure worker holds about a copy of the recording, see save_ica_figures
 
-PREPROCESSED_DIR_TRIGGERS.mkdir(parents=True, exist_ok=True)
 PREPROCESSED_DIR_ANNOT.mkdir(parents=True, exist_ok=True)
 PREPROCESSED_DIR_FIF.mkdir(parents=True, exist_ok=True)
+PREPROCESSED_DIR_ICA.mkdir(parents=True, exist_ok=True)
 FIGURES_ICA.mkdir(parents=True, exist_ok=True)
+LOGS_DIR.mkdir(parents=True, exist_ok=True)
+
+# Threading environment variables of the BLAS/OpenMP backends
+BLAS_THREAD_VARS = (
+    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS'
+)
 
 mne.set_log_level(config.VERBOSE_LEVEL)
 
-for eeg_path in tqdm(list(config.EEG_DIR.glob("*.bdf")), desc="Preprocessing EEG files (patience, ICA takes ~2 mins per subj)"):
-    
-    # Load behavioural and psychopy data if needed
-    behavioural_data = load_json_to_dict(
-        config.BEHAVIOURAL_DIR / f"{eeg_path.stem.split('prueba')[1]}_behavioural.json" # FIXME 1
-    )
+def extract_events(
+    raw: mne.io.BaseRaw,
+    behavioural_data: dict
+) -> dict:
+    """
+    Extract the listening, no-task and bip events from the trigger channel (last channel),
+    validated against the protocol of config.TRIGGER_IDS (see clean_trigger_events).
+    Done prior to downsampling and rereferencing.
 
-    # Load raw EEG data
-    raw = mne.io.read_raw_bdf(
-        eeg_path, preload=True, verbose=config.VERBOSE_LEVEL
-    )
+    Parameters
+    ----------
+    raw : mne.io.BaseRaw
+        Raw recording, as loaded from the BDF file.
+    behavioural_data : dict
+        Behavioural data of the subject.
 
-    # =================
-    # Events extraction
+    Returns
+    -------
+    dict
+        Events times (in seconds), the sampling frequency of the trigger channel ('sfreq'),
+        the trigger channel as run-length encoded transitions ('trigger_runs', see
+        utils.events_helpers.encode_trigger_runs) and the report of the dropped and
+        repaired triggers ('trigger_report').
+    """
+    # Define events and epochs prior to downsampling and rereferencing (reads the trigger channel alone)
+    trigger = raw.get_data(picks=[len(raw.ch_names) - 1], verbose=config.VERBOSE_LEVEL)[0]
 
-    # Define events and epochs prior to downsampling and rereferencing 
-    trigger = raw.get_data()[-1, :]
-    unique_trigger_values = np.unique(trigger[trigger != 0])
-    
-    # Listening events
-    listening_onsets = find_first_event_on_id(
-        event_id=config.TRIGGER_IDS['listening'][0],
+    # Mask, deglitch and validate the triggers against the protocol in a single pass
+    listening_id = config.TRIGGER_IDS['listening'][0]
+    events_index, trigger_report = clean_trigger_events(
         trigger_signal=trigger,
-        raw=raw
+        sfreq=raw.info['sfreq'],
+        trigger_ids=config.TRIGGER_IDS,
+        n_bits=config.TRIGGER_BITS,
+        min_samples=config.TRIGGER_MIN_SAMPLES,
+        expected_durations={
+            # FIXME 3: the listening offsets are missing, their durations come from the behavioural data
+            listening_id: behavioural_data['listening_presentation']['audiobook_duration']
+        },
+        default_duration=config.BIP_DEFAULT_DURATION
     )
-    # FIXME 3
-    # listening_offsets = find_first_event_on_id(
-    #     event_id=config.TRIGGER_IDS['listening'][1],
-    #     trigger_signal=trigger,
-    #     raw=raw
-    # )
-    # np.unique(
-    #     trigger[trigger == config.TRIGGER_IDS['listening'][0]], 
-    #     return_counts=True
-    # )
-    # np.unique(
-    #     trigger[trigger == config.TRIGGER_IDS['listening'][1]], 
-    #     return_counts=True
-    # )
-    # listening_durations = listening_offsets - listening_onsets
-    listening_durations = np.array(
-        behavioural_data['listening_presentation']['audiobook_duration']
+    print(
+        f"Triggers: {trigger_report['kept']} events kept, {trigger_report['repaired']} repaired, "
+        f"{trigger_report['dropped']} dropped, {trigger_report['merged_glitches']} glitches merged, "
+        f"{trigger_report['masked_samples']} samples with status bits"
     )
+    for issue in trigger_report['issues']:
+        print(f"  - {issue['action']} {issue['value']} at {issue['time']:.3f} s: {issue['reason']}")
+    descriptions = {
+        onset: spec['description'] for onset, spec in trigger_protocol(config.TRIGGER_IDS).items()
+    }
+
+    # Listening events
+    listening = get_events(events_index, [listening_id])
+    listening_onsets = listening['time']
+    listening_durations = listening['duration']
     listening_offsets = listening_onsets + listening_durations
     
     # Get non-listening periods
@@ -95,68 +148,48 @@ for eeg_path in tqdm(list(config.EEG_DIR.glob("*.bdf")), desc="Preprocessing EEG
         raw=raw
     )
     
-    # Annotate non-listening periods: will be rejected for ICA
-    annotations = mne.Annotations(
-        onset=no_task_onsets, 
-        duration=no_task_durations, 
-        description=['bad'] * len(no_task_onsets) 
-    )
-    raw = raw.set_annotations(
-        annotations,
-        verbose=config.VERBOSE_LEVEL
-    )
-    
-    # Now find bips
-    all_bips_onsets = []
-    all_bips_durations = []
-    all_bips_descriptions = []
-
-    for bip_block in ['bips1', 'bips2']:
-        for bip_number in range(config.TRIGGER_IDS[bip_block][2]):
-
-            # Calculate trigger value for current bip
-            trigger_value = config.TRIGGER_IDS[bip_block][0] + bip_number * config.TRIGGER_IDS[bip_block][1]
-            
-            bips_onsets = find_first_event_on_id(
-                event_id=trigger_value,
-                trigger_signal=trigger,
-                raw=raw
-            )
-            bips_offsets = find_first_event_on_id(
-                event_id=trigger_value+1,
-                trigger_signal=trigger,
-                raw=raw
-            )
-            # FIXME 4
-            # Discard bips that don't have both onset and offset
-            if (trigger_value not in unique_trigger_values):
-                continue
-            else:
-                if len(bips_onsets) != len(bips_offsets):
-                    bip_durations = np.array([1] * len(bips_onsets))
-                    if len(bips_onsets) == 6:
-                        # FIXME 5 hack to avoid a weird extra bip at start of block in bip 6 of first block
-                        bips_onsets=bips_onsets[1:] 
-                    elif len(bips_onsets) == 8:
-                        # FIXME 5 hack to avoid a weird extra bip at start of block in bip 7 of second block
-                        bips_onsets=bips_onsets[[0, 2, 3, 4 ,6]]
-                else:
-                    bip_durations = bips_offsets - bips_onsets
-            all_bips_onsets.extend(bips_onsets.tolist())
-            all_bips_durations.extend(bip_durations.tolist())
-            all_bips_descriptions.extend(
-                [f'bip_Block_{bip_block[-1]}_Bip_{bip_number+1}'] * len(bips_onsets) 
-            )
-
-    # Sort all bip annotations by onset time (since we processed blocks separately)
-    sorted_indices = np.argsort(all_bips_onsets)
-    all_bips_onsets = [all_bips_onsets[i] for i in sorted_indices]
-    all_bips_durations = [all_bips_durations[i] for i in sorted_indices]
-    all_bips_descriptions = [all_bips_descriptions[i] for i in sorted_indices]
+    # Bips of both blocks, sorted by onset time
+    bips = get_events(events_index, [onset for onset in descriptions if onset != listening_id])
+    all_bips_onsets = bips['time'].tolist()
+    all_bips_durations = bips['duration'].tolist()
+    all_bips_descriptions = [descriptions[value] for value in bips['value'].tolist()]
 
-    # ======================
-    # Preprocessing eeg data 
+    return {
+        'listening_onsets': listening_onsets,
+        'listening_durations': listening_durations,
+        'listening_annotations': ['listening'] * len(listening_onsets),
+        'no_task_durations': no_task_durations,
+        'no_task_onsets': no_task_onsets,
+        'no_task_annotations': ['no-task'] * len(no_task_onsets),
+        'bips_onsets': all_bips_onsets,
+        'bips_durations': all_bips_durations,
+        'bips_descriptions': all_bips_descriptions,
+        'sfreq': raw.info['sfreq'],
+        'trigger_runs': encode_trigger_runs(trigger),
+        'trigger_report': trigger_report
+    }
+
+def filter_and_resample(
+    raw: mne.io.BaseRaw,
+    n_jobs: int = 1
+) -> mne.io.RawArray:
+    """
+    Rename channels, set channel types and montage, band-pass filter (1-40 Hz) and
+    downsample to config.TARGET_SAMPLING_RATE. The trigger channel is kept unfiltered.
+
+    Parameters
+    ----------
+    raw : mne.io.BaseRaw
+        Raw recording, as loaded from the BDF file (preloaded or not). Modified in place.
+        If not preloaded, the channels are streamed from disk block by block.
+    n_jobs : int, optional
+        Number of threads the channels are filtered by. Default is 1.
 
+    Returns
+    -------
+    mne.io.RawArray
+        Filtered and downsampled recording.
+    """
     # Rename channels to standard 10-20 names
     raw = raw.rename_channels(config.EXTERNAL_MAPPING, verbose=config.VERBOSE_LEVEL)
     raw = raw.rename_channels(config.BIOSEMI_MAPPING, verbose=config.VERBOSE_LEVEL)
@@ -185,24 +218,34 @@ for eeg_path in tqdm(list(config.EEG_DIR.glob("*.bdf")), desc="Preprocessing EEG
     # Filter data: high pass 1 Hz Butterworth; Low pass 40 Hz; Notch 50 Hz. All non-causal # FIXME 6
     # raw = raw.resample(config.TARGET_SAMPLING_RATE, verbose=config.VERBOSE_LEVEL)
 
-    # Apply filters
-    raw_data = raw.get_data()
-    filtered_data = fir_filter(
-        array=raw_data[:-1, :], # exclude trigger channel
+    # Apply filters and downsample in a single polyphase pass, reading the channels one block at a
+    # time (from disk if not preloaded) into the preallocated downsampled recording. Each block is
+    # rounded to config.PROCESSING_DTYPE as it is written, as `save_raw_checkpoint` would store it
+    n_channels = len(raw.ch_names)
+    filtered_data = np.empty(
+        (n_channels, -(-raw.n_times * config.TARGET_SAMPLING_RATE // int(raw.info['sfreq']))), dtype=np.float64
+    )
+    fir_filter_decimate(
+        array=LazyRawArray(raw, picks=range(n_channels - 1)), # exclude trigger channel
         sfreq=raw.info['sfreq'],
+        target_sr=config.TARGET_SAMPLING_RATE,
         l_freq=1,
         h_freq=40,
         axis=1, # time axis
-        call_type='forward_compensated_reflected'
+        block_size=config.FILTER_BLOCK_SIZE,
+        store_cache=FILTERS_CACHE_DIR,
+        out=filtered_data[:-1],
+        n_jobs=n_jobs,
+        dtype=config.PROCESSING_DTYPE,
+        cals=channel_cals(raw.info)[:-1]
     )
-    filtered_data = np.vstack([filtered_data, raw_data[-1, :]])  # Add trigger channel back
-    
-    # Downsample 
-    filtered_data = custom_resample(
-        array=filtered_data,
+    custom_resample( # trigger channel, kept unfiltered
+        array=raw.get_data(picks=[n_channels - 1], verbose=config.VERBOSE_LEVEL),
         original_sr=raw.info['sfreq'],
         target_sr=config.TARGET_SAMPLING_RATE,
-        axis=1
+        axis=1,
+        store_cache=FILTERS_CACHE_DIR,
+        out=filtered_data[-1:]
     )
     
     # Update info structure
@@ -212,65 +255,328 @@ for eeg_path in tqdm(list(config.EEG_DIR.glob("*.bdf")), desc="Preprocessing EEG
         new_info['line_freq'] = 50 
         new_info['highpass'] = 1
         new_info['lowpass'] = 40 
-    del raw
-    raw = mne.io.RawArray(filtered_data, new_info)
-    raw.set_annotations(annotations)
+    filtered = mne.io.RawArray(filtered_data, new_info, verbose=config.VERBOSE_LEVEL)
+    return round_to_precision(filtered, picks=[n_channels - 1]) # the filtered channels already are
+
+def channel_cals(
+    info: mne.Info
+) -> np.ndarray:
+    """Calibration factors of the channels, shaped (n_channels, 1): FIF files store data / cals."""
+    return np.array([ch['cal'] * ch['range'] for ch in info['chs']])[:, np.newaxis]
+
+def round_to_precision(
+    raw: mne.io.BaseRaw,
+    picks: Union[list[int], None] = None
+) -> mne.io.BaseRaw:
+    """
+    Round channels of a recording to config.PROCESSING_DTYPE the way `save_raw_checkpoint` stores
+    them (in the calibrated units of the FIF file), so resumed and fresh runs match. mne keeps the
+    data in float64 in memory, only its values are rounded, one channel at a time. Modified in place.
+    """
+    if np.dtype(config.PROCESSING_DTYPE) == np.float64:
+        return raw
+    cals = channel_cals(raw.info)[:, 0]
+    for pick in range(len(raw.ch_names)) if picks is None else picks:
+        raw.apply_function(
+            lambda data: (data / cals[pick]).astype(config.PROCESSING_DTYPE) * cals[pick],
+            picks=[pick],
+            channel_wise=True,
+            verbose=config.VERBOSE_LEVEL
+        )
+    return raw
+
+def save_events(
+    file_path: Path,
+    events: dict
+) -> None:
+    """
+    Save the events of `extract_events` as a columnar events store (see utils.events_helpers):
+    one row per listening, no-task and bip event, the trigger channel as run-length encoded
+    transitions and the trigger report as metadata.
+    """
+    onset_codes = {
+        spec['description']: onset for onset, spec in trigger_protocol(config.TRIGGER_IDS).items()
+    }
+    onsets = np.concatenate([events['listening_onsets'], events['no_task_onsets'], events['bips_onsets']])
+    durations = np.concatenate([events['listening_durations'], events['no_task_durations'], events['bips_durations']])
+    categories = list(events['listening_annotations']) + list(events['no_task_annotations']) + list(events['bips_descriptions'])
+    order = np.argsort(onsets, kind='stable')
+    save_event_store(
+        file_path=file_path,
+        sfreq=events['sfreq'],
+        samples=np.rint(onsets * events['sfreq'])[order],
+        codes=np.array([onset_codes.get(category, 0) for category in categories], dtype=np.int32)[order],
+        durations=durations[order],
+        categories=[categories[i] for i in order],
+        trigger_runs=events['trigger_runs'],
+        metadata={'trigger_report': events['trigger_report']}
+    )
+
+def load_events(
+    file_path: Path
+) -> dict:
+    """Load the events saved by `save_events`, in the format of `extract_events`."""
+    store = load_event_store(file_path)
+    is_listening = store['category'] == 'listening'
+    is_no_task = store['category'] == 'no-task'
+    is_bip = ~is_listening & ~is_no_task
+    return {
+        'listening_onsets': store['time'][is_listening],
+        'listening_durations': store['duration'][is_listening],
+        'listening_annotations': store['category'][is_listening].tolist(),
+        'no_task_durations': store['duration'][is_no_task],
+        'no_task_onsets': store['time'][is_no_task],
+        'no_task_annotations': store['category'][is_no_task].tolist(),
+        'bips_onsets': store['time'][is_bip].tolist(),
+        'bips_durations': store['duration'][is_bip].tolist(),
+        'bips_descriptions': store['category'][is_bip].tolist(),
+        'sfreq': store['sfreq'],
+        'trigger_runs': store['trigger_runs'],
+        'trigger_report': store['metadata']['trigger_report']
+    }
+
+def save_events_checkpoint(
+    events: dict,
+    directory: Path
+) -> None:
+    """Save the events of `extract_events` (see `save_events`)."""
+    save_events(directory / 'events.npz', events)
+
+def load_events_checkpoint(
+    directory: Path
+) -> dict:
+    """Load the events saved by `save_events_checkpoint`."""
+    return load_events(directory / 'events.npz')
+
+def save_raw_checkpoint(
+    raw: mne.io.BaseRaw,
+    directory: Path
+) -> None:
+    """Save a recording in the precision of config.PROCESSING_DTYPE, so checkpoints don't change the results."""
+    fmt = 'single' if np.dtype(config.PROCESSING_DTYPE) == np.float32 else 'double'
+    raw.save(directory / 'checkpoint_raw.fif', fmt=fmt, verbose=config.VERBOSE_LEVEL)
+
+def load_raw_checkpoint(
+    directory: Path
+) -> mne.io.BaseRaw:
+    """Load a recording saved by `save_raw_checkpoint`."""
+    return mne.io.read_raw_fif(directory / 'checkpoint_raw.fif', preload=True, verbose=config.VERBOSE_LEVEL)
+
+def save_ica_checkpoint(
+    ica: mne.preprocessing.ICA,
+    directory: Path
+) -> None:
+    """Save a fitted ICA."""
+    ica.save(directory / 'checkpoint-ica.fif', verbose=config.VERBOSE_LEVEL)
+
+def load_ica_checkpoint(
+    directory: Path
+) -> mne.preprocessing.ICA:
+    """Load an ICA saved by `save_ica_checkpoint`."""
+    return mne.preprocessing.read_ica(directory / 'checkpoint-ica.fif', verbose=config.VERBOSE_LEVEL)
+
+def preprocess_subject(
+    eeg_path: Path,
+    figures: bool = True,
+    figure_jobs: int = 1,
+    filter_jobs: int = 1
+) -> None:
+    """
+    Preprocess the BDF recording of one subject and save the preprocessed FIF,
+    the events store (npz), the trigger report (JSON) and the ICA figures.
+    The pipeline runs as chained stages (raw -> events, raw -> filtered+resampled ->
+    rereferenced -> ICA solution -> cleaned), each checkpointed in CHECKPOINTS_DIR
+    under a key derived from its inputs and parameters, so reruns only recompute
+    what changed (e.g. a new config.ICA_REMOVAL only re-applies the ICA and saves).
+
+    Parameters
+    ----------
+    eeg_path : Path
+        Path to the raw BDF file.
+    figures : bool, optional
+        If True (default), render the ICA figures when the ICA solution changed.
+    figure_jobs : int, optional
+        Number of worker processes rendering the ICA figures. Default is 1.
+    filter_jobs : int, optional
+        Number of threads filtering the channels. Default is 1.
+    """
+    checkpoint_dir = CHECKPOINTS_DIR / eeg_path.stem
+    behavioural_path = config.BEHAVIOURAL_DIR / f"{eeg_path.stem.split('prueba')[1]}_behavioural.json" # FIXME 1
+    raw_key = hash_file(eeg_path)
+
+    # The BDF is only opened if a stage that depends on it has to be recomputed, and
+    # not preloaded: the stages read the channels they need from disk
+    loaded_raw = []
+    def load_raw() -> mne.io.BaseRaw:
+        if not loaded_raw:
+            loaded_raw.append(mne.io.read_raw_bdf(
+                eeg_path, preload=False, verbose=config.VERBOSE_LEVEL
+            ))
+        return loaded_raw[0]
 
-    # Rereference to mastoids
-    raw = raw.set_eeg_reference(
-        ['M1', 'M2'],
-        verbose=config.VERBOSE_LEVEL
+    # =================
+    # Events extraction
+    events_key = stage_key(
+        parents=[raw_key, hash_file(behavioural_path)],
+        params={
+            'TRIGGER_IDS': config.TRIGGER_IDS, 'TRIGGER_BITS': config.TRIGGER_BITS,
+            'TRIGGER_MIN_SAMPLES': config.TRIGGER_MIN_SAMPLES, 'BIP_DEFAULT_DURATION': config.BIP_DEFAULT_DURATION,
+            'EVENT_STORE_SCHEMA_VERSION': EVENT_STORE_SCHEMA_VERSION
+        }
+    )
+    events, _ = cached_stage(
+        checkpoint_dir, 'events', events_key,
+        compute=lambda: extract_events(load_raw(), load_json_to_dict(behavioural_path)),
+        save=save_events_checkpoint,
+        load=load_events_checkpoint
+    )
+    
+    # Annotate non-listening periods: will be rejected for ICA
+    annotations = mne.Annotations(
+        onset=events['no_task_onsets'], 
+        duration=events['no_task_durations'], 
+        description=['bad'] * len(events['no_task_onsets']) 
+    )
+
+    # ======================
+    # Preprocessing eeg data 
+    filtered_key = stage_key(
+        parents=[raw_key],
+        params={
+            'EXTERNAL_MAPPING': config.EXTERNAL_MAPPING, 'BIOSEMI_MAPPING': config.BIOSEMI_MAPPING,
+            'UNUSED_EXT_CH': config.UNUSED_EXT_CH, 'CH_TYPES': config.CH_TYPES,
+            'l_freq': 1, 'h_freq': 40, 'call_type': 'forward_compensated_reflected',
+            'FILTER_BLOCK_SIZE': config.FILTER_BLOCK_SIZE, 'fused_decimation': True,
+            'TARGET_SAMPLING_RATE': config.TARGET_SAMPLING_RATE, 'PROCESSING_DTYPE': config.PROCESSING_DTYPE
+        }
+    )
+    rereferenced_key = stage_key(parents=[filtered_key], params={'ref_channels': ['M1', 'M2']})
+
+    def rereference() -> mne.io.BaseRaw:
+        filtered, _ = cached_stage(
+            checkpoint_dir, 'filtered', filtered_key,
+            compute=lambda: filter_and_resample(load_raw(), n_jobs=filter_jobs),
+            save=save_raw_checkpoint,
+            load=load_raw_checkpoint
+        )
+        loaded_raw.clear()
+        # Rereference to mastoids
+        rereferenced = filtered.set_eeg_reference(
+            ['M1', 'M2'],
+            verbose=config.VERBOSE_LEVEL
+        )
+        # Only the EEG channels changed
+        return round_to_precision(rereferenced, picks=mne.pick_types(rereferenced.info, eeg=True).tolist())
+    raw, _ = cached_stage(
+        checkpoint_dir, 'rereferenced', rereferenced_key,
+        compute=rereference,
+        save=save_raw_checkpoint,
+        load=load_raw_checkpoint
     )
+    loaded_raw.clear()
+    raw.set_annotations(annotations)
 
     # ICA to remove artifacts
-    ica = mne.preprocessing.ICA(
-        n_components=config.ICA_PERCENTAGE, 
-        method="infomax", 
-        random_state=config.RANDOM_SEED,
-        fit_params={'extended': True}, # to better separate sources. The extended version of the Infomax algorithm is designed to handle sub-Gaussian sources more effectively (line source for e.g).
+    ica_params = {
+        'n_components': config.ICA_N_COMPONENTS if config.ICA_N_COMPONENTS is not None else config.ICA_PERCENTAGE,
+        'method': config.ICA_METHOD,
+        'random_state': config.RANDOM_SEED,
+        'decim': config.ICA_DECIM,
+        'segment_fraction': config.ICA_SEGMENT_FRACTION,
+        'segment_seconds': config.ICA_SEGMENT_SECONDS
+    }
+    ica_key = stage_key(parents=[rereferenced_key, events_key], params=ica_params)
+    ica, _ = cached_stage(
+        checkpoint_dir, 'ica', ica_key,
+        compute=lambda: fit_ica(raw, **ica_params, verbose=config.VERBOSE_LEVEL),
+        save=save_ica_checkpoint,
+        load=load_ica_checkpoint
+    )
+
+    # Persist the solution with what it was fitted on, so it can be re-applied later
+    ica.save(PREPROCESSED_DIR_ICA / f"{eeg_path.stem}-ica.fif", overwrite=True, verbose=config.VERBOSE_LEVEL)
+    dump_dict_to_json(
+        filepath=PREPROCESSED_DIR_ICA / f"{eeg_path.stem}_ica.json",
+        data_dict={
+            'subject': eeg_path.stem,
+            'bdf_sha256': raw_key,
+            'params': ica_params,
+            'n_components': int(ica.n_components_),
+            'ica_key': ica_key,
+            'events_key': events_key,
+            'rereferenced_key': rereferenced_key
+        }
     )
-    ica = ica.fit(
-        raw, 
-        picks='eeg', 
-        reject_by_annotation=True, # reject 'bad' annotations
-        verbose=config.VERBOSE_LEVEL
-    ) 
-
-    # Plot ICA components for inspection
-    sub_fig_path = FIGURES_ICA / f'{eeg_path.stem}'
-    sub_fig_path.mkdir(parents=True, exist_ok=True)
-    for component in np.arange(ica.n_components_):
-        plt.close('all')
-        fig = ica.plot_properties(
-            raw, 
-            picks=[component], 
-            show=False, 
-            verbose='CRITICAL'
-        ) 
-        fig[0].savefig(
-            sub_fig_path / f"{component}_properties.png"
+
+    # Plot ICA components for inspection (only when the solution changed)
+    if figures:
+        save_ica_figures(
+            ica_path=PREPROCESSED_DIR_ICA / f"{eeg_path.stem}-ica.fif",
+            raw_path=checkpoint_dir / f"rereferenced-{rereferenced_key[:16]}" / 'checkpoint_raw.fif',
+            output_dir=FIGURES_ICA / f'{eeg_path.stem}',
+            annotations=annotations,
+            n_jobs=figure_jobs,
+            figures_key=stage_key(parents=[ica_key], params={})
         )
-    plt.close('all')
-    fig = ica.plot_components(show=False)
-    if ica.n_components_ >= 20:
-        fig1, fig2 = fig
-        fig1.savefig(sub_fig_path / "topo1.png")
-        fig2.savefig(sub_fig_path / "topo2.png")
-    else:
-        fig.savefig(sub_fig_path / "topo.png")
-    plt.close('all')
-    fig = ica.plot_sources(raw, show=False)
-    fig.savefig(sub_fig_path / "sources.png")
-    
+
+    apply_ica_and_save(eeg_path.stem, raw, ica, events)
+
+def apply_ica_subject(
+    subject: str
+) -> None:
+    """
+    Apply the current config.ICA_REMOVAL of a subject to its saved ICA solution and
+    rewrite the cleaned recording, without refitting. Uses the solution saved by
+    `preprocess_subject` and the rereferenced recording and events it was fitted on.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the recording (stem of the BDF file).
+    """
+    ica_info = load_json_to_dict(PREPROCESSED_DIR_ICA / f"{subject}_ica.json")
+    checkpoint_dir = CHECKPOINTS_DIR / subject
+    rereferenced_dir = checkpoint_dir / f"rereferenced-{ica_info['rereferenced_key'][:16]}"
+    events_dir = checkpoint_dir / f"events-{ica_info['events_key'][:16]}"
+    if not rereferenced_dir.is_dir() or not events_dir.is_dir():
+        raise FileNotFoundError(
+            f"Checkpoints of the data the ICA of {subject} was fitted on are missing, run the full preprocessing."
+        )
+    ica = mne.preprocessing.read_ica(PREPROCESSED_DIR_ICA / f"{subject}-ica.fif", verbose=config.VERBOSE_LEVEL)
+    raw = load_raw_checkpoint(rereferenced_dir)
+    events = load_events_checkpoint(events_dir)
+    apply_ica_and_save(subject, raw, ica, events)
+
+def apply_ica_and_save(
+    subject: str,
+    raw: mne.io.BaseRaw,
+    ica: mne.preprocessing.ICA,
+    events: dict
+) -> None:
+    """
+    Remove the ICA components of config.ICA_REMOVAL and save the cleaned recording,
+    the events store (events and trigger channel, npz) and the trigger report (JSON).
+
+    Parameters
+    ----------
+    subject : str
+        Name of the recording (stem of the BDF file).
+    raw : mne.io.BaseRaw
+        Rereferenced recording the ICA was fitted on. Modified in place.
+    ica : mne.preprocessing.ICA
+        The fitted ICA.
+    events : dict
+        Events returned by `extract_events`.
+    """
     # Remove artifact components based on predefined list
-    ica.exclude = config.ICA_REMOVAL[eeg_path.stem] if eeg_path.stem in config.ICA_REMOVAL.keys() else []
+    ica.exclude = config.ICA_REMOVAL[subject] if subject in config.ICA_REMOVAL.keys() else []
     raw = ica.apply(raw)
 
     # Compute how much variance is explained by removed components
     if len(ica.exclude) > 0:
         sources = ica.get_sources(raw).get_data()
         var_explained = np.sum(np.var(sources[ica.exclude, :], axis=1)) / np.sum(np.var(sources, axis=1))
-        print(f"Variance explained by removed ICA components for {eeg_path.stem}: {var_explained*100:.2f}%")
+        print(f"Variance explained by removed ICA components for {subject}: {var_explained*100:.2f}%")
     else:
         var_explained = 0.0
 
@@ -279,29 +585,205 @@ for eeg_path in tqdm(list(config.EEG_DIR.glob("*.bdf")), desc="Preprocessing EEG
     
     # Save preprocessed data
     raw.save(
-        PREPROCESSED_DIR_FIF / f"{eeg_path.stem}_preprocessed.fif", 
+        PREPROCESSED_DIR_FIF / f"{subject}_preprocessed.fif", 
         verbose=config.VERBOSE_LEVEL,
         overwrite=True,
     )
 
-    # Save events times to json
-    events_times = {
-        'listening_onsets': listening_onsets,
-        'listening_durations': listening_durations,
-        'listening_annotations': ['listening'] * len(listening_onsets),
-        'no_task_durations': no_task_durations,
-        'no_task_onsets': no_task_onsets,
-        'no_task_annotations': ['no-task'] * len(no_task_onsets),
-        'bips_onsets': all_bips_onsets,
-        'bips_durations': all_bips_durations,
-        'bips_descriptions': all_bips_descriptions
-    }
+    # Save the events store (events and trigger channel) and the trigger report
+    save_events(PREPROCESSED_DIR_ANNOT / f"events_{subject}.npz", events)
     dump_dict_to_json(
-        filepath=PREPROCESSED_DIR_ANNOT / f"events_{eeg_path.stem}.json",
-        data_dict=events_times
+        filepath=PREPROCESSED_DIR_ANNOT / f"trigger_report_{subject}.json",
+        data_dict=events['trigger_report']
+    )
+
+@contextmanager
+def blas_thread_env(
+    n_threads: int
+):
+    """
+    Set the thread environment variables of the BLAS/OpenMP backends while the context is
+    open, restoring the previous values on exit. They only affect processes started inside
+    the context (spawned workers load numpy after reading them), not the libraries already
+    loaded by the current process.
+
+    Parameters
+    ----------
+    n_threads : int
+        Maximum number of threads.
+    """
+    previous = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def run_subject(
+    eeg_path: Path,
+    apply_only: bool = False,
+    figures: bool = True,
+    figure_jobs: int = 1,
+    filter_jobs: int = 1
+) -> dict:
+    """
+    Preprocess one subject with its output (prints, warnings and MNE logs) written to
+    its own log file. Exceptions are caught and reported, so a bad recording doesn't
+    stop the rest of the batch.
+
+    Parameters
+    ----------
+    eeg_path : Path
+        Path to the raw BDF file.
+    apply_only : bool, optional
+        If True, only re-apply the saved ICA solution (see `apply_ica_subject`).
+    figures : bool, optional
+        If True (default), render the ICA figures when the ICA solution changed.
+    figure_jobs : int, optional
+        Number of worker processes rendering the ICA figures. Default is 1.
+    filter_jobs : int, optional
+        Number of threads filtering the channels. Default is 1.
+
+    Returns
+    -------
+    dict
+        Dictionary with:
+            - subject: name of the recording
+            - ok: True if the subject was preprocessed
+            - error: last line of the traceback if it failed, else None
+            - log: path of the log file
+    """
+    log_path = LOGS_DIR / f"{eeg_path.stem}.log"
+    error = None
+    open(log_path, 'w').close()
+    # Both handles append, so MNE's lines and the redirected output don't overwrite each other
+    with open(log_path, 'a', buffering=1) as log_file, redirect_stdout(log_file), redirect_stderr(log_file):
+        mne.set_log_file(log_path, overwrite=False)
+        try:
+            if apply_only:
+                apply_ica_subject(eeg_path.stem)
+            else:
+                preprocess_subject(eeg_path, figures, figure_jobs, filter_jobs)
+        except Exception:
+            traceback.print_exc()
+            error = traceback.format_exc().strip().splitlines()[-1]
+        finally:
+            log_file.flush()
+            mne.set_log_file(None)
+            plt.close('all')
+    return {'subject': eeg_path.stem, 'ok': error is None, 'error': error, 'log': log_path}
+
+def main(
+    jobs: int = 1,
+    blas_threads: int = 1,
+    apply_only: bool = False,
+    figures: bool = True,
+    figure_jobs: Union[int, None] = None,
+    filter_jobs: Union[int, None] = None
+) -> list[dict]:
+    """
+    Preprocess every BDF file in config.EEG_DIR, one subject per job.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        Number of worker processes. With 1 (default) subjects are processed serially.
+    blas_threads : int, optional
+        BLAS/OpenMP threads per worker, so jobs * blas_threads should not exceed the
+        number of cores. Ignored when jobs is 1 (the libraries' defaults are used).
+    apply_only : bool, optional
+        If True, only re-apply the saved ICA solutions of the subjects that have one,
+        with the current config.ICA_REMOVAL (no loading, filtering or fitting).
+    figures : bool, optional
+        If True (default), render the ICA figures of the subjects whose solution changed.
+    figure_jobs : Union[int, None], optional
+        Number of worker processes rendering the ICA figures of each subject. If None,
+        the cores left by the subject jobs are used, at most MAX_DEFAULT_FIGURE_JOBS.
+    filter_jobs : Union[int, None], optional
+        Number of threads filtering the channels of each subject. If None, the cores
+        left by the subject jobs are used.
+
+    Returns
+    -------
+    list[dict]
+        Result of each subject, see `run_subject`.
+    """
+    if apply_only:
+        eeg_paths = [
+            config.EEG_DIR / f"{path.name[:-len('_ica.json')]}.bdf"
+            for path in sorted(PREPROCESSED_DIR_ICA.glob("*_ica.json"))
+        ]
+        description = "Applying saved ICA solutions"
+    else:
+        eeg_paths = sorted(config.EEG_DIR.glob("*.bdf"))
+        description = "Preprocessing EEG files (patience, ICA takes ~2 mins per subj)"
+    if figure_jobs is None:
+        figure_jobs = min(MAX_DEFAULT_FIGURE_JOBS, max(1, (os.cpu_count() or 1) // max(jobs, 1)))
+    if filter_jobs is None:
+        filter_jobs = max(1, (os.cpu_count() or 1) // max(jobs, 1))
+    results = []
+    if jobs > 1 and len(eeg_paths) > 1:
+        # Spawned (not forked) workers start a fresh interpreter, so their BLAS is loaded
+        # after the thread variables are set; the parent's own libraries are untouched
+        with blas_thread_env(blas_threads), ProcessPoolExecutor(
+            max_workers=min(jobs, len(eeg_paths)),
+            mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            futures = [
+                executor.submit(run_subject, eeg_path, apply_only, figures, figure_jobs, filter_jobs)
+                for eeg_path in eeg_paths
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=description):
+                results.append(future.result())
+    else:
+        for eeg_path in tqdm(eeg_paths, desc=description):
+            results.append(run_subject(eeg_path, apply_only, figures, figure_jobs, filter_jobs))
+
+    # Report failures, each subject's log has the full traceback
+    failed = [result for result in results if not result['ok']]
+    print(f"Preprocessed {len(results) - len(failed)}/{len(results)} subjects")
+    for result in failed:
+        print(f"  - {result['subject']} failed: {result['error']} (see {result['log']})")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of subjects processed in parallel (worker processes). Default is 1.'
+    )
+    parser.add_argument(
+        '--blas-threads', type=int, default=1,
+        help='BLAS/OpenMP threads per worker when --jobs > 1. Default is 1.'
+    )
+    parser.add_argument(
+        '--apply-only', action='store_true',
+        help='Only re-apply the saved ICA solutions with the current config.ICA_REMOVAL.'
+    )
+    parser.add_argument(
+        '--no-figures', action='store_true',
+        help='Skip the ICA diagnostic figures.'
+    )
+    parser.add_argument(
+        '--figure-jobs', type=int, default=None,
+        help='Worker processes rendering the ICA figures of each subject (each holds about a copy of the recording). Default uses the cores left by --jobs, at most 4.'
+    )
+    parser.add_argument(
+        '--filter-jobs', type=int, default=None,
+        help='Threads filtering the channels of each subject. Default uses the cores left by --jobs.'
+    )
+    args = parser.parse_args()
+    results = main(
+        jobs=args.jobs,
+        blas_threads=args.blas_threads,
+        apply_only=args.apply_only,
+        figures=not args.no_figures,
+        figure_jobs=args.figure_jobs,
+        filter_jobs=args.filter_jobs
     )
-   
-    # Save the last channel (triggers) separately
-    np.save(
-        PREPROCESSED_DIR_TRIGGERS / f"events_{eeg_path.stem}.npy", trigger
-    )
\ No newline at end of file
+    if not all(result['ok'] for result in results):
+        raise SystemExit(1)
@@ -3,7 +3,8 @@ import pandas as pd
 import numpy as np
 import mne
 
-from utils.processing import load_json_to_dict
+from utils.events_helpers import load_event_store, event_samples
+from utils.processing import load_json_to_dict, clip_intervals, in_intervals
 from utils.figures_helpers import (
     onsets_plot, evoked_potential_plot
 )
@@ -11,7 +12,6 @@ import config
 
 OUTPUT_FIGURES_DIR = config.FIGURES_DIR / "evoked_potentials"
 ANNOT_DIR = config.PREPROCESSED_DIR / 'annotations'
-TRIGGER_DIR = config.PREPROCESSED_DIR / 'triggers'
 FIF_DIR = config.PREPROCESSED_DIR / 'fif'
 
 TMING_WINDOW = (-.2, .8)  # Time window around the bip stimuli in seconds
@@ -53,14 +53,14 @@ for eeg_file in FIF_DIR.glob("*_preprocessed.fif"):
     raw = raw.pick_types(eeg=True, exclude=['M1', 'M2'])
     info_mne = raw.info.copy()
 
-    # Read json annotation file
-    annotations_data = load_json_to_dict(
-        filepath=ANNOT_DIR / f"events_{eeg_name}.json"
-    )
+    # Read the events store
+    events_data = load_event_store(ANNOT_DIR / f"events_{eeg_name}.npz")
     
     # Create epochs around bip stimuli
-    bips_indexes = raw.time_as_index(
-        annotations_data['bips_onsets']
+    bips_indexes = event_samples(
+        events_data, 
+        raw.info['sfreq'], 
+        mask=np.char.startswith(events_data['category'], 'bip')
     )
     bip_events = np.zeros(
         shape=(len(bips_indexes), 3), dtype=int
@@ -69,7 +69,7 @@ for eeg_file in FIF_DIR.glob("*_preprocessed.fif"):
     bip_events[:,2] = ID_NAMES['bip']
 
     # Create epochs to audiobook listening periods
-    listening_onsets = annotations_data['listening_onsets']
+    listening_onsets = events_data['time'][events_data['category'] == 'listening']
     listening_onsets_non_target = []
     listening_onsets_target = []
     for subject_audiofile_code, listening_onset, target in zip(
@@ -77,10 +77,22 @@ for eeg_file in FIF_DIR.glob("*_preprocessed.fif"):
         listening_onsets,
         subject_targets
     ):
-        onsets_df = pd.read_csv(config.ONSETS_DIR / f"{subject_audiofile_code}_onsets.csv")
-        for onset in onsets_df.values:
-            listening_onsets_target.append(listening_onset + onset[0 if target=='L' else 1])
-            listening_onsets_non_target.append(listening_onset + onset[1 if target=='L' else 0])
+        onsets = pd.read_csv(config.ONSETS_DIR / f"{subject_audiofile_code}_onsets.csv").values
+        listening_onsets_target.append(listening_onset + onsets[:, 0 if target=='L' else 1])
+        listening_onsets_non_target.append(listening_onset + onsets[:, 1 if target=='L' else 0])
+    listening_onsets_target = np.concatenate(listening_onsets_target) if listening_onsets_target else np.empty(0)
+    listening_onsets_non_target = np.concatenate(listening_onsets_non_target) if listening_onsets_non_target else np.empty(0)
+
+    # Keep only the onsets within the listening periods recorded
+    is_listening = events_data['category'] == 'listening'
+    listening_periods = clip_intervals(
+        onsets=events_data['time'][is_listening],
+        offsets=events_data['time'][is_listening] + events_data['duration'][is_listening],
+        start=raw.times[0],
+        stop=raw.times[-1]
+    )
+    listening_onsets_target = listening_onsets_target[in_intervals(listening_onsets_target, *listening_periods)]
+    listening_onsets_non_target = listening_onsets_non_target[in_intervals(listening_onsets_non_target, *listening_periods)]
     
     listening_indexes_target = raw.time_as_index(listening_onsets_target)
     listening_events_target = np.zeros(
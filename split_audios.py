@@ -1,30 +1,48 @@
 """
 This script processes audiobook files by converting them to .ogg format,
 adjusting sample rates and combining to audios in a stereo format.
+
+Each (female, male) combination is processed as an independent job, so the
+combinations can be spread over a pool of worker processes:
+
+    python split_audios.py --jobs 8
+
+Several independent probe schedules per stimulus (for counterbalancing) are
+mixed against the same decoded and level-matched base buffer:
+
+    python split_audios.py --variants 4
 """
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import shutil
+import argparse
+import random
+import zlib
 
 from utils.audio_helpers import (
-    convert_to_wav, combine_audio_stereo, wav_to_ogg, read_wav, 
-    save_wav, scale_audio, plot_audio_profile, create_bip,
-    create_attention_probe, create_attention_track,
-    scramble_audio, scale_audio_to_relative_db, 
+    cached_convert_to_wav, wav_to_ogg, read_wav, plot_audio_profile, 
+    create_bip, create_attention_probe, schedule_attention_probes,
+    probe_onsets_seconds, add_attention_probes, scramble_audio,
+    stretch_audio_array, match_audio_level_arrays, combine_stereo_arrays,
+    batch_encode_ogg,
+)
+from utils.cache_helpers import (
+    prune_cache, hash_file, load_manifest, save_manifest,
+    outputs_up_to_date, record_outputs,
 )
 import config
 
 # Paths
-INTERMEDIATE_AUDIO_DIR = config.STIMULI_DIR / 'intermediate_audios'
+DECODE_CACHE_DIR = config.STIMULI_DIR / 'decode_cache'
 OUTPUT_DIR = config.STIMULI_DIR / 'processed_audios'
 AUDIO_DIR = config.STIMULI_DIR / 'original_audios'
 TABLES_DIR = config.PSYCHOPY_DIR.parent
+MANIFEST_PATH = OUTPUT_DIR / 'build_manifest.json'
 
-INTERMEDIATE_AUDIO_DIR.mkdir(parents=True, exist_ok=True)
+DECODE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 TABLES_DIR.mkdir(parents=True, exist_ok=True)
-assert AUDIO_DIR.exists(), f"Audio directory {AUDIO_DIR} does not exist. Please load necessary audio files."
 
 # Create output subdirectories  
 no_probe_path = OUTPUT_DIR/'no_probe'
@@ -33,109 +51,375 @@ no_probe_path.mkdir(parents=True, exist_ok=True)
 probe_path.mkdir(parents=True, exist_ok=True)
 probe_path_short = probe_path.parent.parent / 'processed_audios_short' 
 probe_path_short.mkdir(parents=True, exist_ok=True)
+variants_path = OUTPUT_DIR/'with_probe_variants'
 
 # Hyperparameters
 ABSOLUTE_RELATIVE_ATTENUATION_DB = 10
 NUMBER_OF_SCRAMBLE_SEGMENTS = 10
 THRESHOLD_DIFF_SECONDS = 10 # seconds
+STRETCH_METHOD = 'polyphase' # 'polyphase' (band-limited, shifts pitch slightly), 'wsola' (pitch preserving) or 'interp' (legacy)
+LOUDNESS_METHOD = 'energy' # 'energy' (legacy, mean energy), 'gated_rms' (ignores silences) or 'lufs' (K-weighted, BS.1770)
 COMMON_SAMPLE_RATE = 48000 # Hz
 PROBE_DURATION = .1  # seconds
 ATTACK_THRESHOLD = 0.1 # Attack detection in probe profile as percentage of max amplitude
 PROBE_TYPE = 1000 # "va"
 SCRAMBLED_PROBE = False
 OGG_BITRATE = '96k' # standard '64k', '96k', '128k', '160k', '192k', '256k', '320k'
+OGG_ENCODE_WORKERS = 3 # concurrent ffmpeg encoders per job (no-probe, with-probe and short versions)
+DECODE_CACHE_MAX_GB = 20 # size cap of the decoded WAV cache (least recently used entries are evicted)
 
 BIP_FREQ = 1000  # Hz
 BIP_DUR = 500   # ms
 BIP_VOL = -20  # dB
 
-# Create a bip sound for events: bip of 500ms at 1000Hz followed by 500ms of silence
-create_bip(
-    output_file=OUTPUT_DIR/'bip.wav',
-    bip_freq=BIP_FREQ,
-    bip_dur=BIP_DUR,
-    bip_vol=BIP_VOL,
-    sample_rate=COMMON_SAMPLE_RATE,
-    silence_sides_dur=BIP_DUR,
-    silence_type="after",
-    number_of_bips=0
-)
-wav_to_ogg(
-    input_wav=OUTPUT_DIR / 'bip.wav',
-    output_ogg=OUTPUT_DIR / 'bip.ogg',
-    sample_rate_target=COMMON_SAMPLE_RATE,
-    bitrate=OGG_BITRATE
-)
-(OUTPUT_DIR / 'bip.wav').unlink()
+def get_combinations(
+    audio_paths: list[Path]
+) -> list[tuple[Path, Path]]:
+    """
+    Pair female and male stories with consecutive order 1,2 ; 3,4 ; 5,6; etc.
 
-# Get total number of audios
-audio_paths = list(AUDIO_DIR.glob('*.mp3'))
-assert len(audio_paths)%2==0, "The number of audio files must be even. One male, one female"
-number_of_stories = len(audio_paths)//2
+    Parameters
+    ----------
+    audio_paths : list[Path]
+        Paths to the original MP3 files (one male and one female per story).
 
-# Find male and female with corresponding numbers
-ordered_female = sorted(
-    [path for path in audio_paths if 'mujer' in path.name],
-    key=lambda p: p.name.split('_')[0]
-)
-ordered_male = sorted(
-    [path for path in audio_paths if 'hombre' in path.name],
-    key=lambda p: p.name.split('_')[0]
-)
-audio_names = [f_path.stem.split('_')[1] for f_path in ordered_female]
-assert audio_names == [m_path.stem.split('_')[1] for m_path in ordered_male], "Mismatch between female and male audio names"
-
-# Get combinations with consecutive order 1,2 ; 3,4 ; 5,6; etc
-combinations = []
-for i in range(number_of_stories):
-    if i % 2 == 0:
-        f_path = ordered_female[i]
-        m_path = ordered_male[i + 1]
-        combinations.append(
-            (f_path, m_path)
-        )
-        m_path = ordered_male[i]
-        f_path = ordered_female[i + 1]
-        combinations.append(
-            (f_path, m_path)
-        )
+    Returns
+    -------
+    list[tuple[Path, Path]]
+        List of (female, male) combinations.
+    """
+    assert len(audio_paths)%2==0, "The number of audio files must be even. One male, one female"
+    number_of_stories = len(audio_paths)//2
 
-# Create attentional probe
-attention_probe_path = OUTPUT_DIR / 'attention_probe.wav'
-scrambled_probe_path = attention_probe_path.with_name(attention_probe_path.stem + '_scrambled.wav')
-create_attention_probe(
-    output_attention_probe_path=attention_probe_path,
-    duration_seconds=PROBE_DURATION,
-    stimulus_type=PROBE_TYPE,
-    sr=COMMON_SAMPLE_RATE
-)
-# Generate audio profile to verify attack characteristics (should be fast and clear)
-probe_profile_path = attention_probe_path.parents[1] / f'attention_probe_{PROBE_TYPE}_{int(PROBE_DURATION*1000)}_profile.png'
-attack_metrics = plot_audio_profile(
-    audio_path=attention_probe_path,
-    output_path=probe_profile_path,
-    attack_threshold=ATTACK_THRESHOLD,
-    plot_spectrum=True
-)
-if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
-    scramble_audio(
-        input_file=attention_probe_path,
-        output_file=scrambled_probe_path,
-        number_of_segments=NUMBER_OF_SCRAMBLE_SEGMENTS
+    # Find male and female with corresponding numbers
+    ordered_female = sorted(
+        [path for path in audio_paths if 'mujer' in path.name],
+        key=lambda p: p.name.split('_')[0]
+    )
+    ordered_male = sorted(
+        [path for path in audio_paths if 'hombre' in path.name],
+        key=lambda p: p.name.split('_')[0]
+    )
+    audio_names = [f_path.stem.split('_')[1] for f_path in ordered_female]
+    assert audio_names == [m_path.stem.split('_')[1] for m_path in ordered_male], "Mismatch between female and male audio names"
+
+    combinations = []
+    for i in range(number_of_stories):
+        if i % 2 == 0:
+            f_path = ordered_female[i]
+            m_path = ordered_male[i + 1]
+            combinations.append(
+                (f_path, m_path)
+            )
+            m_path = ordered_male[i]
+            f_path = ordered_female[i + 1]
+            combinations.append(
+                (f_path, m_path)
+            )
+    return combinations
+
+def get_stereo_names(
+    audio_f: Path,
+    audio_m: Path
+) -> tuple[str, str]:
+    """
+    Get the code names of both stereo stimuli of a combination, based on the
+    original numbering of the stories.
+
+    Parameters
+    ----------
+    audio_f : Path
+        Path to the female MP3 file.
+    audio_m : Path
+        Path to the male MP3 file.
+
+    Returns
+    -------
+    tuple[str, str]
+        Female-left and male-left code names (e.g. ('F01_M02', 'M02_F01')).
+    """
+    number_f = int(audio_f.stem.split('_')[0])
+    number_m = int(audio_m.stem.split('_')[0])
+    return f'F{number_f:02d}_M{number_m:02d}', f'M{number_m:02d}_F{number_f:02d}'
+
+def get_combination_outputs(
+    stereo_names: tuple[str, str],
+    variants: int = 1
+) -> dict:
+    """
+    Get every output of a combination together with the hyperparameters that affect it.
+
+    Parameters
+    ----------
+    stereo_names : tuple[str, str]
+        Code names of both stereo stimuli of the combination.
+    variants : int, optional
+        Number of probe schedules per stimulus, see `process_combination`. Default is 1.
+
+    Returns
+    -------
+    dict
+        Mapping of output path to its relevant hyperparameters.
+    """
+    level_params = {
+        'ABSOLUTE_RELATIVE_ATTENUATION_DB': ABSOLUTE_RELATIVE_ATTENUATION_DB,
+        'THRESHOLD_DIFF_SECONDS': THRESHOLD_DIFF_SECONDS,
+        'COMMON_SAMPLE_RATE': COMMON_SAMPLE_RATE,
+        'STRETCH_METHOD': STRETCH_METHOD,
+        'LOUDNESS_METHOD': LOUDNESS_METHOD,
+    }
+    onset_params = {
+        'THRESHOLD_DIFF_SECONDS': THRESHOLD_DIFF_SECONDS,
+        'COMMON_SAMPLE_RATE': COMMON_SAMPLE_RATE,
+        'RANDOM_SEED': config.RANDOM_SEED,
+    }
+    probe_params = {**level_params, **onset_params, 'OGG_BITRATE': OGG_BITRATE}
+    outputs = {}
+    for stereo_name in stereo_names:
+        outputs[no_probe_path / f'{stereo_name}_no_probe.ogg'] = {**level_params, 'OGG_BITRATE': OGG_BITRATE}
+        outputs[get_probe_save_path(stereo_name).with_suffix('.ogg')] = probe_params
+        outputs[probe_path_short / f'{stereo_name}_short.ogg'] = probe_params
+        outputs[OUTPUT_DIR / 'onsets' / f'{stereo_name}_onsets.csv'] = onset_params
+        for variant in range(1, variants):
+            outputs[get_variant_save_path(stereo_name, variant)] = {**probe_params, 'VARIANT': variant}
+            outputs[get_onsets_path(stereo_name, variant)] = {**onset_params, 'VARIANT': variant}
+    return outputs
+
+def get_probe_save_path(
+    stereo_name: str
+) -> Path:
+    """
+    Get the output path of a stereo stimulus with probes according to hyperparameters.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+
+    Returns
+    -------
+    Path
+        Path of the WAV file with probes.
+    """
+    if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
+        return probe_path / f'{stereo_name}_scrambled.wav'
+    elif isinstance(PROBE_TYPE, str) and not SCRAMBLED_PROBE:
+        return probe_path / f'{stereo_name}_not_scrambled.wav'
+    elif isinstance(PROBE_TYPE, int):
+        return probe_path / f'{stereo_name}_tone_probe.wav'
+    raise ValueError("PROBE_TYPE must be either str or int.")
+
+def get_variant_save_path(
+    stereo_name: str,
+    variant: int
+) -> Path:
+    """
+    Get the output path of an extra probe schedule (variant) of a stereo stimulus.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+    variant : int
+        Variant number (1 or more, variant 0 is the stimulus in `probe_path`).
+
+    Returns
+    -------
+    Path
+        Path of the OGG file with probes.
+    """
+    return variants_path / f'{get_probe_save_path(stereo_name).stem}_v{variant:02d}.ogg'
+
+def get_onsets_path(
+    stereo_name: str,
+    variant: int = 0
+) -> Path:
+    """
+    Get the path of the probe onsets CSV of a stereo stimulus.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+    variant : int, optional
+        Variant number. Default is 0 (the stimulus in `probe_path`).
+
+    Returns
+    -------
+    Path
+        Path of the onsets CSV.
+    """
+    suffix = f'_v{variant:02d}' if variant > 0 else ''
+    return OUTPUT_DIR / 'onsets' / f'{stereo_name}{suffix}_onsets.csv'
+
+def get_combination_row(
+    stereo_name: str,
+    save_path: Path
+) -> dict:
+    """
+    Build the PsychoPy table row of a stereo stimulus from its code name.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+    save_path : Path
+        Path of the WAV file with probes.
+
+    Returns
+    -------
+    dict
+        Row with filename and condition labels.
+    """
+    story_right = stereo_name.split('_')[1][1:]
+    story_left = stereo_name.split('_')[0][1:]
+    voice_right = stereo_name.split('_')[1][0]
+    voice_left = stereo_name.split('_')[0][0]
+    ordered = story_left < story_right
+    condition_label = f'O_{voice_left}_{voice_right}' if ordered else f'NO_{voice_left}_{voice_right}'
+    return {
+        'filename':str(Path("..")/save_path.with_suffix('.ogg')),
+        'condition_label': condition_label,
+        'ordered': ordered,
+        'story_L': story_left,
+        'story_R': story_right,
+        'voice_L': voice_left,
+        'voice_R': voice_right,
+    }
+
+def decode_audio(
+    audio_path: Path
+) -> Path:
+    """
+    Decode an MP3 to a mono WAV at COMMON_SAMPLE_RATE through the decode cache.
+
+    Parameters
+    ----------
+    audio_path : Path
+        Path to the MP3 file.
+
+    Returns
+    -------
+    Path
+        Path to the cached WAV file.
+    """
+    return cached_convert_to_wav(
+        input_file=audio_path,
+        cache_dir=DECODE_CACHE_DIR,
+        stereo=False,
+        sample_rate_target=COMMON_SAMPLE_RATE
     )
-    attention_probe_path = scrambled_probe_path
 
-# Process each combination
-audio_combinations_dict = []
-skipped_combinations = []
-for j, (audio_f, audio_m) in enumerate(combinations):
+def get_job_rng(
+    stereo_name: str
+) -> random.Random:
+    """
+    Random generator seeded from the stimulus name, so probe placement is
+    reproducible regardless of job order or number of workers.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+
+    Returns
+    -------
+    random.Random
+        Seeded random generator.
+    """
+    return random.Random(f'{config.RANDOM_SEED}_{stereo_name}')
+
+def get_variant_rngs(
+    stereo_name: str,
+    variants: int
+) -> list[np.random.Generator]:
+    """
+    Independent random streams of the extra probe schedules (variants 1 to variants-1)
+    of a stimulus, spawned from a SeedSequence keyed on RANDOM_SEED and the stimulus name.
+    Spawned streams don't depend on the number of variants, so raising it keeps the
+    existing variants unchanged.
+
+    Parameters
+    ----------
+    stereo_name : str
+        Code name of the stereo stimulus (e.g. 'F01_M02').
+    variants : int
+        Number of probe schedules per stimulus, including the default one.
+
+    Returns
+    -------
+    list[np.random.Generator]
+        One generator per extra variant.
+    """
+    seed_sequence = np.random.SeedSequence([config.RANDOM_SEED, zlib.crc32(stereo_name.encode('utf8'))])
+    return [np.random.default_rng(child) for child in seed_sequence.spawn(max(variants - 1, 0))]
+
+def save_onsets(
+    events: dict,
+    onsets_file: Path
+) -> None:
+    """
+    Save the probe onsets (in seconds) of each channel on a csv file.
+
+    Parameters
+    ----------
+    events : dict
+        Event list returned by `schedule_attention_probes`.
+    onsets_file : Path
+        Path of the CSV file.
+    """
+    left_onsets, right_onsets = probe_onsets_seconds(events, COMMON_SAMPLE_RATE)
+    data_onsets = pd.DataFrame({
+        'left_s': left_onsets,
+        'right_s': right_onsets
+    })
+    onsets_file.parent.mkdir(parents=True, exist_ok=True)
+    data_onsets.to_csv(
+        onsets_file,
+        index=False,
+        sep=',',
+        float_format='%.6f'
+    )
+
+def process_combination(
+    audio_f: Path,
+    audio_m: Path,
+    attention_probe_path: Path,
+    variants: int = 1
+) -> dict:
+    """
+    Process a single (female, male) combination: convert, match durations and
+    levels, build both stereo conditions (with and without probes) and encode them.
+    Only the decoded inputs are read from disk (through the decode cache); every
+    other stage passes float32 buffers.
+    With variants > 1, extra independent probe schedules are mixed against the same
+    level-matched base buffer, so decoding, stretching and level matching run once.
+
+    Parameters
+    ----------
+    audio_f : Path
+        Path to the female MP3 file.
+    audio_m : Path
+        Path to the male MP3 file.
+    attention_probe_path : Path
+        Path to the attention probe WAV file.
+    variants : int, optional
+        Number of probe schedules per stimulus, including the default one. Default is 1.
+
+    Returns
+    -------
+    dict
+        Dictionary with:
+            - rows: PsychoPy table rows of the saved stereo stimuli
+            - variant_rows: PsychoPy table rows of the extra probe schedules
+            - skipped: code names of the skipped stimuli (empty if not skipped)
+    """
     # Get numbers and names of the stories
     number_f, audio_name_f = int(audio_f.stem.split('_')[0]), audio_f.stem.split('_')[1]
     number_m, audio_name_m = int(audio_m.stem.split('_')[0]), audio_m.stem.split('_')[1]
 
     # The code names are based on the original numbering of the stories 
-    stereo_name1 = f'F{number_f:02d}_M{number_m:02d}' 
-    stereo_name2 = f'M{number_m:02d}_F{number_f:02d}' 
+    stereo_name1, stereo_name2 = get_stereo_names(audio_f, audio_m)
     
     # Examples:
     # First iteration: (number_f, number_m) = (1, 2)
@@ -146,180 +430,332 @@ for j, (audio_f, audio_m) in enumerate(combinations):
     # M01_F02.wav --> male story 1 on left ear, female story 2 on right ear
     # ...
 
-    # Convert to wav to operate on higher quality audio --> then downsample if needed
-    convert_to_wav(audio_f, INTERMEDIATE_AUDIO_DIR / audio_f.with_suffix('.wav').name, exists_ok=True, sample_rate_target=COMMON_SAMPLE_RATE)
-    convert_to_wav(audio_m, INTERMEDIATE_AUDIO_DIR / audio_m.with_suffix('.wav').name, exists_ok=True, sample_rate_target=COMMON_SAMPLE_RATE)
-    audio_f = INTERMEDIATE_AUDIO_DIR / audio_f.with_suffix('.wav').name
-    audio_m = INTERMEDIATE_AUDIO_DIR / audio_m.with_suffix('.wav').name
-    
+    # Convert to wav to operate on higher quality audio (cached across combinations and runs)
+    # The decoded inputs are memory-mapped, from the stretch on every stage works on in-memory buffers
+    (sr_m, wav_m) = read_wav(decode_audio(audio_m), return_sample_rate=True, mmap=True)
+    (sr_f, wav_f) = read_wav(decode_audio(audio_f), return_sample_rate=True, mmap=True)
+
     # Verify audio sample lengths and sample rates
-    (sr_m, wav_m), (sr_f, wav_f) = read_wav(audio_m, return_sample_rate=True), read_wav(audio_f, return_sample_rate=True)
     assert sr_m == sr_f, "Sample rates of male and female mismatch"
     len_m, len_f = len(wav_m), len(wav_f) 
     
     # Skip combinations with length differences beyond threshold
     diff = len_m - len_f
     if abs(diff) > THRESHOLD_DIFF_SECONDS*sr_m:
-        skipped_combinations.append((stereo_name1, stereo_name2))
         print(
             f"\n\n\t\tAudio lengths in combination {number_f}_{audio_name_f}_F-{number_m}_{audio_name_m}_M"+\
             f" differ by {diff/sr_m:.2f}s, "+\
             f"which is more than the current threshold ({THRESHOLD_DIFF_SECONDS} s)\n\n"+\
             "\t\tSkipping these 2 combinations.\n\n"
         )
-        continue
+        return {'rows': [], 'variant_rows': [], 'skipped': (stereo_name1, stereo_name2)}
     # Else, split differences, contracting longer audio and dilating shorter audio
     else:
-        scale_audio(
-            input_file=audio_m,
-            output_file=audio_m,
-            delta_frames=-diff//2 if diff >=0 else -diff//2
+        wav_m = stretch_audio_array(
+            data=wav_m,
+            delta_frames=-diff//2 if diff >=0 else -diff//2,
+            method=STRETCH_METHOD
         )
-        scale_audio(
-            input_file=audio_f,
-            output_file=audio_f,
-            delta_frames=diff//2 if diff >=0 else diff//2
+        wav_f = stretch_audio_array(
+            data=wav_f,
+            delta_frames=diff//2 if diff >=0 else diff//2,
+            method=STRETCH_METHOD
         )
     
     # Rescale female and male voices to common dB level
-    scale_audio_to_relative_db(
-        audio_to_scale_path=audio_f,
-        reference_audio_path=audio_m,
-        target_db_diff=0 # dB
+    wav_f, wav_m = match_audio_level_arrays(
+        audio_to_scale=wav_f,
+        reference_audio=wav_m,
+        target_db_diff=0, # dB
+        method=LOUDNESS_METHOD,
+        sample_rate=COMMON_SAMPLE_RATE
     )
+    sr_probe, probe_wav = read_wav(attention_probe_path, return_sample_rate=True)
+    assert sr_probe == COMMON_SAMPLE_RATE, "Attention probe must be sampled at COMMON_SAMPLE_RATE"
 
     # For each combination, first create stereo audio without probes 
+    rows, variant_rows = [], []
     for i, stereo_name in enumerate([stereo_name1, stereo_name2]):
-        audio_left = audio_f if i==0 else audio_m
-        audio_right = audio_m if i==0 else audio_f
-        combine_audio_stereo(
-            audio_left=audio_left,
-            audio_right=audio_right,
-            output_file=no_probe_path / f'{stereo_name}_no_probe.wav'
+        audio_left = wav_f if i==0 else wav_m
+        audio_right = wav_m if i==0 else wav_f
+        stereo_data = combine_stereo_arrays(
+            left=audio_left,
+            right=audio_right
         )
 
-        # Now redefine audios with ABSOLUTE_RELATIVE_ATTENUATION_DB attenuation
-        scale_audio_to_relative_db(
-            audio_to_scale_path=no_probe_path / f'{stereo_name}_no_probe.wav',
-            reference_audio_path=attention_probe_path,
-            target_db_diff=-ABSOLUTE_RELATIVE_ATTENUATION_DB # dB
+        # Now redefine audios with ABSOLUTE_RELATIVE_ATTENUATION_DB attenuation. 
+        # The reference probe is also attenuated if needed to avoid saturation
+        data, probe_scaled = match_audio_level_arrays(
+            audio_to_scale=stereo_data,
+            reference_audio=probe_wav,
+            target_db_diff=-ABSOLUTE_RELATIVE_ATTENUATION_DB, # dB
+            method=LOUDNESS_METHOD,
+            sample_rate=COMMON_SAMPLE_RATE
         )
 
-        # Convert to ogg
-        wav_to_ogg(
-            input_wav=no_probe_path / f'{stereo_name}_no_probe.wav',
-            output_ogg=no_probe_path / f'{stereo_name}_no_probe.ogg',
-            sample_rate_target=COMMON_SAMPLE_RATE,
-            bitrate=OGG_BITRATE
-        )
-        
-        # Then add attention tracks
-        sr_data, data = read_wav(no_probe_path / f'{stereo_name}_no_probe.wav', return_sample_rate=True)
-        normalized_data = data / np.max(np.abs(data))
-
-        n_probes, track_left, track_right, left_onsets, right_onsets = create_attention_track(
+        # Then schedule the attention probes and mix them in
+        events = schedule_attention_probes(
             duration_samples=len(data),
             sr=COMMON_SAMPLE_RATE,
-            probe_audio_path=attention_probe_path,
-            return_onsets=True
+            probe_len=len(probe_scaled),
+            rng=get_job_rng(stereo_name)
+        )
+        print(f"Added {events['n_probes']} probes to {stereo_name}")
+        mixed_data = add_attention_probes(
+            data=data,
+            events=events,
+            probe_audio=probe_scaled
         )
-        print(f'Added {n_probes} probes to {stereo_name}')
-        normalized_data[:,0] += track_left
-        normalized_data[:,1] += track_right
         
         # Save final audios according to hyperparameters
-        if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
-            save_path = probe_path / f'{stereo_name}_scrambled.wav'
-        elif isinstance(PROBE_TYPE, str) and not SCRAMBLED_PROBE:
-            save_path = probe_path / f'{stereo_name}_not_scrambled.wav'
-        elif isinstance(PROBE_TYPE, int):
-            save_path = probe_path / f'{stereo_name}_tone_probe.wav'
-        save_wav(save_path, sr_data, normalized_data)
+        save_path = get_probe_save_path(stereo_name)
 
         # Save probe onsets on a csv file
-        data_onsets = pd.DataFrame({
-            'left_s': left_onsets,
-            'right_s': right_onsets
-        })
-        onsets_path = save_path.parents[1] / 'onsets'
-        onsets_path.mkdir(parents=True, exist_ok=True)
-        data_onsets.to_csv(
-            onsets_path / f'{stereo_name}_onsets.csv',
-            index=False,
-            sep=',',
-            float_format='%.6f'
-        )
+        save_onsets(events, get_onsets_path(stereo_name))
         
-        # Convert to ogg
-        wav_to_ogg(
-            input_wav=save_path,
-            output_ogg=save_path.with_suffix('.ogg'),
-            sample_rate_target=COMMON_SAMPLE_RATE,
-            bitrate=OGG_BITRATE
+        # Convert to ogg: no-probe, with-probe and a shorter version for testing in psychopy (first 5 seconds)
+        batch_encode_ogg(
+            jobs=[
+                ((data, sr_f), no_probe_path / f'{stereo_name}_no_probe.ogg', OGG_BITRATE),
+                ((mixed_data, sr_f), save_path.with_suffix('.ogg'), OGG_BITRATE),
+                ((mixed_data[:COMMON_SAMPLE_RATE*5,:], sr_f), probe_path_short / f'{stereo_name}_short.ogg', OGG_BITRATE),
+            ],
+            max_workers=OGG_ENCODE_WORKERS,
+            sample_rate_target=COMMON_SAMPLE_RATE
         )
+    
+        # Save combinations
+        rows.append(get_combination_row(stereo_name, save_path))
+        del mixed_data
 
-        # Save a shorter version for testing in psychopy
-        short_data = normalized_data[:COMMON_SAMPLE_RATE*5,:]  # first 5 seconds
-        short_save_path = probe_path_short / f'{stereo_name}_short.wav'
-        save_wav(short_save_path, sr_data, short_data)
-        
+        # Extra probe schedules, mixed against the same base buffer and encoded
+        # OGG_ENCODE_WORKERS at a time to bound the number of mixed copies in memory
+        variant_rngs = list(enumerate(get_variant_rngs(stereo_name, variants), start=1))
+        for start in range(0, len(variant_rngs), OGG_ENCODE_WORKERS):
+            encode_jobs = []
+            for variant, variant_rng in variant_rngs[start:start + OGG_ENCODE_WORKERS]:
+                events = schedule_attention_probes(
+                    duration_samples=len(data),
+                    sr=COMMON_SAMPLE_RATE,
+                    probe_len=len(probe_scaled),
+                    rng=variant_rng
+                )
+                save_onsets(events, get_onsets_path(stereo_name, variant))
+                mixed_data = add_attention_probes(data=data, events=events, probe_audio=probe_scaled)
+                encode_jobs.append(((mixed_data, sr_f), get_variant_save_path(stereo_name, variant), OGG_BITRATE))
+                variant_rows.append({**get_combination_row(stereo_name, get_variant_save_path(stereo_name, variant)), 'variant': variant})
+            variants_path.mkdir(parents=True, exist_ok=True)
+            batch_encode_ogg(
+                jobs=encode_jobs,
+                max_workers=OGG_ENCODE_WORKERS,
+                sample_rate_target=COMMON_SAMPLE_RATE
+            )
+            del encode_jobs, mixed_data
+
+    return {'rows': rows, 'variant_rows': variant_rows, 'skipped': ()}
+
+def main(
+    jobs: int = 1,
+    force: bool = False,
+    variants: int = 1
+) -> None:
+    """
+    Generate the stimuli and the PsychoPy tables. Only outputs whose inputs or
+    relevant hyperparameters changed since the last run (according to the build
+    manifest) are rebuilt.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        Number of worker processes. With 1 (default) combinations are processed serially.
+    force : bool, optional
+        If True, rebuild every output regardless of the build manifest.
+    variants : int, optional
+        Number of independent probe schedules per stimulus. Variant 0 is the default
+        stimulus; the others are saved in `variants_path` with their onsets. Default is 1.
+    """
+    assert AUDIO_DIR.exists(), f"Audio directory {AUDIO_DIR} does not exist. Please load necessary audio files."
+    manifest = {'outputs': {}} if force else load_manifest(MANIFEST_PATH)
+    new_manifest = {'outputs': {}}
+
+    # Create a bip sound for events: bip of 500ms at 1000Hz followed by 500ms of silence
+    bip_outputs = {
+        OUTPUT_DIR / 'bip.ogg': {
+            'BIP_FREQ': BIP_FREQ, 'BIP_DUR': BIP_DUR, 'BIP_VOL': BIP_VOL,
+            'COMMON_SAMPLE_RATE': COMMON_SAMPLE_RATE, 'OGG_BITRATE': OGG_BITRATE
+        }
+    }
+    if not outputs_up_to_date(manifest, bip_outputs, inputs={}):
+        create_bip(
+            output_file=OUTPUT_DIR/'bip.wav',
+            bip_freq=BIP_FREQ,
+            bip_dur=BIP_DUR,
+            bip_vol=BIP_VOL,
+            sample_rate=COMMON_SAMPLE_RATE,
+            silence_sides_dur=BIP_DUR,
+            silence_type="after",
+            number_of_bips=0
+        )
         wav_to_ogg(
-            input_wav=short_save_path,
-            output_ogg=short_save_path.with_suffix('.ogg'),
+            input_wav=OUTPUT_DIR / 'bip.wav',
+            output_ogg=OUTPUT_DIR / 'bip.ogg',
             sample_rate_target=COMMON_SAMPLE_RATE,
             bitrate=OGG_BITRATE
         )
-    
-        # Save combinations
-        story_right = stereo_name.split('_')[1][1:]
-        story_left = stereo_name.split('_')[0][1:]
-        voice_right = stereo_name.split('_')[1][0]
-        voice_left = stereo_name.split('_')[0][0]
-        ordered = story_left < story_right
-        condition_label = f'O_{voice_left}_{voice_right}' if ordered else f'NO_{voice_left}_{voice_right}'
+        (OUTPUT_DIR / 'bip.wav').unlink()
+    record_outputs(new_manifest, bip_outputs, inputs={})
+
+    # Get combinations with consecutive order 1,2 ; 3,4 ; 5,6; etc
+    audio_paths = list(AUDIO_DIR.glob('*.mp3'))
+    combinations = get_combinations(audio_paths)
+
+    # Create attentional probe
+    attention_probe_path = OUTPUT_DIR / 'attention_probe.wav'
+    scrambled_probe_path = attention_probe_path.with_name(attention_probe_path.stem + '_scrambled.wav')
+    probe_profile_path = attention_probe_path.parents[1] / f'attention_probe_{PROBE_TYPE}_{int(PROBE_DURATION*1000)}_profile.png'
+    probe_params = {
+        'PROBE_TYPE': PROBE_TYPE, 'PROBE_DURATION': PROBE_DURATION,
+        'COMMON_SAMPLE_RATE': COMMON_SAMPLE_RATE, 'ATTACK_THRESHOLD': ATTACK_THRESHOLD,
+        'SCRAMBLED_PROBE': SCRAMBLED_PROBE, 'NUMBER_OF_SCRAMBLE_SEGMENTS': NUMBER_OF_SCRAMBLE_SEGMENTS
+    }
+    probe_outputs = {attention_probe_path: probe_params, probe_profile_path: probe_params}
+    if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
+        probe_outputs[scrambled_probe_path] = probe_params
+    if not outputs_up_to_date(manifest, probe_outputs, inputs={}):
+        create_attention_probe(
+            output_attention_probe_path=attention_probe_path,
+            duration_seconds=PROBE_DURATION,
+            stimulus_type=PROBE_TYPE,
+            sr=COMMON_SAMPLE_RATE
+        )
+        # Generate audio profile to verify attack characteristics (should be fast and clear)
+        attack_metrics = plot_audio_profile(
+            audio_path=attention_probe_path,
+            output_path=probe_profile_path,
+            attack_threshold=ATTACK_THRESHOLD,
+            plot_spectrum=True
+        )
+        if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
+            scramble_audio(
+                input_file=attention_probe_path,
+                output_file=scrambled_probe_path,
+                number_of_segments=NUMBER_OF_SCRAMBLE_SEGMENTS
+            )
+    record_outputs(new_manifest, probe_outputs, inputs={})
+    if isinstance(PROBE_TYPE, str) and SCRAMBLED_PROBE:
+        attention_probe_path = scrambled_probe_path
+
+    # Only rebuild combinations whose inputs or hyperparameters changed
+    probe_hash = hash_file(attention_probe_path)
+    pending, results = [], {}
+    for audio_f, audio_m in combinations:
+        stereo_names = get_stereo_names(audio_f, audio_m)
+        outputs = get_combination_outputs(stereo_names, variants)
+        inputs = {'female': hash_file(audio_f), 'male': hash_file(audio_m), 'probe': probe_hash}
+        if outputs_up_to_date(manifest, outputs, inputs):
+            record_outputs(new_manifest, outputs, inputs)
+            results[stereo_names] = {
+                'rows': [get_combination_row(name, get_probe_save_path(name)) for name in stereo_names],
+                'variant_rows': [
+                    {**get_combination_row(name, get_variant_save_path(name, variant)), 'variant': variant}
+                    for name in stereo_names for variant in range(1, variants)
+                ],
+                'skipped': ()
+            }
+        else:
+            pending.append((audio_f, audio_m, stereo_names, outputs, inputs))
+    print(f'{len(combinations) - len(pending)} combinations up to date, {len(pending)} to (re)build')
+
+    # Process each pending combination as an independent job
+    jobs_args = (
+        [audio_f for audio_f, *_ in pending],
+        [audio_m for _, audio_m, *_ in pending],
+        [attention_probe_path] * len(pending),
+        [variants] * len(pending)
+    )
+    try:
+        if jobs > 1 and len(pending) > 0:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Fill the decode cache first: every story appears in two combinations
+                pending_audios = sorted({path for audio_f, audio_m, *_ in pending for path in (audio_f, audio_m)})
+                list(executor.map(decode_audio, pending_audios))
+                for job, result in zip(pending, executor.map(process_combination, *jobs_args)):
+                    results[job[2]] = result
+                    if not result['skipped']:
+                        record_outputs(new_manifest, job[3], job[4])
+        else:
+            for job, result in zip(pending, map(process_combination, *jobs_args)):
+                results[job[2]] = result
+                if not result['skipped']:
+                    record_outputs(new_manifest, job[3], job[4])
+    finally:
+        # Keep the entries of finished jobs even if another job failed
+        for output_path, entry in manifest['outputs'].items():
+            if output_path not in new_manifest['outputs'] and Path(output_path).exists():
+                new_manifest['outputs'].setdefault(output_path, entry)
+        save_manifest(MANIFEST_PATH, new_manifest)
+
+    # Assemble results in combination order
+    ordered_results = [results[get_stereo_names(audio_f, audio_m)] for audio_f, audio_m in combinations]
+    audio_combinations_dict = [row for result in ordered_results for row in result['rows']]
+    variant_combinations_dict = [row for result in ordered_results for row in result['variant_rows']]
+    skipped_combinations = [result['skipped'] for result in ordered_results if result['skipped']]
         
-        audio_combinations_dict.append({
-            'filename':str(Path("..")/save_path.with_suffix('.ogg')),
-            'condition_label': condition_label,
-            'ordered': ordered,
-            'story_L': story_left,
-            'story_R': story_right,
-            'voice_L': voice_left,
-            'voice_R': voice_right,
-        })
-    
-# Print summary
-print(f'\n\nExpected number of combinations: {len(combinations) * 2}')
-print(f'Actual number of saved combinations: {len(audio_combinations_dict)}\n\n')
-
-# Create csv with filenames relative to psychopy experiment folder and it's labels
-csv_audio_combinations_no_probes_path = TABLES_DIR / 'audiobook_combinations_no_probes.csv'
-csv_audio_combinations_probes_path = TABLES_DIR / 'audiobook_combinations_probes.csv'
-csv_audio_combinations_short_path = TABLES_DIR / 'audiobook_combinations_short.csv'
-
-df_audio_combinations = pd.DataFrame(audio_combinations_dict)
-df_audio_combinations.to_csv(
-    csv_audio_combinations_probes_path, index=False
-)
-df_audio_combinations['filename'] = df_audio_combinations['filename'].apply(
-    lambda p: p.replace('with_probe','no_probe').replace('_tone_probe','').replace('_not_scrambled','').replace('_scrambled','').replace('.ogg','_no_probe.ogg')
-)
-df_audio_combinations.to_csv(
-    csv_audio_combinations_no_probes_path, index=False
-)
-df_audio_combinations['filename'] = df_audio_combinations['filename'].apply(
-    lambda p: str(Path("..") / probe_path_short /Path(p).name.replace('no_probe','short'))
-)
-df_audio_combinations.to_csv(
-    csv_audio_combinations_short_path, index=False
-)
-# Remove .wav files from processed folders to keep only ogg outputs
-for d in (probe_path, no_probe_path, probe_path_short):
-    if d.exists():
-        for wav_file in d.glob('*.wav'):
-            try:
-                wav_file.unlink()
-            except Exception:
-                pass
-# Delete intermediate files
-shutil.rmtree(INTERMEDIATE_AUDIO_DIR)
\ No newline at end of file
+    # Print summary
+    print(f'\n\nExpected number of combinations: {len(combinations) * 2}')
+    print(f'Actual number of saved combinations: {len(audio_combinations_dict)}\n\n')
+
+    # Create csv with filenames relative to psychopy experiment folder and it's labels
+    csv_audio_combinations_no_probes_path = TABLES_DIR / 'audiobook_combinations_no_probes.csv'
+    csv_audio_combinations_probes_path = TABLES_DIR / 'audiobook_combinations_probes.csv'
+    csv_audio_combinations_short_path = TABLES_DIR / 'audiobook_combinations_short.csv'
+
+    df_audio_combinations = pd.DataFrame(audio_combinations_dict)
+    df_audio_combinations.to_csv(
+        csv_audio_combinations_probes_path, index=False
+    )
+    df_audio_combinations['filename'] = df_audio_combinations['filename'].apply(
+        lambda p: p.replace('with_probe','no_probe').replace('_tone_probe','').replace('_not_scrambled','').replace('_scrambled','').replace('.ogg','_no_probe.ogg')
+    )
+    df_audio_combinations.to_csv(
+        csv_audio_combinations_no_probes_path, index=False
+    )
+    df_audio_combinations['filename'] = df_audio_combinations['filename'].apply(
+        lambda p: str(Path("..") / probe_path_short /Path(p).name.replace('no_probe','short'))
+    )
+    df_audio_combinations.to_csv(
+        csv_audio_combinations_short_path, index=False
+    )
+    if variants > 1:
+        pd.DataFrame(variant_combinations_dict).to_csv(
+            TABLES_DIR / 'audiobook_combinations_probe_variants.csv', index=False
+        )
+    # Remove .wav files from processed folders to keep only ogg outputs
+    for d in (probe_path, no_probe_path, probe_path_short):
+        if d.exists():
+            for wav_file in d.glob('*.wav'):
+                try:
+                    wav_file.unlink()
+                except Exception:
+                    pass
+    # Keep the decode cache below its size cap
+    evicted = prune_cache(DECODE_CACHE_DIR, max_bytes=int(DECODE_CACHE_MAX_GB * 2**30), pattern='*.wav')
+    if evicted:
+        print(f'Evicted {len(evicted)} files from the decode cache')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of combinations processed in parallel (worker processes). Default is 1.'
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Rebuild every output, ignoring the build manifest.'
+    )
+    parser.add_argument(
+        '--variants', type=int, default=1,
+        help='Number of independent probe schedules per stimulus (counterbalancing). Default is 1.'
+    )
+    args = parser.parse_args()
+    main(jobs=args.jobs, force=args.force, variants=args.variants)
@@ -2,13 +2,17 @@
 This module provides helper functions for audio processing tasks such as reading,
 saving, resampling, plotting audio profiles, and manipulating audio files.
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Union
 from gtts import gTTS
+import functools
 import numpy as np
 import subprocess
 import random
 import shutil
+import struct
+import os
 
 from pydub.generators import Sine
 from pydub import AudioSegment
@@ -18,12 +22,15 @@ import matplotlib.pyplot as plt
 import matplotlib
 import ffmpeg
 
+from utils.cache_helpers import hash_file, hash_params, touch_cache_entry
+
 matplotlib.use('Agg')  # Use non-interactive backend for server environments
 random.seed(42)
 
 def read_wav(
     file_path: Union[str, Path],
-    return_sample_rate: bool = False
+    return_sample_rate: bool = False,
+    mmap: bool = False
 ) -> Union[np.ndarray, tuple[int, np.ndarray]]:
     """
     Reads a WAV file and returns it as an array.
@@ -34,18 +41,101 @@ def read_wav(
             Path to the WAV file
         return_sample_rate: bool
             If True, returns a tuple (sample_rate, data)
+        mmap: bool
+            If True, returns a read-only memory map of the samples instead of loading
+            them, so files larger than the available RAM can be processed blockwise.
+            Formats that can't be mapped (e.g. 24-bit PCM) are loaded as usual.
     
     Returns
     -------
-        np.ndarray or tuple[int, np.ndarray]: Audio data as a numpy array,
-            or (sample_rate, data) if return_sample_rate is True
+        np.ndarray or tuple[int, np.ndarray]: Audio data as a numpy array (frames,) or
+            (frames, channels), or (sample_rate, data) if return_sample_rate is True
     """
-    sample_rate, data = wavfile.read(file_path)
+    header = read_wav_header(file_path)
+    if mmap and header['dtype'] is not None:
+        sample_rate = header['sample_rate']
+        data = np.memmap(
+            file_path,
+            dtype=header['dtype'],
+            mode='r',
+            offset=header['data_offset'],
+            shape=_wav_shape(header['n_frames'], header['n_channels'])
+        )
+    else:
+        sample_rate, data = wavfile.read(file_path)
     if return_sample_rate:
         return sample_rate, data
     else:
         return data
 
+def read_wav_header(
+    file_path: Union[str, Path]
+) -> dict:
+    """
+    Reads the format of a WAV file from its RIFF chunks without touching the sample data.
+    Runs in constant time regardless of the file length.
+
+    Parameters
+    ----------
+        file_path: Union[str, Path]
+            Path to the WAV file
+
+    Returns
+    -------
+        dict: Dictionary with:
+            - sample_rate: sample rate in Hz
+            - n_channels: number of channels
+            - n_frames: number of frames
+            - bits_per_sample: sample width in bits
+            - dtype: numpy dtype of the samples, None if they can't be mapped (e.g. 24-bit PCM)
+            - data_offset: byte offset of the sample data in the file
+    """
+    with open(file_path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError(f"{file_path} is not a WAV file.")
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"{file_path} has no data chunk.")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            else:
+                # Chunks are word aligned
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    if fmt is None:
+        raise ValueError(f"{file_path} has no fmt chunk before its data chunk.")
+
+    format_tag, n_channels, sample_rate, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE, the actual format is the start of the sub-format GUID
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    dtypes = {
+        (1, 8): np.dtype('u1'),
+        (1, 16): np.dtype('<i2'),
+        (1, 32): np.dtype('<i4'),
+        (1, 64): np.dtype('<i8'),
+        (3, 32): np.dtype('<f4'),
+        (3, 64): np.dtype('<f8')
+    }
+    # The data chunk size may be wrong (e.g. streamed writers), so it's bounded by the file size
+    file_size = os.path.getsize(file_path)
+    data_size = min(chunk_size, file_size - data_offset)
+    return {
+        'sample_rate': sample_rate,
+        'n_channels': n_channels,
+        'n_frames': data_size // block_align,
+        'bits_per_sample': bits_per_sample,
+        'dtype': dtypes.get((format_tag, bits_per_sample)),
+        'data_offset': data_offset
+    }
+
 def read_ogg(
     file_path: Union[str, Path],
     return_sample_rate: bool = False
@@ -108,7 +198,7 @@ def plot_audio_profile(
             - peak_amplitude: Normalized peak amplitude
             - is_fast_attack: True if attack_time < 20ms (quick onset)
     """
-    sample_rate, data = wavfile.read(audio_path)
+    sample_rate, data = read_wav(audio_path, return_sample_rate=True, mmap=True)
     
     # Normalize data
     data = data.astype(np.float32)
@@ -269,6 +359,99 @@ def save_wav(
         None
     """
     wavfile.write(file_path, sample_rate, data)
+
+def create_wav_memmap(
+    file_path: Union[str, Path],
+    sample_rate: int,
+    n_frames: int,
+    n_channels: int = 1,
+    dtype: np.dtype = np.float32
+) -> np.memmap:
+    """
+    Preallocates a WAV file and returns a writable memory map of its samples, so outputs
+    can be filled blockwise without holding them in memory. Call `flush()` (or delete
+    the map) when done.
+
+    Parameters
+    ----------
+        file_path: Union[str, Path]
+            Path to save the WAV file
+        sample_rate: int
+            Sample rate of the audio
+        n_frames: int
+            Number of frames of the audio
+        n_channels: int
+            Number of channels. Mono files are mapped as (frames,), others as (frames, channels)
+        dtype: np.dtype
+            Sample type: integer types are written as PCM, float types as IEEE float
+
+    Returns
+    -------
+        np.memmap: Zero-initialised samples of the file
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    header = _wav_header(sample_rate, n_frames, n_channels, dtype)
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + n_frames * n_channels * dtype.itemsize)
+    if n_frames == 0:
+        # Empty files can't be mapped
+        return np.zeros(_wav_shape(0, n_channels), dtype=dtype)
+    return np.memmap(
+        file_path,
+        dtype=dtype,
+        mode='r+',
+        offset=len(header),
+        shape=_wav_shape(n_frames, n_channels)
+    )
+
+def _wav_header(
+    sample_rate: int,
+    n_frames: int,
+    n_channels: int,
+    dtype: np.dtype
+) -> bytes:
+    """RIFF/WAVE header of a PCM (integer dtypes) or IEEE float (float dtypes) file."""
+    dtype = np.dtype(dtype)
+    is_float = np.issubdtype(dtype, np.floating)
+    block_align = n_channels * dtype.itemsize
+    data_size = n_frames * block_align
+    fmt_chunk = struct.pack(
+        '<HHIIHH',
+        3 if is_float else 1, # WAVE_FORMAT_IEEE_FLOAT or WAVE_FORMAT_PCM
+        n_channels,
+        int(sample_rate),
+        int(sample_rate) * block_align,
+        block_align,
+        dtype.itemsize * 8
+    )
+    extra_chunks = b''
+    if is_float:
+        # Non-PCM formats carry a cbSize field and a 'fact' chunk with the number of frames
+        fmt_chunk += struct.pack('<H', 0)
+        extra_chunks = b'fact' + struct.pack('<II', 4, n_frames)
+    riff_size = 4 + 8 + len(fmt_chunk) + len(extra_chunks) + 8 + data_size
+    if riff_size > 2**32 - 1:
+        raise ValueError("Audio data is too large for the WAV format (4 GiB limit).")
+    return (
+        b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<I', len(fmt_chunk)) + fmt_chunk
+        + extra_chunks
+        + b'data' + struct.pack('<I', data_size)
+    )
+
+def _wav_shape(
+    n_frames: int,
+    n_channels: int
+) -> tuple:
+    """Array shape of WAV samples, as returned by `scipy.io.wavfile.read`."""
+    return (n_frames,) if n_channels == 1 else (n_frames, n_channels)
+
+def _n_channels(
+    data: np.ndarray
+) -> int:
+    """Number of channels of audio data (frames,) or (frames, channels)."""
+    return 1 if data.ndim == 1 else data.shape[1]
     
 def get_sample_rate(
     file_path: Union[str, Path]
@@ -285,7 +468,7 @@ def get_sample_rate(
         int: Sample rate of the WAV file
         
     """
-    return wavfile.read(file_path)[0]
+    return read_wav_header(file_path)['sample_rate']
 
 def resample_audio(
     input_file: Union[str, Path], 
@@ -374,10 +557,72 @@ def convert_to_wav(
         .run(quiet=not verbose, capture_stdout=not verbose, capture_stderr=not verbose)
     )
 
+def cached_convert_to_wav(
+    input_file: Union[str, Path],
+    cache_dir: Union[str, Path],
+    stereo: bool = False,
+    sample_rate_target: int = 44100,
+    verbose: bool = False
+) -> Path:
+    """
+    Converts an audio file to WAV format through a persistent, content-addressed cache.
+    Entries are keyed by the hash of the source file plus the target sample rate and
+    channel layout, so a source is only decoded again if its content or the target format changes.
+    Use `utils.cache_helpers.prune_cache` to cap the cache size (LRU eviction).
+
+    Parameters
+    ----------
+    input_file : Union[str, Path]
+        Path to the input audio file.
+    cache_dir : Union[str, Path]
+        Directory holding the decoded WAV files.
+    stereo : bool, optional
+        If True, converts audio to stereo. Defaults to False (mono).
+    sample_rate_target : int, optional
+        Target sample rate in Hz. Default is 44100.
+    verbose : bool, optional
+        If True, prints cache hits and misses.
+
+    Returns
+    -------
+    Path
+        Path to the cached WAV file.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hash_params({
+        'source': hash_file(input_file),
+        'sample_rate': int(sample_rate_target),
+        'channels': 2 if stereo else 1,
+        'codec': 'pcm_s16le'
+    })
+    cached_file = cache_dir / f'{Path(input_file).stem}-{key[:16]}.wav'
+    if cached_file.exists():
+        if verbose:
+            print(f'Decode cache hit for {input_file}')
+        touch_cache_entry(cached_file)
+        return cached_file
+
+    if verbose:
+        print(f'Decode cache miss for {input_file}, decoding...')
+    # Decode to a temporary name and rename atomically, so concurrent jobs never see partial files
+    temp_file = cached_file.with_name(f'{cached_file.stem}.{os.getpid()}.tmp.wav')
+    convert_to_wav(
+        input_file=input_file,
+        output_file=temp_file,
+        stereo=stereo,
+        exists_ok=True,
+        sample_rate_target=sample_rate_target,
+        verbose=verbose
+    )
+    os.replace(temp_file, cached_file)
+    return cached_file
+
 def scale_audio(
     input_file: Union[str, Path],
     output_file: Union[str, Path],
-    delta_frames: int
+    delta_frames: int,
+    method: str = 'polyphase'
 ) -> None:
     """
     Scales (time-stretches) an audio file by a given delta in seconds.
@@ -390,37 +635,243 @@ def scale_audio(
         Path to save the scaled audio file.
     delta_frames : int
         Number of milliseconds to stretch (positive) or compress (negative) the audio.
+    method : str, optional
+        Time-stretch method, see `time_stretch`. Default is 'polyphase'.
     
     Returns
     -------
         None
     """
-    sample_rate, data = wavfile.read(input_file)
-    original_frames = data.shape[0]
-    original_dtype = data.dtype
-    data = data.mean(axis=1)  if data.ndim != 1 else data
-    target_frames = original_frames + delta_frames
-    
     if delta_frames == 0:
         if input_file != output_file:
             shutil.copyfile(input_file, output_file)
         return
+    sample_rate, data = read_wav(input_file, return_sample_rate=True, mmap=True)
+    original_dtype = data.dtype
+    n_channels = _n_channels(data)
+    target_frames = data.shape[0] + delta_frames
+    # Outputs are written next to output_file and renamed at the end, so input_file may be output_file
+    output_file = Path(output_file)
+    temp_file = output_file.with_name(f'{output_file.stem}.{os.getpid()}.tmp.wav')
+    if original_dtype == np.float32:
+        # Stretch straight into the output file
+        out = create_wav_memmap(temp_file, sample_rate, target_frames, n_channels, np.float32)
+        time_stretch(data, target_frames, method=method, out=out)
     else:
-        data_float = data.astype(np.float32)
-        original_idx = np.arange(original_frames, dtype=np.float32)
-        target_idx = np.linspace(0, original_frames - 1, target_frames, dtype=np.float32)
-        
-        
-        scaled = np.interp(target_idx, original_idx, data_float)
-        
-        if np.issubdtype(original_dtype, np.integer):
-            dtype_info = np.iinfo(original_dtype)
-            scaled = np.clip(
-                np.round(scaled), dtype_info.min, dtype_info.max
-            ).astype(original_dtype)
+        # Stretch into a float32 scratch file, then convert to the original type blockwise
+        scratch_file = output_file.with_name(f'{output_file.stem}.{os.getpid()}.f32.tmp.wav')
+        scaled = create_wav_memmap(scratch_file, sample_rate, target_frames, n_channels, np.float32)
+        time_stretch(data, target_frames, method=method, out=scaled)
+        out = create_wav_memmap(temp_file, sample_rate, target_frames, n_channels, original_dtype)
+        block, block_frames = None, 2**16
+        for start in range(0, target_frames, block_frames):
+            block = scaled[start:start + block_frames]
+            if np.issubdtype(original_dtype, np.integer):
+                dtype_info = np.iinfo(original_dtype)
+                block = np.clip(np.round(block), dtype_info.min, dtype_info.max)
+            out[start:start + block_frames] = block
+        del scaled, block
+        os.remove(scratch_file)
+    out.flush()
+    del out, data # release the memory maps before replacing the file
+    os.replace(temp_file, output_file)
+
+def stretch_audio_array(
+    data: np.ndarray,
+    delta_frames: int,
+    method: str = 'polyphase'
+) -> np.ndarray:
+    """
+    Scales (time-stretches) an audio buffer by a given number of frames.
+    In-memory counterpart of `scale_audio`.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Audio data (frames,) or (frames, channels). The channel count is preserved.
+    delta_frames : int
+        Number of frames to stretch (positive) or compress (negative) the audio.
+    method : str, optional
+        Time-stretch method, see `time_stretch`. Default is 'polyphase'.
+
+    Returns
+    -------
+    np.ndarray
+        The scaled float32 audio data, in the same units as the input.
+    """
+    if delta_frames == 0:
+        return data.astype(np.float32)
+    return time_stretch(
+        data=data,
+        target_frames=data.shape[0] + delta_frames,
+        method=method
+    )
+
+def time_stretch(
+    data: np.ndarray,
+    target_frames: int,
+    method: str = 'polyphase',
+    chunk_frames: int = 2**16,
+    out: Union[np.ndarray, None] = None
+) -> np.ndarray:
+    """
+    Time-stretch engine. Stretches or compresses audio to an exact number of frames,
+    processing the output in chunks so peak memory is bounded by the chunk size
+    (plus the output buffer) regardless of the file length. Works on memory-mapped inputs.
+
+    Available methods:
+    - 'interp': linear interpolation (legacy behaviour of `scale_audio`). Changes pitch
+        along with time and attenuates high frequencies.
+    - 'polyphase': band-limited (Kaiser-windowed sinc) polyphase resampling. Changes pitch
+        along with time, like 'interp', but without interpolation artifacts.
+    - 'wsola': Waveform Similarity Overlap-Add. Preserves pitch; frames are aligned on the
+        channel average so every channel stays in sync.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Audio data (frames,) or (frames, channels).
+    target_frames : int
+        Number of frames of the output.
+    method : str, optional
+        One of 'interp', 'polyphase' or 'wsola'. Default is 'polyphase'.
+    chunk_frames : int, optional
+        Number of output frames processed at a time ('interp' and 'polyphase').
+    out : Union[np.ndarray, None], optional
+        Preallocated float32 output of shape (target_frames,) + data.shape[1:]
+        (e.g. a memory map). If None, a new array is allocated.
+
+    Returns
+    -------
+    np.ndarray
+        The stretched float32 audio data, with the same channel layout as the input.
+    """
+    methods = {
+        'interp': _stretch_interp,
+        'polyphase': _stretch_polyphase,
+        'wsola': _stretch_wsola
+    }
+    if method not in methods:
+        raise ValueError(f"method must be one of {list(methods)}, got '{method}'.")
+    target_frames = int(target_frames)
+    if out is None:
+        out = np.zeros((target_frames,) + data.shape[1:], dtype=np.float32)
+    assert out.shape == (target_frames,) + data.shape[1:], "out has a wrong shape"
+
+    # Work on a (frames, channels) view
+    data_2d = data.reshape(data.shape[0], -1)
+    out_2d = out.reshape(target_frames, -1)
+    methods[method](data_2d, out_2d, chunk_frames)
+    return out
+
+def _stretch_interp(
+    data: np.ndarray,
+    out: np.ndarray,
+    chunk_frames: int
+) -> None:
+    """Chunked linear interpolation, sample positions aligned on both ends (as np.linspace)."""
+    original_frames, target_frames = data.shape[0], out.shape[0]
+    ratio = (original_frames - 1) / max(target_frames - 1, 1)
+    for start in range(0, target_frames, chunk_frames):
+        positions = np.arange(start, min(start + chunk_frames, target_frames)) * ratio
+        first = int(np.floor(positions[0]))
+        last = min(int(np.ceil(positions[-1])) + 1, original_frames)
+        segment = np.asarray(data[first:last], dtype=np.float32)
+        segment_idx = np.arange(first, last)
+        for channel in range(data.shape[1]):
+            out[start:start + len(positions), channel] = np.interp(positions, segment_idx, segment[:, channel])
+
+def _stretch_polyphase(
+    data: np.ndarray,
+    out: np.ndarray,
+    chunk_frames: int,
+    half_taps: int = 16,
+    phases: int = 512,
+    beta: float = 8.6
+) -> None:
+    """
+    Chunked band-limited resampling with a table of `phases` Kaiser-windowed sinc sub-filters
+    of 2*half_taps taps each. Each output frame is the dot product of the sub-filter closest to
+    its fractional input position with the neighbouring input frames (edges are clamped).
+    """
+    original_frames, target_frames = data.shape[0], out.shape[0]
+    ratio = (original_frames - 1) / max(target_frames - 1, 1)
+    # Lower the cutoff when compressing, to avoid aliasing
+    cutoff = min(1.0, 1.0 / ratio) if ratio > 0 else 1.0
+
+    # Sub-filter table: row p holds the weights for a fractional position p/phases
+    offsets = np.arange(-half_taps + 1, half_taps + 1)
+    distances = np.arange(phases + 1)[:, None] / phases - offsets[None, :]
+    window = np.kaiser(2 * half_taps + 1, beta)
+    window_values = np.interp(distances, np.arange(-half_taps, half_taps + 1), window, left=0, right=0)
+    table = cutoff * np.sinc(cutoff * distances) * window_values
+    table /= table.sum(axis=1, keepdims=True) # unit DC gain
+    table = table.astype(np.float32)
+
+    for start in range(0, target_frames, chunk_frames):
+        positions = np.arange(start, min(start + chunk_frames, target_frames)) * ratio
+        base = np.floor(positions).astype(np.int64)
+        phase = np.rint((positions - base) * phases).astype(np.int64)
+
+        # Read only the input frames needed by this chunk
+        first = base[0] - half_taps + 1
+        last = base[-1] + half_taps + 1
+        segment_idx = np.clip(np.arange(first, last), 0, original_frames - 1)
+        segment = np.asarray(data[segment_idx[0]:segment_idx[-1] + 1], dtype=np.float32)
+        segment = segment[segment_idx - segment_idx[0]]
+
+        taps_idx = (base - first)[:, None] + offsets[None, :]
+        weights = table[phase]
+        segment = np.ascontiguousarray(segment.T)
+        for channel in range(data.shape[1]):
+            out[start:start + len(positions), channel] = np.sum(weights * segment[channel][taps_idx], axis=1)
+
+def _stretch_wsola(
+    data: np.ndarray,
+    out: np.ndarray,
+    chunk_frames: int,
+    frame_length: int = 2048,
+    tolerance: int = 512
+) -> None:
+    """
+    WSOLA with a periodic Hann window at 50% overlap (the windows sum to one, so no
+    normalization buffer is needed). Each analysis frame is shifted by up to `tolerance`
+    frames to best match the natural continuation of the previous one. `chunk_frames` is unused:
+    the output is produced frame by frame.
+    """
+    original_frames, target_frames = data.shape[0], out.shape[0]
+    hop = frame_length // 2
+    speed = original_frames / target_frames
+    window = signal.get_window('hann', frame_length, fftbins=True).astype(np.float32)[:, None]
+    out[:] = 0
+
+    def read(start, length):
+        # Zero-padded read of data[start:start+length]
+        segment = np.zeros((length, data.shape[1]), dtype=np.float32)
+        first, last = max(start, 0), min(start + length, original_frames)
+        if last > first:
+            segment[first - start:last - start] = data[first:last]
+        return segment
+
+    previous_start = None
+    frame_start = -hop
+    while frame_start < target_frames:
+        nominal = int(round(frame_start * speed))
+        if previous_start is None:
+            shift = 0
         else:
-            scaled = scaled.astype(original_dtype)
-        wavfile.write(output_file, sample_rate, scaled)
+            # Natural continuation of the previous frame vs. candidates around the nominal position
+            template = read(previous_start + hop, frame_length).mean(axis=1)
+            candidates = read(nominal - tolerance, frame_length + 2 * tolerance).mean(axis=1)
+            similarity = signal.correlate(candidates, template, mode='valid', method='fft')
+            shift = int(np.argmax(similarity)) - tolerance
+        analysis_start = nominal + shift
+        frame = read(analysis_start, frame_length) * window
+
+        first, last = max(frame_start, 0), min(frame_start + frame_length, target_frames)
+        out[first:last] += frame[first - frame_start:last - frame_start]
+        previous_start = analysis_start
+        frame_start += hop
 
 def calculate_energy(
     audio_data: np.ndarray
@@ -440,15 +891,176 @@ def calculate_energy(
     """
     return np.sum(audio_data.astype(np.float32) ** 2) / len(audio_data)
 
+def measure_audio_level(
+    audio_data: np.ndarray,
+    sample_rate: Union[int, None] = None,
+    method: str = 'energy',
+    block_frames: int = 2**16,
+    full_scale: Union[float, None] = None
+) -> dict:
+    """
+    Streaming level measurement: reads the signal in fixed-size blocks (so it works
+    on memory-mapped WAVs) and accumulates energy and peak in float64.
+
+    Available methods:
+    - 'energy': mean energy per frame, as `calculate_energy` (silence lowers it).
+    - 'gated_rms': ITU-R BS.1770 style gating on 400 ms blocks (75% overlap): blocks
+        below -70 dBFS and then blocks 10 dB below the mean of the remaining ones are
+        ignored, so silent passages don't skew the level.
+    - 'lufs': as 'gated_rms' but on K-weighted audio (integrated loudness, BS.1770).
+    Gated methods fall back to 'energy' for signals shorter than one 400 ms block.
+
+    Parameters
+    ----------
+    audio_data : np.ndarray
+        Audio data (frames,) or (frames, channels). May be a memory map.
+    sample_rate : Union[int, None], optional
+        Sample rate in Hz. Required by the gated methods.
+    method : str, optional
+        One of 'energy', 'gated_rms' or 'lufs'. Default is 'energy'.
+    block_frames : int, optional
+        Number of frames read at a time.
+    full_scale : Union[float, None], optional
+        Amplitude of a full-scale signal; energy and peak are reported relative to it.
+        If None, it is inferred from the dtype (e.g. 32768 for int16, 1.0 for floats).
+
+    Returns
+    -------
+    dict
+        Dictionary with:
+            - energy: mean energy per frame relative to full scale (gated/K-weighted for the gated methods)
+            - peak: maximum absolute amplitude relative to full scale
+            - level_db: energy in dB full scale (LUFS for 'lufs')
+    """
+    if method not in ('energy', 'gated_rms', 'lufs'):
+        raise ValueError(f"method must be 'energy', 'gated_rms' or 'lufs', got '{method}'.")
+    if method != 'energy' and sample_rate is None:
+        raise ValueError(f"sample_rate is required for method '{method}'.")
+    if full_scale is None:
+        full_scale = _full_scale(audio_data.dtype)
+
+    data_2d = audio_data.reshape(audio_data.shape[0], -1)
+    n_frames = data_2d.shape[0]
+    total_energy, peak = 0.0, 0.0
+    gated = method != 'energy'
+    if gated:
+        # 100 ms sub-blocks, read blocks are a whole number of sub-blocks
+        sub_frames = int(round(0.1 * sample_rate))
+        block_frames = max(1, block_frames // sub_frames) * sub_frames
+        sub_energies = []
+        if method == 'lufs':
+            sos = _k_weighting_sos(sample_rate)
+            zi = np.zeros((sos.shape[0], 2, data_2d.shape[1]))
+
+    for start in range(0, n_frames, block_frames):
+        block = np.asarray(data_2d[start:start + block_frames], dtype=np.float64)
+        total_energy += np.sum(block ** 2)
+        peak = max(peak, float(np.max(np.abs(block))))
+        if gated:
+            if method == 'lufs':
+                block, zi = signal.sosfilt(sos, block, axis=0, zi=zi)
+            n_sub = block.shape[0] // sub_frames
+            squares = block[:n_sub * sub_frames] ** 2
+            # Sum of the channels' mean squares of each sub-block
+            sub_energies.append(squares.reshape(n_sub, sub_frames, -1).mean(axis=1).sum(axis=1))
+
+    energy = total_energy / n_frames / full_scale**2
+    offset_db = -0.691 if method == 'lufs' else 0.0
+    if gated:
+        sub_energies = np.concatenate(sub_energies) / full_scale**2
+        if len(sub_energies) >= 4:
+            # 400 ms gating blocks with 75% overlap
+            block_energies = np.convolve(sub_energies, np.ones(4) / 4, mode='valid')
+            block_levels = offset_db + 10 * np.log10(np.maximum(block_energies, 1e-30))
+            kept = block_energies[block_levels > -70]
+            if len(kept) > 0:
+                relative_gate = offset_db + 10 * np.log10(kept.mean()) - 10
+                kept = block_energies[(block_levels > -70) & (block_levels > relative_gate)]
+            if len(kept) > 0:
+                energy = float(kept.mean())
+    level_db = offset_db + 10 * np.log10(max(energy, 1e-30))
+    return {'energy': float(energy), 'peak': peak / full_scale, 'level_db': float(level_db)}
+
+def _full_scale(
+    dtype: np.dtype
+) -> float:
+    """Amplitude of a full-scale signal of the given dtype (e.g. 32768 for int16, 1.0 for floats)."""
+    if np.issubdtype(dtype, np.integer):
+        return float(-np.iinfo(dtype).min)
+    return 1.0
+
+def _k_weighting_sos(
+    sample_rate: int
+) -> np.ndarray:
+    """K-weighting filter (BS.1770 high shelf + high pass) as second-order sections for sample_rate."""
+    # Pre-filter (high shelf modelling the head), BS.1770 coefficients derived for any rate
+    gain_db, q, fc = 3.999843853973347, 0.7071752369554196, 1681.974450955533
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    k = np.tan(np.pi * fc / sample_rate)
+    a0 = 1 + k / q + k**2
+    shelf = [
+        (vh + vb * k / q + k**2) / a0, 2 * (k**2 - vh) / a0, (vh - vb * k / q + k**2) / a0,
+        1.0, 2 * (k**2 - 1) / a0, (1 - k / q + k**2) / a0
+    ]
+    # RLB weighting (high pass)
+    q, fc = 0.5003270373238773, 38.13547087602444
+    k = np.tan(np.pi * fc / sample_rate)
+    a0 = 1 + k / q + k**2
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k**2 - 1) / a0, (1 - k / q + k**2) / a0]
+    return np.array([shelf, highpass])
+
+def _relative_db_gains(
+    level_to_scale: dict,
+    reference_level: dict,
+    target_db_diff: float,
+    ceiling: float = .99
+) -> tuple[float, float]:
+    """
+    Gains that put level_to_scale target_db_diff dB relative to reference_level, both
+    scaled down if needed so that neither peak exceeds ceiling.
+    """
+    current_energy = level_to_scale['energy']
+    reference_energy = reference_level['energy']
+
+    # Validations to avoid division by zero
+    if current_energy == 0 or reference_energy == 0:
+        print("Warning: one of the audio signals has zero energy. Returning original audio.")
+        return 1.0, 1.0
+
+    # If target_db = 10 * log10(E_target / E_reference), then E_target / E_reference = 10^(target_db / 10)
+    # If target_db_diff = 0, then E_target = E_reference
+
+    # Calculate the target energy
+    required_ratio = 10 ** (target_db_diff / 10) 
+    target_energy = reference_energy * required_ratio
+    
+    # Calculate the scaling factor for Amplitude
+    # Since Energy ~ Amplitude^2, the factor is sqrt(E_target / E_current)
+    scaling_factor = np.sqrt(target_energy / current_energy)
+    
+    peak_tgt = level_to_scale['peak'] * scaling_factor
+    peak_ref = reference_level['peak']
+    global_peak = max(peak_tgt, peak_ref)
+    if global_peak > ceiling:
+        correction_factor = ceiling / global_peak
+        return float(scaling_factor * correction_factor), float(correction_factor)
+    return float(scaling_factor), 1.0
+
 def scale_audio_to_relative_db(
     audio_to_scale_path: Union[str, Path],
     reference_audio_path: Union[str, Path],
-    target_db_diff: float
+    target_db_diff: float,
+    method: str = 'energy',
+    block_frames: int = 2**16
 ) -> None:
     """
     Scale an audio signal so that its energy is a specified dB difference
     relative to a reference audio signal. Also includes protection against
     saturation (both audios scaled down if needed).
+    Streaming two-pass implementation: the first pass measures energy and peak
+    blockwise on memory-mapped files, the second applies the gains blockwise, so
+    no full-length copy of either file is held in memory. Both files are rewritten as float32.
     
     Parameters
     ----------
@@ -456,56 +1068,93 @@ def scale_audio_to_relative_db(
         The audio signal to be scaled.
     reference_audio : Union[str, Path]
         The reference audio signal.
-    output_path : Union[str, Path]
-        Path to save the scaled audio file.
     target_db_diff : float
         The desired difference in dB. 
         E.g., 20.0 will make the resulting audio 20dB louder than the reference.
         E.g., -6.0 will make the resulting audio 6dB quieter than the reference.
+    method : str, optional
+        Level measurement, see `measure_audio_level`. Default is 'energy'.
+    block_frames : int, optional
+        Number of frames processed at a time.
             
     Returns
     -------
         None
     """
-    CEILING = .99
+    # First pass: calculate current energies and peaks
+    sample_rate, audio_to_scale = read_wav(audio_to_scale_path, return_sample_rate=True, mmap=True)
+    sample_rate_ref, reference_audio = read_wav(reference_audio_path, return_sample_rate=True, mmap=True)
+    gain_tgt, gain_ref = _relative_db_gains(
+        level_to_scale=measure_audio_level(audio_to_scale, sample_rate, method, block_frames),
+        reference_level=measure_audio_level(reference_audio, sample_rate_ref, method, block_frames),
+        target_db_diff=target_db_diff
+    )
 
-    # Calculate current energies
-    sample_rate, audio_to_scale = read_wav(audio_to_scale_path, return_sample_rate=True)
-    sample_rate_ref, reference_audio = read_wav(reference_audio_path, return_sample_rate=True)
-    audio_to_scale = audio_to_scale.astype(np.float32)
-    reference_audio = reference_audio.astype(np.float32)
-    current_energy = calculate_energy(audio_to_scale)
-    reference_energy = calculate_energy(reference_audio)
-    
-    # Validations to avoid division by zero
-    if current_energy == 0 or reference_energy == 0:
-        print("Warning: one of the audio signals has zero energy. Returning original audio.")
+    # Second pass: write the scaled files next to the originals, then replace them
+    temp_tgt = _write_scaled_wav(audio_to_scale_path, sample_rate, audio_to_scale, gain_tgt, block_frames)
+    temp_ref = _write_scaled_wav(reference_audio_path, sample_rate_ref, reference_audio, gain_ref, block_frames)
+    del audio_to_scale, reference_audio # release the memory maps before replacing the files
+    os.replace(temp_tgt, audio_to_scale_path)
+    os.replace(temp_ref, reference_audio_path)
 
-    # If target_db = 10 * log10(E_target / E_reference), then E_target / E_reference = 10^(target_db / 10)
-    # If target_db_diff = 0, then E_target = E_reference
+def match_audio_level_arrays(
+    audio_to_scale: np.ndarray,
+    reference_audio: np.ndarray,
+    target_db_diff: float,
+    method: str = 'energy',
+    sample_rate: Union[int, None] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Scale an audio buffer so that its energy is a specified dB difference
+    relative to a reference buffer, with saturation protection (both buffers
+    scaled down if needed). In-memory counterpart of `scale_audio_to_relative_db`.
 
-    # Calculate the target energy
-    required_ratio = 10 ** (target_db_diff / 10) 
-    target_energy = reference_energy * required_ratio
-    
-    # Calculate the scaling factor for Amplitude
-    # Since Energy ~ Amplitude^2, the factor is sqrt(E_target / E_current)
-    scaling_factor = np.sqrt(target_energy / current_energy)
-    candidate_tgt = audio_to_scale * scaling_factor
-    candidate_ref = reference_audio.copy()
-    
-    peak_tgt = np.max(np.abs(candidate_tgt))
-    peak_ref = np.max(np.abs(candidate_ref))
-    global_peak = max(peak_tgt, peak_ref)
-    if global_peak > CEILING:
-        correction_factor = CEILING / global_peak
-        final_tgt = candidate_tgt * correction_factor
-        final_ref = candidate_ref * correction_factor
-    else:
-        final_tgt = candidate_tgt
-        final_ref = candidate_ref
-    save_wav(file_path=audio_to_scale_path, sample_rate=sample_rate, data=final_tgt)
-    save_wav(file_path=reference_audio_path, sample_rate=sample_rate_ref, data=final_ref)
+    Parameters
+    ----------
+    audio_to_scale : np.ndarray
+        The audio signal to be scaled.
+    reference_audio : np.ndarray
+        The reference audio signal.
+    target_db_diff : float
+        The desired difference in dB. 
+        E.g., 20.0 will make the resulting audio 20dB louder than the reference.
+        E.g., -6.0 will make the resulting audio 6dB quieter than the reference.
+    method : str, optional
+        Level measurement, see `measure_audio_level`. Default is 'energy'.
+    sample_rate : Union[int, None], optional
+        Sample rate of both buffers in Hz. Required by the gated methods.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The scaled audio and the (possibly attenuated) reference, both float32.
+    """
+    gain_tgt, gain_ref = _relative_db_gains(
+        level_to_scale=measure_audio_level(audio_to_scale, sample_rate, method),
+        reference_level=measure_audio_level(reference_audio, sample_rate, method),
+        target_db_diff=target_db_diff
+    )
+    final_tgt = np.multiply(audio_to_scale, np.float32(gain_tgt), dtype=np.float32)
+    final_ref = np.multiply(reference_audio, np.float32(gain_ref), dtype=np.float32)
+    return final_tgt, final_ref
+
+def _write_scaled_wav(
+    file_path: Union[str, Path],
+    sample_rate: int,
+    data: np.ndarray,
+    gain: float,
+    block_frames: int
+) -> Path:
+    """Write gain * data (integer data is brought to [-1, 1]) as a float32 WAV blockwise, next to file_path. Returns the temporary path."""
+    file_path = Path(file_path)
+    temp_path = file_path.with_name(f'{file_path.stem}.{os.getpid()}.tmp.wav')
+    gain = np.float32(gain / _full_scale(data.dtype))
+    out = create_wav_memmap(temp_path, sample_rate, data.shape[0], _n_channels(data), np.float32)
+    for start in range(0, data.shape[0], block_frames):
+        np.multiply(data[start:start + block_frames], gain, out=out[start:start + block_frames], dtype=np.float32)
+    out.flush()
+    del out
+    return temp_path
 
 def create_bip(
     output_file: Union[str, Path],
@@ -635,6 +1284,26 @@ def combine_audio_stereo(
     -------
         None
     """
+    if Path(audio_left).suffix.lower() == Path(audio_right).suffix.lower() == '.wav':
+        header_left, header_right = read_wav_header(audio_left), read_wav_header(audio_right)
+        same_format = all(
+            header_left[key] == header_right[key] for key in ('sample_rate', 'dtype', 'n_channels')
+        )
+        if same_format and header_left['n_channels'] == 1 and header_left['dtype'] is not None:
+            # Interleave the memory-mapped channels straight into the output file
+            left = read_wav(audio_left, mmap=True)
+            right = read_wav(audio_right, mmap=True)
+            stereo_audio = create_wav_memmap(
+                output_file, header_left['sample_rate'], max(len(left), len(right)), 2, left.dtype
+            )
+            block_frames = 2**16
+            for channel, data in enumerate([left, right]):
+                for start in range(0, len(data), block_frames):
+                    end = min(start + block_frames, len(data))
+                    stereo_audio[start:end, channel] = data[start:end]
+            stereo_audio.flush()
+            return
+
     left = AudioSegment.from_file(audio_left).set_channels(1)
     right = AudioSegment.from_file(audio_right).set_channels(1)
         
@@ -644,6 +1313,31 @@ def combine_audio_stereo(
     )
     stereo_audio.export(output_file, format='wav')
 
+def combine_stereo_arrays(
+    left: np.ndarray,
+    right: np.ndarray
+) -> np.ndarray:
+    """
+    Combines two mono audio buffers into a single stereo buffer.
+    In-memory counterpart of `combine_audio_stereo`; the shorter channel is padded with silence.
+
+    Parameters
+    ----------
+    left : np.ndarray
+        Left channel audio data (frames,).
+    right : np.ndarray
+        Right channel audio data (frames,).
+
+    Returns
+    -------
+    np.ndarray
+        Stereo float32 audio data (frames, 2).
+    """
+    stereo = np.zeros((max(len(left), len(right)), 2), dtype=np.float32)
+    stereo[:len(left), 0] = left
+    stereo[:len(right), 1] = right
+    return stereo
+
 def get_antialiasing_filter(
     original_sr: int, 
     target_sr: int, 
@@ -851,28 +1545,176 @@ def scramble_audio(
     -------
         None
     """
-    sample_rate, data = wavfile.read(input_file)
+    sample_rate, data = read_wav(input_file, return_sample_rate=True, mmap=True)
     segment_samples = data.shape[0] // number_of_segments
     
     segments = []
     for start in range(0, data.shape[0], segment_samples):
         end = min(start + segment_samples, data.shape[0])
-        segments.append(data[start:end])
+        segments.append((start, end))
     random.shuffle(segments)
-    scrambled_data = np.concatenate(segments)
-    wavfile.write(output_file, sample_rate, scrambled_data)
+
+    # Copy the shuffled segments into the output file one at a time
+    output_file = Path(output_file)
+    temp_file = output_file.with_name(f'{output_file.stem}.{os.getpid()}.tmp.wav')
+    scrambled_data = create_wav_memmap(temp_file, sample_rate, data.shape[0], _n_channels(data), data.dtype)
+    position = 0
+    for start, end in segments:
+        scrambled_data[position:position + end - start] = data[start:end]
+        position += end - start
+    scrambled_data.flush()
+    del scrambled_data, data # release the memory maps before replacing the file
+    os.replace(temp_file, output_file)
+
+def schedule_attention_probes(
+    duration_samples: int,
+    sr: int,
+    probe_len: int,
+    rng: Union[random.Random, np.random.Generator, None] = None
+) -> dict:
+    """
+    Schedules randomly placed attention probes (beeps) on the left and right channels,
+    without rendering any audio. Follows parameters inspired by Sanders, L. D., Stevens, C., 
+    Coch, D., & Neville, H. J. (2006). Selective auditory attention in 3-to 5-year-old children: 
+    An event-related potential study. Neuropsychologia, 44(11), 2126-2138.
+    Onsets are computed at once from the cumulative ISIs and both sides are balanced
+    (trailing probes of the side with more probes dropped) before any rendering.
+
+    Parameters
+    ----------
+    duration_samples : int
+        Total duration of the audio in samples.
+    sr : int
+        Sample rate of the audio in Hz.
+    probe_len : int
+        Length of the probe in samples.
+    rng : Union[random.Random, np.random.Generator, None], optional
+        Random generator used for sides and ISIs. If None, the module-level
+        generator is used. Pass a seeded generator for reproducible placement;
+        independent numpy streams (e.g. spawned from a SeedSequence) give independent schedules.
+
+    Returns
+    -------
+    dict
+        Sparse event list, sorted by onset:
+            - n_probes: number of probes per channel originally planned (int)
+            - onset_samples: probe onsets in samples (np.ndarray of int64)
+            - sides: channel of each probe, 0 for left and 1 for right (np.ndarray of int8)
+            - gains: amplitude of each probe (np.ndarray of float32)
+    """
+    # Sanders original parameters
+    DELAY_SECONDS = 3.0  # initial delay before first probe
+    ISI_OPTIONS = [0.2, 0.5, 1.0] # interstimulus intervals in seconds
+
+    # Estimate the even number of probes that can fit in the available time
+    available_seconds = (duration_samples / sr) - DELAY_SECONDS
+    avg_event_duration = probe_len / sr
+    avg_event_duration += (sum(ISI_OPTIONS)/len(ISI_OPTIONS))
+    n_probes = max(int(available_seconds / avg_event_duration), 0)
+    n_probes -= 1 if n_probes % 2 != 0 else 0  
+    
+    # Randomly assign probes to left or right channels, then draw random ISIs
+    rng = random if rng is None else rng
+    if isinstance(rng, np.random.Generator):
+        sides = rng.permutation(np.repeat(np.array([0, 1], dtype=np.int8), n_probes // 2))
+        isis = rng.choice(ISI_OPTIONS, size=n_probes)
+    else:
+        sides = ['left'] * (n_probes // 2) + ['right'] * (n_probes // 2)
+        rng.shuffle(sides)
+        sides = np.array([side == 'right' for side in sides], dtype=np.int8)
+        isis = [rng.choice(ISI_OPTIONS) for _ in range(n_probes)]
+    
+    # The ISI comes AFTER each beep
+    isi_samples = (np.array(isis, dtype=np.float64) * sr).astype(np.int64)
+    onsets = int(DELAY_SECONDS * sr) + np.arange(n_probes, dtype=np.int64) * probe_len
+    onsets[1:] += np.cumsum(isi_samples[:-1])
+
+    # Keep the probes that end before the audio does
+    fits = onsets + probe_len < duration_samples
+    onsets, sides = onsets[fits], sides[fits]
+
+    # Balance both sides by keeping the first probes of each up to the count of the smaller one
+    n_right = int(sides.sum())
+    n_per_side = min(len(sides) - n_right, n_right)
+    rank_in_side = np.where(sides == 1, np.cumsum(sides), np.cumsum(1 - sides)) - 1
+    keep = rank_in_side < n_per_side
+    return {
+        'n_probes': n_probes // 2,
+        'onset_samples': onsets[keep],
+        'sides': sides[keep],
+        'gains': np.ones(int(keep.sum()), dtype=np.float32)
+    }
+
+def probe_onsets_seconds(
+    events: dict,
+    sr: int
+) -> tuple[list, list]:
+    """
+    Probe onsets in seconds of each channel, from an event list of `schedule_attention_probes`.
+
+    Parameters
+    ----------
+    events : dict
+        Event list returned by `schedule_attention_probes`.
+    sr : int
+        Sample rate of the audio in Hz.
+
+    Returns
+    -------
+    tuple[list, list]
+        Left and right onsets in seconds.
+    """
+    onsets = events['onset_samples']
+    return (onsets[events['sides'] == 0] / sr).tolist(), (onsets[events['sides'] == 1] / sr).tolist()
+
+def render_attention_probes(
+    data: np.ndarray,
+    events: dict,
+    probe_audio: np.ndarray,
+    events_per_block: int = 256
+) -> np.ndarray:
+    """
+    Adds the scheduled probes into a stereo buffer, in place. Probes don't overlap
+    (consecutive onsets are at least a probe length apart), so they're scattered
+    into the buffer in blocks of events.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Stereo audio data (frames, 2), modified in place.
+    events : dict
+        Event list returned by `schedule_attention_probes`.
+    probe_audio : np.ndarray
+        Probe audio data (samples,), at the sample rate of data.
+    events_per_block : int, optional
+        Number of probes rendered at a time (bounds the size of the index arrays).
+
+    Returns
+    -------
+    np.ndarray
+        The same buffer, with the probes added.
+    """
+    probe_audio = np.asarray(probe_audio, dtype=np.float32)
+    offsets = np.arange(len(probe_audio))
+    for start in range(0, len(events['onset_samples']), events_per_block):
+        block = slice(start, start + events_per_block)
+        frames = events['onset_samples'][block, None] + offsets[None, :]
+        channels = np.broadcast_to(events['sides'][block, None], frames.shape)
+        data[frames, channels] += events['gains'][block, None] * probe_audio[None, :]
+    return data
 
 def create_attention_track(
     duration_samples: int, 
     sr: int, 
-    probe_audio_path: Union[str, Path],
-    return_onsets: bool = False
+    probe_audio_path: Union[str, Path, None] = None,
+    return_onsets: bool = False,
+    rng: Union[random.Random, None] = None,
+    probe_audio: Union[np.ndarray, None] = None
 ) -> tuple[int, np.ndarray, np.ndarray]:
     """
     Generates left and right audio tracks with randomly placed attention probes (beeps).
-    Follows parameters inspired by Sanders, L. D., Stevens, C., Coch, D., & Neville, H. J. (2006). 
-    Selective auditory attention in 3-to 5-year-old children: An event-related potential study. 
-    Neuropsychologia, 44(11), 2126-2138.
+    Probes are placed by `schedule_attention_probes` and rendered with `render_attention_probes`;
+    use those directly to avoid materializing two full-length tracks.
     
     Parameters
     ----------
@@ -880,8 +1722,15 @@ def create_attention_track(
         Total duration of the audio tracks in samples.
     sr : int
         Sample rate of the audio tracks in Hz.
-    probe_audio_path : Union[str, Path]
-        Path to the probe audio file (beep sound).
+    probe_audio_path : Union[str, Path, None]
+        Path to the probe audio file (beep sound). Ignored if probe_audio is given.
+    return_onsets : bool, optional
+        If True, also returns the probe onsets (in seconds) of each channel.
+    rng : Union[random.Random, None], optional
+        Random generator used for sides and ISIs. If None, the module-level
+        generator is used. Pass a seeded generator for reproducible placement.
+    probe_audio : Union[np.ndarray, None], optional
+        Probe audio data already sampled at sr. Avoids reading the probe from disk.
         
     Returns
     -------
@@ -891,15 +1740,49 @@ def create_attention_track(
             - Left audio track with probes (np.ndarray)
             - Right audio track with probes (np.ndarray)
     """
-    # Sanders original parameters
-    DELAY_SECONDS = 3.0  # initial delay before first probe
-    ISI_OPTIONS = [0.2, 0.5, 1.0] # interstimulus intervals in seconds
+    probe_wav = load_probe_audio(sr, probe_audio_path, probe_audio)
+    events = schedule_attention_probes(
+        duration_samples=duration_samples,
+        sr=sr,
+        probe_len=len(probe_wav),
+        rng=rng
+    )
+    tracks = render_attention_probes(
+        data=np.zeros((duration_samples, 2), dtype=np.float32),
+        events=events,
+        probe_audio=probe_wav
+    )
+    track_l, track_r = tracks[:, 0].copy(), tracks[:, 1].copy()
+    if return_onsets:
+        onsets_left, onsets_right = probe_onsets_seconds(events, sr)
+        return events['n_probes'], track_l, track_r, onsets_left, onsets_right
+    else:
+        return events['n_probes'], track_l, track_r
 
-    # Create empty arrays for left and right tracks
-    track_l = np.zeros(duration_samples, dtype=np.float32)
-    track_r = np.zeros(duration_samples, dtype=np.float32)
-    
-    # Load or generate the beep (If no file, generate a 100ms tone)
+def load_probe_audio(
+    sr: int,
+    probe_audio_path: Union[str, Path, None] = None,
+    probe_audio: Union[np.ndarray, None] = None
+) -> np.ndarray:
+    """
+    Loads the probe (beep) audio at sample rate sr, from memory or from disk.
+
+    Parameters
+    ----------
+    sr : int
+        Target sample rate in Hz.
+    probe_audio_path : Union[str, Path, None]
+        Path to the probe audio file. Ignored if probe_audio is given.
+    probe_audio : Union[np.ndarray, None], optional
+        Probe audio data already sampled at sr.
+
+    Returns
+    -------
+    np.ndarray
+        Probe audio data sampled at sr.
+    """
+    if probe_audio is not None:
+        return probe_audio
     sr_probe, probe_wav = wavfile.read(probe_audio_path)
     if sr_probe != sr:
         probe_wav = custom_resample(
@@ -909,65 +1792,64 @@ def create_attention_track(
             padtype='mean',
             axis=0
         )
-    probe_len = len(probe_wav)
-    probe_duration = probe_len / sr
-    
-    # Estimate the even number of probes that can fit in the available time
-    available_seconds = (duration_samples / sr) - DELAY_SECONDS
-    avg_event_duration = probe_duration
-    avg_event_duration += (sum(ISI_OPTIONS)/len(ISI_OPTIONS))
-    n_probes = int(available_seconds / avg_event_duration)
-    n_probes -= 1 if n_probes % 2 != 0 else 0  
-    
-    # Randomly assign probes to left or right channels
-    sides = ['left'] * (n_probes // 2) + ['right'] * (n_probes // 2)
-    random.shuffle(sides)
-    
-    # Random ISIs
-    isis = [random.choice(ISI_OPTIONS) for _ in range(n_probes)]
-    
-    current_sample = int(DELAY_SECONDS * sr)
-    idxs_l = []
-    idxs_r = []
-    onsets_left = []
-    onsets_right = []
-    for i in range(n_probes):
-        if current_sample + probe_len >= duration_samples:
-            break
-        if sides[i] == 'left':
-            track_l[current_sample:current_sample+probe_len] += probe_wav
-            idxs_l.append(current_sample)
-            # record onset time in seconds
-            onsets_left.append(current_sample / sr)
-        else:
-            track_r[current_sample:current_sample+probe_len] += probe_wav
-            idxs_r.append(current_sample)
-            # record onset time in seconds
-            onsets_right.append(current_sample / sr)
-        # The ISI comes AFTER the current beep
-        isi_samples = int(isis[i] * sr)
-        current_sample += probe_len + isi_samples
-    
-    # Verify that both tracks have the same number of probes, else set 0 the ending probes of the longer one
-    while len(idxs_l) != len(idxs_r):
-        if len(idxs_l) > len(idxs_r):
-            last_pos = idxs_l.pop() 
-            track_l[last_pos : last_pos + probe_len] = 0 
-            # also remove corresponding onset if present
-            if onsets_left:
-                onsets_left.pop()
-        else:
-            last_pos = idxs_r.pop()
-            track_r[last_pos : last_pos + probe_len] = 0
-            if onsets_right:
-                onsets_right.pop()
-    if return_onsets:
-        return n_probes//2, track_l, track_r, onsets_left, onsets_right
-    else:
-        return n_probes//2, track_l, track_r
+    return probe_wav
+
+def add_attention_tracks(
+    data: np.ndarray,
+    track_left: np.ndarray,
+    track_right: np.ndarray
+) -> np.ndarray:
+    """
+    Peak-normalizes a stereo buffer and mixes the attention tracks into it.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Stereo audio data (frames, 2).
+    track_left : np.ndarray
+        Left attention track (frames,).
+    track_right : np.ndarray
+        Right attention track (frames,).
+
+    Returns
+    -------
+    np.ndarray
+        The mixed float32 stereo audio data (frames, 2).
+    """
+    mixed = data.astype(np.float32) / np.max(np.abs(data))
+    mixed[:,0] += track_left
+    mixed[:,1] += track_right
+    return mixed
+
+def add_attention_probes(
+    data: np.ndarray,
+    events: dict,
+    probe_audio: np.ndarray
+) -> np.ndarray:
+    """
+    Peak-normalizes a stereo buffer and mixes the scheduled probes into it.
+    Equivalent to `add_attention_tracks` without materializing the attention tracks.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Stereo audio data (frames, 2).
+    events : dict
+        Event list returned by `schedule_attention_probes`.
+    probe_audio : np.ndarray
+        Probe audio data (samples,), at the sample rate of data.
+
+    Returns
+    -------
+    np.ndarray
+        The mixed float32 stereo audio data (frames, 2).
+    """
+    mixed = data.astype(np.float32) / np.max(np.abs(data))
+    return render_attention_probes(mixed, events, probe_audio)
     
-def _ffmpeg_has_encoder(encoder_name: str) -> bool:
-    """Return True if `ffmpeg -encoders` lists encoder_name."""
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_encoders() -> str:
+    """Return the output of `ffmpeg -encoders`. Probed once per process."""
     try:
         p = subprocess.run(
             ["ffmpeg", "-hide_banner", "-encoders"],
@@ -975,11 +1857,31 @@ def _ffmpeg_has_encoder(encoder_name: str) -> bool:
             capture_output=True,
             text=True
         )
-        out = (p.stdout or "") + "\n" + (p.stderr or "")
-        return encoder_name in out
+        return (p.stdout or "") + "\n" + (p.stderr or "")
     except Exception:
         # If ffmpeg isn't callable, let the actual encode step raise a clear error.
-        return False
+        return ""
+
+def _ffmpeg_has_encoder(encoder_name: str) -> bool:
+    """Return True if `ffmpeg -encoders` lists encoder_name."""
+    return encoder_name in _ffmpeg_encoders()
+
+@functools.lru_cache(maxsize=None)
+def _resolve_ogg_codec(codec: str) -> str:
+    """Return codec or an available OGG fallback. Resolved (and warned about) once per process."""
+    # Prefer libvorbis if present, otherwise use native vorbis (experimental in some builds)
+    if codec == "libopus" and not _ffmpeg_has_encoder("libopus"):
+        if _ffmpeg_has_encoder("libvorbis"):
+            print("Warning: ffmpeg encoder 'libopus' not available. Falling back to 'libvorbis'.")
+            return "libvorbis"
+        elif _ffmpeg_has_encoder("vorbis"):
+            print("Warning: ffmpeg encoder 'libopus' not available. Falling back to native 'vorbis' (experimental).")
+            return "vorbis"
+        else:
+            raise RuntimeError(
+                "No suitable OGG encoder found (tried libopus, libvorbis, vorbis). " \
+                "Install a fuller ffmpeg build.")
+    return codec
 
 def wav_to_ogg(
     input_wav: Union[str, Path],
@@ -1006,31 +1908,11 @@ def wav_to_ogg(
     -------
         None
     """
-    if sample_rate_target == 44100:
-        sample_rate_target = 48000
-        print("Warning: OGG files should use 48kHz sample rate. Overriding to 48000Hz.")
-    # Prefer libvorbis if present, otherwise use native vorbis (experimental in some builds)
-    if codec == "libopus" and not _ffmpeg_has_encoder("libopus"):
-        if _ffmpeg_has_encoder("libvorbis"):
-            print("Warning: ffmpeg encoder 'libopus' not available. Falling back to 'libvorbis'.")
-            codec = "libvorbis"
-        elif _ffmpeg_has_encoder("vorbis"):
-            print("Warning: ffmpeg encoder 'libopus' not available. Falling back to native 'vorbis' (experimental).")
-            codec = "vorbis"
-        else:
-            raise RuntimeError(
-                "No suitable OGG encoder found (tried libopus, libvorbis, vorbis). " \
-                "Install a fuller ffmpeg build.")
-    output_kwargs = dict(
-        acodec=codec,
-        audio_bitrate=bitrate,
-        format="ogg",
-        ar=sample_rate_target,
-        ac=2,
+    output_kwargs = _ogg_output_kwargs(
+        bitrate=bitrate,
+        codec=codec,
+        sample_rate_target=sample_rate_target
     )
-    # Native 'vorbis' may be marked experimental -> requires: -strict -2
-    if codec == "vorbis":
-        output_kwargs["strict"] = "-2"
     stream = (
         ffmpeg
         .input(str(input_wav))
@@ -1049,4 +1931,165 @@ def wav_to_ogg(
         except AttributeError:
             pass
         msg = stderr.decode('utf8', errors='replace').strip()
-        raise RuntimeError(f"ffmpeg failed while encoding {input_wav.name} -> {output_ogg.name}\n{msg}") from e
+        raise RuntimeError(f"ffmpeg failed while encoding {Path(input_wav).name} -> {Path(output_ogg).name}\n{msg}") from e
+
+def array_to_ogg(
+    data: np.ndarray,
+    sample_rate: int,
+    output_ogg: Union[str, Path],
+    bitrate: str = "192k",
+    codec: str = "libopus",
+    sample_rate_target: int = 48000,
+    chunk_frames: int = 2**16
+) -> None:
+    """
+    Encodes an in-memory audio buffer to OGG, streaming float32 PCM to ffmpeg
+    through stdin (no temporary WAV file).
+
+    Parameters
+    ----------
+        data : np.ndarray
+            Audio data (frames,) or (frames, channels).
+        sample_rate : int
+            Sample rate of data in Hz.
+        output_ogg : Union[str, Path]
+            Path to save the output OGG file.
+        bitrate : str
+            Bitrate for the OGG file (e.g., "192k").
+        sample_rate_target : int
+            Target sample rate for the output OGG file (e.g., 48000).
+        chunk_frames : int
+            Number of frames written to ffmpeg at a time.
+
+    Returns
+    -------
+        None
+    """
+    output_kwargs = _ogg_output_kwargs(
+        bitrate=bitrate,
+        codec=codec,
+        sample_rate_target=sample_rate_target
+    )
+    n_channels = 1 if data.ndim == 1 else data.shape[1]
+    process = (
+        ffmpeg
+        .input('pipe:', format='f32le', ac=n_channels, ar=sample_rate)
+        .output(
+            str(output_ogg),
+            **output_kwargs
+        )
+        .global_args('-nostats', '-loglevel', 'error')
+        .overwrite_output()
+        .run_async(pipe_stdin=True, pipe_stderr=True)
+    )
+    try:
+        for start in range(0, data.shape[0], chunk_frames):
+            chunk = np.ascontiguousarray(data[start:start + chunk_frames], dtype='<f4')
+            process.stdin.write(chunk.tobytes())
+    except BrokenPipeError:
+        pass
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        msg = (stderr or b"").decode('utf8', errors='replace').strip()
+        raise RuntimeError(f"ffmpeg failed while encoding in-memory audio -> {Path(output_ogg).name}\n{msg}")
+
+_ENCODER_POOL = None
+_ENCODER_POOL_SIZE = 0
+
+def _get_encoder_pool(
+    max_workers: int
+) -> ThreadPoolExecutor:
+    """Return the process-wide encoder pool, (re)creating it if its size changed."""
+    global _ENCODER_POOL, _ENCODER_POOL_SIZE
+    if _ENCODER_POOL is None or _ENCODER_POOL_SIZE != max_workers:
+        if _ENCODER_POOL is not None:
+            _ENCODER_POOL.shutdown(wait=True)
+        _ENCODER_POOL = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='ogg_encoder'
+        )
+        _ENCODER_POOL_SIZE = max_workers
+    return _ENCODER_POOL
+
+def batch_encode_ogg(
+    jobs: list[tuple],
+    max_workers: int = 4,
+    codec: str = "libopus",
+    sample_rate_target: int = 48000
+) -> list[Path]:
+    """
+    Encodes several inputs to OGG concurrently on a bounded, persistent pool of
+    ffmpeg workers. Codec availability is probed once per process.
+    Each ffmpeg encode runs in its own subprocess; pool threads only feed and wait on them.
+
+    Parameters
+    ----------
+        jobs : list[tuple]
+            List of (input, output_ogg, bitrate) jobs. The input is either the path to
+            a WAV file or a (data, sample_rate) tuple of in-memory PCM, which is streamed
+            to ffmpeg through stdin.
+        max_workers : int
+            Maximum number of concurrent ffmpeg processes.
+        codec : str
+            Preferred OGG encoder (falls back to vorbis if unavailable).
+        sample_rate_target : int
+            Target sample rate for the output OGG files (e.g., 48000).
+
+    Returns
+    -------
+        list[Path]
+            Paths of the encoded OGG files, in job order.
+    """
+    # Resolve the codec before dispatching so the fallback warning is printed only once
+    codec = _resolve_ogg_codec(codec)
+    pool = _get_encoder_pool(max_workers)
+    futures = []
+    for source, output_ogg, bitrate in jobs:
+        if isinstance(source, tuple):
+            data, sample_rate = source
+            futures.append(pool.submit(
+                array_to_ogg,
+                data=data,
+                sample_rate=sample_rate,
+                output_ogg=output_ogg,
+                bitrate=bitrate,
+                codec=codec,
+                sample_rate_target=sample_rate_target
+            ))
+        else:
+            futures.append(pool.submit(
+                wav_to_ogg,
+                input_wav=source,
+                output_ogg=output_ogg,
+                bitrate=bitrate,
+                codec=codec,
+                sample_rate_target=sample_rate_target
+            ))
+    # Wait for every job before raising, so no encode is left running in the background
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [Path(output_ogg) for _, output_ogg, _ in jobs]
+
+def _ogg_output_kwargs(
+    bitrate: str,
+    codec: str,
+    sample_rate_target: int
+) -> dict:
+    """Select an available OGG encoder and build the ffmpeg output arguments."""
+    if sample_rate_target == 44100:
+        sample_rate_target = 48000
+        print("Warning: OGG files should use 48kHz sample rate. Overriding to 48000Hz.")
+    codec = _resolve_ogg_codec(codec)
+    output_kwargs = dict(
+        acodec=codec,
+        audio_bitrate=bitrate,
+        format="ogg",
+        ar=sample_rate_target,
+        ac=2,
+    )
+    # Native 'vorbis' may be marked experimental -> requires: -strict -2
+    if codec == "vorbis":
+        output_kwargs["strict"] = "-2"
+    return output_kwargs
@@ -0,0 +1,289 @@
+"""
+Helpers for content-addressed caching: hashing of files and parameters,
+size-capped, least-recently-used pruning of cache directories, build manifests
+and checkpointed pipeline stages.
+"""
+from typing import Union, Callable, Any
+from pathlib import Path
+import hashlib
+import shutil
+import json
+import os
+
+def hash_file(
+    file_path: Union[str, Path],
+    chunk_size: int = 2**20
+) -> str:
+    """
+    Computes the SHA-256 hash of a file's content, reading it in chunks.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Path to the file.
+    chunk_size : int, optional
+        Number of bytes read at a time. Default is 1 MiB.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_params(
+    params: dict
+) -> str:
+    """
+    Computes a stable SHA-256 hash of a dictionary of parameters.
+    Keys are sorted and non-JSON values (paths, numpy scalars, tuples) are stringified.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters to hash.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the parameters.
+    """
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+def touch_cache_entry(
+    file_path: Union[str, Path]
+) -> None:
+    """
+    Marks a cache entry as recently used by updating its modification time.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Path to the cache entry.
+    """
+    try:
+        os.utime(file_path, None)
+    except FileNotFoundError:
+        pass
+
+def prune_cache(
+    cache_dir: Union[str, Path],
+    max_bytes: int,
+    pattern: str = '*'
+) -> list[Path]:
+    """
+    Evicts least-recently-used entries (oldest modification time first) until
+    the total size of the cache directory is below max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : Union[str, Path]
+        Cache directory.
+    max_bytes : int
+        Maximum total size of the cache in bytes.
+    pattern : str, optional
+        Glob pattern of the cache entries. Default is '*'.
+
+    Returns
+    -------
+    list[Path]
+        Paths of the evicted entries.
+    """
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return []
+    entries = []
+    for path in cache_dir.glob(pattern):
+        if path.is_file():
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+        evicted.append(path)
+    return evicted
+
+def load_manifest(
+    manifest_path: Union[str, Path]
+) -> dict:
+    """
+    Loads a build manifest. A missing or unreadable manifest yields an empty one.
+
+    Parameters
+    ----------
+    manifest_path : Union[str, Path]
+        Path to the JSON manifest.
+
+    Returns
+    -------
+    dict
+        The manifest, with an 'outputs' entry mapping output paths to their recorded inputs and parameters.
+    """
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    manifest.setdefault('outputs', {})
+    return manifest
+
+def save_manifest(
+    manifest_path: Union[str, Path],
+    manifest: dict
+) -> None:
+    """
+    Saves a build manifest atomically (written to a temporary file, then renamed).
+
+    Parameters
+    ----------
+    manifest_path : Union[str, Path]
+        Path to the JSON manifest.
+    manifest : dict
+        The manifest to save.
+    """
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_name(f'{manifest_path.name}.{os.getpid()}.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True, default=str)
+    os.replace(temp_path, manifest_path)
+
+def outputs_up_to_date(
+    manifest: dict,
+    outputs: dict,
+    inputs: dict
+) -> bool:
+    """
+    Checks whether every output exists and was built from the same inputs and parameters.
+
+    Parameters
+    ----------
+    manifest : dict
+        The build manifest.
+    outputs : dict
+        Mapping of output path to the parameters that affect it.
+    inputs : dict
+        Mapping of input name to its content hash.
+
+    Returns
+    -------
+    bool
+        True if no output needs to be rebuilt.
+    """
+    for output_path, params in outputs.items():
+        entry = manifest['outputs'].get(Path(output_path).as_posix())
+        if not Path(output_path).exists() or entry is None:
+            return False
+        if entry != _manifest_entry(inputs, params):
+            return False
+    return True
+
+def record_outputs(
+    manifest: dict,
+    outputs: dict,
+    inputs: dict
+) -> None:
+    """
+    Records in the manifest the inputs and parameters each output was built from.
+
+    Parameters
+    ----------
+    manifest : dict
+        The build manifest (modified in place).
+    outputs : dict
+        Mapping of output path to the parameters that affect it.
+    inputs : dict
+        Mapping of input name to its content hash.
+    """
+    for output_path, params in outputs.items():
+        manifest['outputs'][Path(output_path).as_posix()] = _manifest_entry(inputs, params)
+
+def _manifest_entry(
+    inputs: dict,
+    params: dict
+) -> dict:
+    """Normalizes inputs and parameters the way they are stored in the JSON manifest."""
+    return json.loads(json.dumps({'inputs': inputs, 'params': params}, sort_keys=True, default=str))
+
+def stage_key(
+    parents: list[str],
+    params: dict
+) -> str:
+    """
+    Key of a pipeline stage, chained on the keys of the stages (or input hashes) it
+    depends on, so a change upstream invalidates every stage downstream.
+
+    Parameters
+    ----------
+    parents : list[str]
+        Keys of the parent stages or hashes of the input files.
+    params : dict
+        Parameters of the stage.
+
+    Returns
+    -------
+    str
+        Hexadecimal key of the stage.
+    """
+    return hash_params({'parents': list(parents), 'params': params})
+
+def cached_stage(
+    checkpoint_dir: Union[str, Path],
+    stage: str,
+    key: str,
+    compute: Callable[[], Any],
+    save: Callable[[Any, Path], None],
+    load: Callable[[Path], Any]
+) -> tuple[Any, bool]:
+    """
+    Runs a pipeline stage through an on-disk checkpoint. Each checkpoint is a directory
+    named after the stage and its key, so stages can save any number of files. The
+    checkpoint is written to a temporary directory and renamed once complete, and
+    superseded checkpoints of the same stage are removed.
+
+    Parameters
+    ----------
+    checkpoint_dir : Union[str, Path]
+        Directory of the checkpoints (e.g. one per subject).
+    stage : str
+        Name of the stage.
+    key : str
+        Key of the stage, see `stage_key`.
+    compute : Callable[[], Any]
+        Computes the result of the stage. Only called if there is no valid checkpoint.
+    save : Callable[[Any, Path], None]
+        Saves a result into the given (existing) directory.
+    load : Callable[[Path], Any]
+        Loads a result from the given directory.
+
+    Returns
+    -------
+    tuple[Any, bool]
+        The result of the stage and whether it was loaded from a checkpoint.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    stage_dir = checkpoint_dir / f'{stage}-{key[:16]}'
+    if stage_dir.is_dir():
+        return load(stage_dir), True
+
+    result = compute()
+    temp_dir = checkpoint_dir / f'{stage_dir.name}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    temp_dir.mkdir(parents=True)
+    save(result, temp_dir)
+    os.replace(temp_dir, stage_dir)
+    for old_dir in checkpoint_dir.glob(f'{stage}-*'):
+        if old_dir != stage_dir and old_dir.is_dir() and not old_dir.name.endswith('.tmp'):
+            shutil.rmtree(old_dir, ignore_errors=True)
+    return result, False
@@ -0,0 +1,194 @@
+"""
+Helpers for the compact binary events store of the preprocessed EEG recordings: a typed,
+columnar table of events (sample index, trigger code, duration and description category)
+and the trigger channel as run-length encoded transitions, saved together in one .npz file
+with a schema version.
+"""
+from typing import Union
+from pathlib import Path
+import numpy as np
+import json
+import os
+
+EVENT_STORE_SCHEMA_VERSION = 1
+
+def encode_trigger_runs(
+    trigger_signal: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Run-length encodes a trigger channel as the transitions between constant values.
+
+    Parameters
+    ----------
+    trigger_signal : np.ndarray
+        The trigger signal array (integer values, possibly stored as floats).
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, int]
+        First sample (int64) and value (int32) of each run, the first run starting at sample 0,
+        and the number of samples of the trigger channel.
+    """
+    starts = np.concatenate([[0], np.flatnonzero(trigger_signal[1:] != trigger_signal[:-1]) + 1])
+    return starts.astype(np.int64), np.rint(trigger_signal[starts]).astype(np.int32), len(trigger_signal)
+
+def decode_trigger_runs(
+    starts: np.ndarray,
+    values: np.ndarray,
+    n_samples: int,
+    dtype: np.dtype = np.float64
+) -> np.ndarray:
+    """
+    Rebuilds a trigger channel from its run-length encoding (see encode_trigger_runs).
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        First sample of each run.
+    values : np.ndarray
+        Value of each run.
+    n_samples : int
+        Number of samples of the trigger channel.
+    dtype : np.dtype, optional
+        Dtype of the trigger channel. Default is float64 (as returned by MNE).
+
+    Returns
+    -------
+    np.ndarray
+        The trigger signal array.
+    """
+    lengths = np.diff(np.append(starts, n_samples))
+    return np.repeat(values.astype(dtype), lengths)
+
+def save_event_store(
+    file_path: Union[str, Path],
+    sfreq: float,
+    samples: np.ndarray,
+    codes: np.ndarray,
+    durations: np.ndarray,
+    categories: list[str],
+    trigger_runs: Union[tuple[np.ndarray, np.ndarray, int], None] = None,
+    metadata: Union[dict, None] = None
+) -> None:
+    """
+    Saves events as a columnar .npz store, written atomically (temporary file, then renamed).
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Path to the .npz file.
+    sfreq : float
+        Sampling frequency of the sample indices (and of the trigger channel).
+    samples : np.ndarray
+        Onset sample index of each event.
+    codes : np.ndarray
+        Trigger code of each event (0 for events that are not triggers, e.g. no-task periods).
+    durations : np.ndarray
+        Duration of each event in seconds.
+    categories : list[str]
+        Description of each event (e.g. 'listening', 'bip_Block_1_Bip_3'), stored as an index
+        into the sorted unique descriptions.
+    trigger_runs : tuple[np.ndarray, np.ndarray, int], optional
+        Trigger channel as run-length encoded transitions, see encode_trigger_runs. Default is None.
+    metadata : dict, optional
+        JSON-serializable metadata (e.g. the trigger cleaning report). Default is None.
+    """
+    category_names, category_index = np.unique(np.asarray(categories, dtype=str), return_inverse=True)
+    columns = {
+        'schema_version': np.int64(EVENT_STORE_SCHEMA_VERSION),
+        'sfreq': np.float64(sfreq),
+        'sample': np.asarray(samples, dtype=np.int64),
+        'code': np.asarray(codes, dtype=np.int32),
+        'duration': np.asarray(durations, dtype=np.float64),
+        'category': category_index.astype(np.int16),
+        'category_names': category_names,
+        'metadata': np.array(json.dumps(metadata or {}, default=str))
+    }
+    if trigger_runs is not None:
+        starts, values, n_samples = trigger_runs
+        columns['trigger_starts'] = np.asarray(starts, dtype=np.int64)
+        columns['trigger_values'] = np.asarray(values, dtype=np.int32)
+        columns['trigger_n_samples'] = np.int64(n_samples)
+
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = file_path.with_name(f'{file_path.stem}.{os.getpid()}.tmp.npz')
+    np.savez(temp_path, **columns)
+    os.replace(temp_path, file_path)
+
+def load_event_store(
+    file_path: Union[str, Path],
+    load_trigger: bool = False
+) -> dict:
+    """
+    Loads an events store saved by save_event_store.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        Path to the .npz file.
+    load_trigger : bool, optional
+        If True, also rebuild the full trigger channel ('trigger', None if it was not saved).
+        Default is False.
+
+    Returns
+    -------
+    dict
+        The columns 'sample', 'code', 'duration', 'category' (description of each event) and
+        'time' (onset in seconds), with 'sfreq', 'schema_version', 'metadata' and 'trigger_runs'
+        (see encode_trigger_runs, None if the trigger channel was not saved).
+    """
+    with np.load(file_path, allow_pickle=False) as store:
+        schema_version = int(store['schema_version'])
+        if schema_version != EVENT_STORE_SCHEMA_VERSION:
+            raise ValueError(
+                f"{file_path} has events store schema version {schema_version}, "
+                f"expected {EVENT_STORE_SCHEMA_VERSION}."
+            )
+        sfreq = float(store['sfreq'])
+        events = {
+            'schema_version': schema_version,
+            'sfreq': sfreq,
+            'sample': store['sample'],
+            'code': store['code'],
+            'duration': store['duration'],
+            'category': store['category_names'][store['category']],
+            'time': store['sample'] / sfreq,
+            'metadata': json.loads(str(store['metadata'])),
+            'trigger_runs': None
+        }
+        if 'trigger_starts' in store:
+            events['trigger_runs'] = (
+                store['trigger_starts'], store['trigger_values'], int(store['trigger_n_samples'])
+            )
+    if load_trigger:
+        events['trigger'] = None if events['trigger_runs'] is None else decode_trigger_runs(*events['trigger_runs'])
+    return events
+
+def event_samples(
+    events: dict,
+    sfreq: float,
+    mask: Union[np.ndarray, None] = None
+) -> np.ndarray:
+    """
+    Sample indices of events at another sampling frequency (e.g. of the downsampled recording),
+    truncated as mne's Raw.time_as_index.
+
+    Parameters
+    ----------
+    events : dict
+        Events, see load_event_store.
+    sfreq : float
+        Target sampling frequency.
+    mask : np.ndarray, optional
+        Boolean mask of the events to convert. Default is None (all events).
+
+    Returns
+    -------
+    np.ndarray
+        Sample indices (int64) at sfreq.
+    """
+    samples = events['sample'] if mask is None else events['sample'][mask]
+    if float(sfreq).is_integer() and float(events['sfreq']).is_integer():
+        return samples * int(sfreq) // int(events['sfreq'])
+    return (samples / events['sfreq'] * sfreq).astype(np.int64)
@@ -1,11 +1,14 @@
 """
 Helpers for plotting figures
 """
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import matplotlib.text as mtext
 from pathlib import Path
 from typing import Union
 import numpy as np
+import matplotlib
+import json
 import mne
 
 import config
@@ -183,3 +186,119 @@ def evoked_potential_plot(
     
     if verbose:
         print('\n\t Figure saved to: ', output_filepath)
+
+def save_ica_figures(
+    ica_path: Union[Path, str],
+    raw_path: Union[Path, str],
+    output_dir: Union[Path, str],
+    annotations: Union[mne.Annotations, None] = None,
+    n_jobs: int = 1,
+    figures_key: Union[str, None] = None
+) -> bool:
+    """
+    Plot the ICA components of a fitted solution for inspection: properties of each
+    component, topographies and sources. Components are rendered in parallel worker
+    processes (Agg backend), each loading the solution and opening the recording from disk.
+    The recording is not preloaded, but plot_properties epochs all of it: each worker peaks
+    at about one copy of the recording in float64, on top of ~130 MB for mne and matplotlib,
+    so memory grows linearly with n_jobs.
+    If figures_key matches the key stored with the figures of output_dir (e.g. a hash
+    of the ICA solution and the recording), nothing is rendered.
+
+    Parameters
+    ----------
+    ica_path : Union[Path, str]
+        Path to the fitted ICA (-ica.fif).
+    raw_path : Union[Path, str]
+        Path to the recording the ICA was fitted on (FIF).
+    output_dir : Union[Path, str]
+        Output directory of the figures.
+    annotations : Union[mne.Annotations, None]
+        Annotations set on the recording before plotting ('bad' segments are rejected).
+    n_jobs : int
+        Number of worker processes (see the memory cost above). With 1, figures are rendered in this process.
+    figures_key : Union[str, None]
+        Key of the solution. If None, figures are always rendered.
+
+    Returns
+    -------
+    bool
+        True if the figures were rendered, False if they were up to date.
+    """
+    output_dir = Path(output_dir)
+    stamp_path = output_dir / 'figures.json'
+    if figures_key is not None and stamp_path.exists():
+        with open(stamp_path, 'r') as f:
+            if json.load(f).get('figures_key') == figures_key:
+                return False
+
+    # Remove figures of a previous solution (the number of components may differ)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stamp_path.unlink(missing_ok=True)
+    for old_figure in output_dir.glob('*.png'):
+        old_figure.unlink()
+
+    n_components = mne.preprocessing.read_ica(ica_path, verbose='CRITICAL').n_components_
+    component_chunks = [chunk for chunk in np.array_split(np.arange(n_components), max(n_jobs, 1)) if len(chunk)]
+    # The overview figures (topographies and sources) are one more job
+    jobs = [chunk.tolist() for chunk in component_chunks] + [None]
+    render_args = [str(ica_path), str(raw_path), str(output_dir), annotations]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs)), initializer=_use_agg_backend) as executor:
+            list(executor.map(_render_ica_figures, *[[arg] * len(jobs) for arg in render_args], jobs))
+    else:
+        for components in jobs:
+            _render_ica_figures(*render_args, components)
+
+    if figures_key is not None:
+        with open(stamp_path, 'w') as f:
+            json.dump({'figures_key': figures_key, 'n_components': int(n_components)}, f, indent=4)
+    return True
+
+def _use_agg_backend() -> None:
+    """Use the non-interactive Agg backend in a worker process."""
+    matplotlib.use('Agg')
+
+def _render_ica_figures(
+    ica_path: str,
+    raw_path: str,
+    output_dir: str,
+    annotations: Union[mne.Annotations, None],
+    components: Union[list[int], None]
+) -> None:
+    """
+    Render the properties figures of the given components, or the overview figures
+    (topographies and sources) if components is None.
+    """
+    ica = mne.preprocessing.read_ica(ica_path, verbose='CRITICAL')
+    raw = mne.io.read_raw_fif(raw_path, preload=False, verbose='CRITICAL')
+    if annotations is not None:
+        raw.set_annotations(annotations)
+    output_dir = Path(output_dir)
+    if components is not None:
+        for component in components:
+            plt.close('all')
+            fig = ica.plot_properties(
+                raw, 
+                picks=[component], 
+                show=False, 
+                verbose='CRITICAL'
+            ) 
+            fig[0].savefig(
+                output_dir / f"{component}_properties.png"
+            )
+        plt.close('all')
+        return
+
+    plt.close('all')
+    fig = ica.plot_components(show=False)
+    if ica.n_components_ >= 20:
+        fig1, fig2 = fig
+        fig1.savefig(output_dir / "topo1.png")
+        fig2.savefig(output_dir / "topo2.png")
+    else:
+        fig.savefig(output_dir / "topo.png")
+    plt.close('all')
+    fig = ica.plot_sources(raw, show=False)
+    fig.savefig(output_dir / "sources.png")
+    plt.close('all')
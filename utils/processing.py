@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Callable
+from functools import lru_cache
 from pathlib import Path
-from typing import Union
 from scipy import signal
 import numpy as np
+import threading
 import json
 import mne
+import os
+
+from utils.cache_helpers import hash_params
 
 # =================
 # GENERAL UTILITIES
@@ -80,38 +86,166 @@ def load_json_to_dict(
 
 # =====================
 # ANNOTATION PROCESSING
-def find_first_event_on_id(
-        raw, 
-        trigger_signal, 
-        event_id
-    ) -> np.ndarray:
-        """
-        Find the time of the first occurrence of a specific event ID in the trigger signal.
-
-        Parameters
-        ----------
-        raw : mne.io.Raw
-            The raw EEG data.
-        trigger_signal : np.ndarray
-            The trigger signal array.
-        event_id : int
-            The event ID to search for.
-        
-        Returns
-        -------
-        np.ndarray
-            The times of the first occurrence of the specified event ID.
-        """
-        return raw.times[
-            np.where(
-                np.diff(
-                    (trigger_signal==event_id).astype(int)
-                )==1
-            )[0]+1
-        ]
-        # return np.where(
-        #             (trigger_signal==event_id).astype(int)
-        #     )[0]+1
+# Dtype of the events table returned by decode_trigger_events
+TRIGGER_EVENTS_DTYPE = np.dtype([
+    ('sample', np.int64), # first sample of the event
+    ('time', np.float64), # onset in seconds
+    ('value', np.int64), # trigger value
+    ('duration', np.float64) # seconds until the trigger value changes
+])
+
+def decode_trigger_events(
+    trigger_signal: np.ndarray,
+    sfreq: float,
+    n_bits: Union[int, None] = None,
+    min_samples: int = 1,
+    return_n_glitches: bool = False
+) -> Union[np.ndarray, tuple[np.ndarray, int]]:
+    """
+    Decode every event of a trigger channel in a single pass: an event starts at each sample where
+    the trigger changes to a non-zero value, and lasts until the value changes again. A value
+    already present at the first sample is not an event.
+
+    Parameters
+    ----------
+    trigger_signal : np.ndarray
+        The trigger signal array.
+    sfreq : float
+        The sampling frequency of the trigger signal.
+    n_bits : int, optional
+        Keep only the lowest n_bits of the trigger values (e.g. to drop the status bits of the
+        Biosemi Status channel). Default is None (values as they are).
+    min_samples : int, optional
+        Values lasting fewer samples are glitches, merged into the value before them. Default is 1.
+    return_n_glitches : bool, optional
+        If True, also return the number of merged glitches. Default is False.
+
+    Returns
+    -------
+    Union[np.ndarray, tuple[np.ndarray, int]]
+        Structured array (TRIGGER_EVENTS_DTYPE) with fields sample, time, value and duration,
+        ordered by sample (and the number of merged glitches, if return_n_glitches).
+    """
+    starts, values, n_glitches = _trigger_runs(trigger_signal, n_bits, min_samples)
+    events = _runs_to_events(starts, values, len(trigger_signal), sfreq)
+    if return_n_glitches:
+        return events, n_glitches
+    return events
+
+def _runs_to_events(
+    starts: np.ndarray,
+    values: np.ndarray,
+    n_samples: int,
+    sfreq: float
+) -> np.ndarray:
+    """Events table of the non-zero runs of a run-length encoded trigger channel (see _trigger_runs)."""
+    ends = np.append(starts[1:], n_samples)
+    is_event = values != 0
+    is_event[0] = False # no transition at the first sample
+
+    events = np.empty(np.count_nonzero(is_event), dtype=TRIGGER_EVENTS_DTYPE)
+    events['sample'] = starts[is_event]
+    events['time'] = events['sample'] / sfreq
+    events['value'] = np.rint(values[is_event])
+    events['duration'] = (ends[is_event] - events['sample']) / sfreq
+    return events
+
+def _trigger_runs(
+    trigger_signal: np.ndarray,
+    n_bits: Union[int, None],
+    min_samples: int
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Run-length encoding of a trigger channel: first sample and value of each run of constant value,
+    after masking to n_bits and merging the runs shorter than min_samples (except the first one)
+    into the run before them. Also returns the number of merged glitches.
+    """
+    if n_bits is not None:
+        trigger_signal = np.rint(trigger_signal).astype(np.int64) & ((1 << n_bits) - 1)
+    starts = np.concatenate([[0], np.flatnonzero(trigger_signal[1:] != trigger_signal[:-1]) + 1])
+    values = trigger_signal[starts]
+    if min_samples <= 1:
+        return starts, values, 0
+
+    lengths = np.diff(np.append(starts, len(trigger_signal)))
+    keep = lengths >= min_samples
+    keep[0] = True
+    n_glitches = int(np.count_nonzero(~keep))
+    starts, values = starts[keep], values[keep]
+    # Runs separated only by glitches are a single run
+    changes = np.concatenate([[True], values[1:] != values[:-1]])
+    return starts[changes], values[changes], n_glitches
+
+def index_events_by_value(
+    events: np.ndarray
+) -> dict[int, np.ndarray]:
+    """
+    Group an events table (see decode_trigger_events) by trigger value, so that
+    per-ID queries are dictionary lookups instead of scans of the trigger signal.
+
+    Parameters
+    ----------
+    events : np.ndarray
+        Events table, ordered by sample.
+
+    Returns
+    -------
+    dict[int, np.ndarray]
+        Events of each trigger value, ordered by sample.
+    """
+    order = np.argsort(events['value'], kind='stable')
+    values, starts = np.unique(events['value'][order], return_index=True)
+    return {
+        int(value): events[rows]
+        for value, rows in zip(values, np.split(order, starts[1:]))
+    }
+
+def get_events(
+    events_index: dict[int, np.ndarray],
+    event_ids: list[int]
+) -> np.ndarray:
+    """
+    Events with any of the given trigger values, merged from their entries of the index.
+
+    Parameters
+    ----------
+    events_index : dict[int, np.ndarray]
+        Events grouped by trigger value, see index_events_by_value.
+    event_ids : list[int]
+        The event IDs to look up.
+
+    Returns
+    -------
+    np.ndarray
+        Events table (TRIGGER_EVENTS_DTYPE), ordered by sample, empty if there are none.
+    """
+    tables = [events_index[event_id] for event_id in event_ids if event_id in events_index]
+    if not tables:
+        return np.empty(0, dtype=TRIGGER_EVENTS_DTYPE)
+    events = np.concatenate(tables)
+    return events[np.argsort(events['sample'], kind='stable')]
+
+def get_event_times(
+    events_index: dict[int, np.ndarray],
+    event_id: int
+) -> np.ndarray:
+    """
+    Onset times of the events with a given trigger value (the samples where the
+    trigger changes to that value).
+
+    Parameters
+    ----------
+    events_index : dict[int, np.ndarray]
+        Events grouped by trigger value, see index_events_by_value.
+    event_id : int
+        The event ID to search for.
+
+    Returns
+    -------
+    np.ndarray
+        The onset times (seconds) of the events, empty if there are none.
+    """
+    return get_events(events_index, [event_id])['time']
 
 def get_no_task_times(
     raw: mne.io.Raw,
@@ -119,7 +253,8 @@ def get_no_task_times(
     offsets: np.ndarray
 ) -> tuple[np.ndarray, np.ndarray]:
     """
-    Get onsets and durations of no-task periods based on task period onsets and offsets.
+    Get onsets and durations of no-task periods based on task period onsets and offsets,
+    as the complement of the task periods within the recording.
 
     Parameters
     ----------
@@ -135,30 +270,363 @@ def get_no_task_times(
     tuple[np.ndarray, np.ndarray]
         Onsets and durations of no-task periods.
     """
-    no_task_mask = np.zeros_like(raw.times, dtype=bool)
-
-    # Mark periods between offsets and next onsets as no-task
-    for onset, offset in zip(onsets, offsets):
-        onset_idx = raw.time_as_index(onset)[0]
-        offset_idx = raw.time_as_index(offset)[0]
-        no_task_mask[onset_idx:offset_idx] = True
-    no_task_mask = ~no_task_mask
-
-    diff = np.diff(no_task_mask.astype(int),  append=0)
-    diff[0] = no_task_mask[0]
-    offsets_not_annotated = raw.times[np.where(diff==-1)[0]]
-    onsets_not_annotated = raw.times[np.where(diff==1)[0]]
+    # Task periods in samples, no-task periods are the samples [start, stop) outside them
+    starts, stops = complement_intervals(
+        onsets=raw.time_as_index(np.asarray(onsets, dtype=np.float64)),
+        offsets=raw.time_as_index(np.asarray(offsets, dtype=np.float64)),
+        start=0,
+        stop=raw.n_times
+    )
+    # Onsets on the last task sample and offsets on the last no-task sample, as the
+    # former sample mask implementation reported them
+    onsets_not_annotated = raw.times[np.maximum(starts - 1, 0)]
+    offsets_not_annotated = raw.times[stops - 1]
     durations_not_annotated = offsets_not_annotated - onsets_not_annotated
 
     return onsets_not_annotated, durations_not_annotated
 
+def trigger_protocol(
+    trigger_ids: dict
+) -> dict[int, dict]:
+    """
+    Expected trigger protocol of the experiment, as configured in config.TRIGGER_IDS:
+    listening periods start with trigger_ids['listening'][0] and end with trigger_ids['listening'][1],
+    and bip number n (from 0) of a block (start, step, number of bips) starts with start + n * step
+    and ends with the next value.
+
+    Parameters
+    ----------
+    trigger_ids : dict
+        Trigger IDs, see config.TRIGGER_IDS.
+
+    Returns
+    -------
+    dict[int, dict]
+        For each onset value: its offset value, description and the onset value expected before it
+        (the previous bip of the block, None for the first bip and for listening periods).
+    """
+    protocol = {
+        trigger_ids['listening'][0]: {
+            'offset': trigger_ids['listening'][1], 'description': 'listening', 'previous': None
+        }
+    }
+    for bip_block in ['bips1', 'bips2']:
+        start, step, n_bips = trigger_ids[bip_block]
+        for bip_number in range(n_bips):
+            onset = start + bip_number * step
+            protocol[onset] = {
+                'offset': onset + 1,
+                'description': f'bip_Block_{bip_block[-1]}_Bip_{bip_number+1}',
+                'previous': onset - step if bip_number > 0 else None
+            }
+    return protocol
+
+def clean_trigger_events(
+    trigger_signal: np.ndarray,
+    sfreq: float,
+    trigger_ids: dict,
+    n_bits: int = 8,
+    min_samples: int = 3,
+    expected_durations: Union[dict, None] = None,
+    default_duration: float = 1.0
+) -> tuple[dict[int, np.ndarray], dict]:
+    """
+    Validate the events of a trigger channel against the experiment protocol (see trigger_protocol),
+    in a single vectorized pass over the decoded events:
+
+    - Trigger values are masked to n_bits (the upper bits of the Biosemi Status channel are status flags)
+      and glitches shorter than min_samples are merged.
+    - Values that are not part of the protocol are dropped.
+    - Each onset is paired with the offset that follows it, which sets its duration. Offsets without
+      their onset just before are dropped.
+    - Onsets without an offset get the duration from expected_durations (the k-th occurrence of an onset
+      value gets its k-th expected duration) or, for the values without expected durations, default_duration.
+      If they are also out of the protocol order (not preceded by the previous bip of their block), they are
+      spurious and dropped.
+
+    Parameters
+    ----------
+    trigger_signal : np.ndarray
+        The trigger signal array.
+    sfreq : float
+        The sampling frequency of the trigger signal.
+    trigger_ids : dict
+        Trigger IDs, see config.TRIGGER_IDS.
+    n_bits : int, optional
+        Width of the trigger values in bits. Default is 8.
+    min_samples : int, optional
+        Minimum number of samples of a trigger value. Default is 3.
+    expected_durations : dict, optional
+        Durations (seconds) of the onsets of some values, in order of occurrence
+        (e.g. the listening durations of the behavioural data). Default is None.
+    default_duration : float, optional
+        Duration (seconds) of the onsets without offset of the values not in expected_durations. Default is 1.0.
+
+    Returns
+    -------
+    tuple[dict[int, np.ndarray], dict]
+        The validated onsets grouped by trigger value (see index_events_by_value, query them with
+        get_events or get_event_times) and a JSON-serializable report
+        with the number of masked samples, merged glitches, kept, repaired and dropped events, and an entry
+        (sample, time, value, action, reason) for every repaired or dropped event.
+
+    Raises
+    ------
+    ValueError
+        If an onset without offset of a value in expected_durations has no expected duration left
+        (more onsets in the recording than expected durations).
+    """
+    expected_durations = expected_durations or {}
+    protocol = trigger_protocol(trigger_ids)
+    n_values = 1 << n_bits
+    values = np.rint(trigger_signal).astype(np.int64)
+    n_masked = int(np.count_nonzero((values < 0) | (values >= n_values)))
+    events, n_glitches = decode_trigger_events(trigger_signal, sfreq, n_bits, min_samples, return_n_glitches=True)
+
+    # Lookup tables of the protocol, indexed by trigger value
+    offset_of = np.full(n_values, -1, dtype=np.int64)
+    onset_of = np.full(n_values, -1, dtype=np.int64)
+    previous_of = np.full(n_values, -1, dtype=np.int64)
+    for onset, spec in protocol.items():
+        offset_of[onset] = spec['offset']
+        onset_of[spec['offset']] = onset
+        previous_of[onset] = -1 if spec['previous'] is None else spec['previous']
+    is_offset = onset_of >= 0
+
+    # Drop the values outside the protocol
+    value = events['value']
+    is_onset = offset_of[value] >= 0
+    unexpected = ~is_onset & ~is_offset[value]
+    dropped = [(events[unexpected], 'unexpected trigger value')]
+    events = events[~unexpected]
+    value, is_onset = events['value'], offset_of[events['value']] >= 0
+
+    # Pair each onset with the event just after it, offsets with the event just before
+    next_value = np.append(value[1:], 0)
+    previous_value = np.insert(value[:-1], 0, 0)
+    paired = is_onset & (next_value == offset_of[value])
+    orphan_offsets = ~is_onset & (onset_of[value] != previous_value)
+    dropped.append((events[orphan_offsets], 'offset without onset'))
+
+    # Onsets without offset: spurious if out of the protocol order (the event before is not from the previous bip)
+    previous_onset = np.where(offset_of[previous_value] >= 0, previous_value, onset_of[previous_value])
+    in_order = (previous_of[value] < 0) | (previous_onset == previous_of[value])
+    unpaired = is_onset & ~paired
+    spurious = unpaired & ~in_order
+    dropped.append((events[spurious], 'onset without offset, out of protocol order'))
+
+    durations = np.append(np.diff(events['time']), 0.)
+    keep = is_onset & ~spurious
+    onsets = events[keep]
+    onsets['duration'] = durations[keep]
+    repaired = unpaired[keep]
+    repaired_reasons = np.full(len(onsets), 'onset without offset, default duration', dtype=object)
+    for onset_value, expected in expected_durations.items():
+        of_value = onsets['value'] == onset_value
+        occurrence = np.cumsum(of_value) - 1
+        missing = repaired & of_value & (occurrence >= len(expected))
+        if np.any(missing):
+            raise ValueError(
+                f"{np.count_nonzero(of_value)} onsets of trigger {onset_value} but only {len(expected)} expected "
+                f"durations: no duration for the onsets at {np.round(onsets['time'][missing], 3).tolist()} s."
+            )
+        fill = repaired & of_value
+        onsets['duration'][fill] = np.asarray(expected, dtype=np.float64)[occurrence[fill]]
+        repaired_reasons[fill] = 'onset without offset, expected duration'
+    fill_default = repaired & (repaired_reasons == 'onset without offset, default duration')
+    onsets['duration'][fill_default] = default_duration
+
+    issues = [
+        {'sample': int(event['sample']), 'time': float(event['time']), 'value': int(event['value']), 'action': 'dropped', 'reason': reason}
+        for table, reason in dropped for event in table
+    ] + [
+        {'sample': int(event['sample']), 'time': float(event['time']), 'value': int(event['value']), 'action': 'repaired', 'reason': reason}
+        for event, reason in zip(onsets[repaired], repaired_reasons[repaired])
+    ]
+    issues.sort(key=lambda issue: issue['sample'])
+    report = {
+        'masked_samples': n_masked,
+        'merged_glitches': n_glitches,
+        'kept': int(len(onsets) - np.count_nonzero(repaired)),
+        'repaired': int(np.count_nonzero(repaired)),
+        'dropped': int(sum(len(table) for table, _ in dropped)),
+        'issues': issues
+    }
+    return index_events_by_value(onsets), report
+
+# ===================
+# INTERVAL ARITHMETIC
+def union_intervals(
+    onsets: np.ndarray,
+    offsets: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Union of half-open intervals [onset, offset): sorted, disjoint intervals where overlapping
+    or touching intervals are merged and empty ones dropped.
+
+    Parameters
+    ----------
+    onsets : np.ndarray
+        Interval onsets (times or sample indices).
+    offsets : np.ndarray
+        Interval offsets, same length as onsets.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Onsets and offsets of the union.
+    """
+    onsets, offsets = np.asarray(onsets), np.asarray(offsets)
+    non_empty = offsets > onsets
+    onsets, offsets = onsets[non_empty], offsets[non_empty]
+    order = np.argsort(onsets, kind='stable')
+    onsets, offsets = onsets[order], offsets[order]
+    if len(onsets) == 0:
+        return onsets, offsets
+
+    # A new interval starts where the onset is past every previous offset
+    reach = np.maximum.accumulate(offsets)
+    is_start = np.concatenate([[True], onsets[1:] > reach[:-1]])
+    is_end = np.append(is_start[1:], True)
+    return onsets[is_start], reach[is_end]
+
+def clip_intervals(
+    onsets: np.ndarray,
+    offsets: np.ndarray,
+    start: float,
+    stop: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Clip intervals to [start, stop) (e.g. the bounds of the recording), dropping the ones left empty.
+
+    Parameters
+    ----------
+    onsets : np.ndarray
+        Interval onsets.
+    offsets : np.ndarray
+        Interval offsets.
+    start : float
+        Lower bound.
+    stop : float
+        Upper bound.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Onsets and offsets of the clipped intervals, in the original order.
+    """
+    onsets = np.clip(onsets, start, stop)
+    offsets = np.clip(offsets, start, stop)
+    non_empty = offsets > onsets
+    return onsets[non_empty], offsets[non_empty]
+
+def complement_intervals(
+    onsets: np.ndarray,
+    offsets: np.ndarray,
+    start: float,
+    stop: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Complement of the union of intervals within [start, stop): the gaps between them.
+
+    Parameters
+    ----------
+    onsets : np.ndarray
+        Interval onsets.
+    offsets : np.ndarray
+        Interval offsets.
+    start : float
+        Lower bound (e.g. 0).
+    stop : float
+        Upper bound (e.g. the duration of the recording).
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Onsets and offsets of the complement, sorted.
+    """
+    onsets, offsets = union_intervals(*clip_intervals(onsets, offsets, start, stop))
+    gap_onsets = np.concatenate([[start], offsets]).astype(np.result_type(onsets, type(start)))
+    gap_offsets = np.concatenate([onsets, [stop]]).astype(gap_onsets.dtype)
+    non_empty = gap_offsets > gap_onsets
+    return gap_onsets[non_empty], gap_offsets[non_empty]
+
+def intersect_intervals(
+    onsets_a: np.ndarray,
+    offsets_a: np.ndarray,
+    onsets_b: np.ndarray,
+    offsets_b: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Intersection of the unions of two sets of intervals.
+
+    Parameters
+    ----------
+    onsets_a : np.ndarray
+        Onsets of the first set.
+    offsets_a : np.ndarray
+        Offsets of the first set.
+    onsets_b : np.ndarray
+        Onsets of the second set.
+    offsets_b : np.ndarray
+        Offsets of the second set.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Onsets and offsets of the intersection, sorted and disjoint.
+    """
+    onsets_a, offsets_a = union_intervals(onsets_a, offsets_a)
+    onsets_b, offsets_b = union_intervals(onsets_b, offsets_b)
+    # Sweep over the boundaries: the intersection is covered by both sets (offsets before onsets on ties)
+    points = np.concatenate([onsets_a, onsets_b, offsets_a, offsets_b])
+    steps = np.concatenate([np.ones(len(onsets_a) + len(onsets_b), dtype=int), -np.ones(len(offsets_a) + len(offsets_b), dtype=int)])
+    order = np.lexsort((steps, points))
+    points, coverage = points[order], np.cumsum(steps[order])
+    is_onset = coverage == 2
+    onsets = points[is_onset]
+    offsets = points[np.flatnonzero(is_onset) + 1]
+    non_empty = offsets > onsets
+    return onsets[non_empty], offsets[non_empty]
+
+def in_intervals(
+    points: np.ndarray,
+    onsets: np.ndarray,
+    offsets: np.ndarray
+) -> np.ndarray:
+    """
+    Whether each point (e.g. an event time) falls within the union of the intervals.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Points to test.
+    onsets : np.ndarray
+        Interval onsets.
+    offsets : np.ndarray
+        Interval offsets.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask, True for the points within [onset, offset) of some interval.
+    """
+    points = np.asarray(points)
+    onsets, offsets = union_intervals(onsets, offsets)
+    if len(onsets) == 0:
+        return np.zeros(points.shape, dtype=bool)
+    # Last interval starting at or before each point
+    interval = np.searchsorted(onsets, points, side='right') - 1
+    return (interval >= 0) & (points < offsets[np.maximum(interval, 0)])
+
 # ========================
 # FILTERING AND RESAMPLING
 def get_antialiasing_filter(
     original_sr: int, 
     target_sr: int, 
     cutoff_ratio: float=0.9, 
-    gstop_db: float=53
+    gstop_db: float=53,
+    store_cache: Union[Path, str, None]=None
 )->np.ndarray:
     """
     Calculate FIR filter coefficients for anti-aliasing before downsampling.
@@ -174,12 +642,31 @@ def get_antialiasing_filter(
             0.90 is safer for TRF than 0.99 (less ringing).
     gstop_db: float
         The stopband attenuation in dB.
+    store_cache: Union[Path, str, None]
+        Directory of the on-disk filter cache. Designs are also cached in memory, see design_fir_filter.
 
     Returns
     -------
     np.ndarray
-        The FIR filter coefficients.
+        The FIR filter coefficients (read-only).
     """
+    return _cached_filter_design(
+        'antialiasing',
+        _antialiasing_taps,
+        store_cache,
+        original_sr=float(original_sr),
+        target_sr=float(target_sr),
+        cutoff_ratio=float(cutoff_ratio),
+        gstop_db=float(gstop_db)
+    )
+
+def _antialiasing_taps(
+    original_sr: float, 
+    target_sr: float, 
+    cutoff_ratio: float, 
+    gstop_db: float
+) -> np.ndarray:
+    """Taps of get_antialiasing_filter (uncached)."""
     nyquist_target = target_sr / 2.0
     f_pass = nyquist_target * cutoff_ratio
     f_stop = nyquist_target
@@ -208,7 +695,11 @@ def custom_resample(
     original_sr:int, 
     target_sr:int,
     padtype:str='line',
-    axis:int=0
+    axis:int=0,
+    store_cache:Union[Path, str, None]=None,
+    n_jobs:int=1,
+    out:Union[np.ndarray, None]=None,
+    dtype:Union[np.dtype, str, None]=None
 ) -> np.ndarray:
     """
     Resample an array from original_sr to target_sr using polyphase filtering.
@@ -225,11 +716,21 @@ def custom_resample(
         The type of padding to use. Default is 'line'.
     axis : int, optional
         The axis along which to resample. Default is 0.
+    store_cache : Union[Path, str, None], optional
+        Directory of the on-disk filter cache, see get_antialiasing_filter.
+    n_jobs : int, optional
+        Number of threads the channels are split across (-1: all CPUs). Default is 1.
+    out : np.ndarray, optional
+        Preallocated output, with ceil(n_samples * target_sr / original_sr) samples along axis.
+    dtype : np.dtype, optional
+        Floating point precision of the output (e.g. np.float32 to halve its memory): the values are
+        rounded to it and out, if not given, is allocated with it. Integer and float32 inputs are
+        resampled in float64. Default is None (the dtype of array, float64 for integer arrays).
     
     Returns
     -------
     np.ndarray
-        The resampled array.
+        The resampled array (out, if given).
     """
     # Calculate upsampling and downsampling factors by finding greatest common divisor
     gcd = np.gcd(int(original_sr), int(target_sr))
@@ -242,20 +743,297 @@ def custom_resample(
             original_sr=original_sr, 
             target_sr=target_sr,
             cutoff_ratio=0.9,
-            gstop_db=53
+            gstop_db=53,
+            store_cache=store_cache
         )
     else:
         window_param = ('kaiser', 5.0) 
 
+    if dtype is None:
+        dtype = array.dtype if array.dtype.kind == 'f' else np.float64
+
+    if n_jobs != 1 or out is not None:
+        def resample_channels(channels: np.ndarray, out_channels: np.ndarray) -> None:
+            # resample_poly filters in the precision of its input
+            out_channels[...] = signal.resample_poly(
+                x=np.asarray(channels, dtype=np.float64), up=up, down=down, axis=axis, window=window_param, padtype=padtype
+            ).astype(dtype, copy=False)
+        return _map_channels(
+            resample_channels, array, axis, n_jobs, out,
+            out_length=-(-array.shape[axis] * up // down),
+            dtype=dtype
+        )
+
     return signal.resample_poly(
-        x=array, 
+        x=np.asarray(array, dtype=np.float64), 
         up=up, 
         down=down, 
         axis=axis, 
         window=window_param, 
         padtype=padtype
+    ).astype(dtype, copy=False)
+
+def _map_channels(
+    function: Callable[[np.ndarray, np.ndarray], None],
+    array: np.ndarray,
+    axis: int,
+    n_jobs: int,
+    out: Union[np.ndarray, None],
+    out_length: int,
+    dtype: np.dtype = np.float64,
+    channel_arrays: tuple = ()
+) -> np.ndarray:
+    """
+    Runs function(channels, out_channels, *channel_arrays) over contiguous chunks of the channel axis
+    (the first axis other than axis) in a thread pool, the SciPy kernels releasing the GIL. Each call fills
+    its view of the (preallocated) output, so the chunks are written in place, without reassembling copies.
+    channel_arrays (e.g. per-channel factors shaped (n_channels, 1)) are sliced along with the channels.
+    """
+    axis = axis % array.ndim
+    out_shape = list(array.shape)
+    out_shape[axis] = out_length
+    if out is None:
+        out = np.empty(out_shape, dtype=dtype)
+    elif list(out.shape) != out_shape:
+        raise ValueError(f"out has shape {out.shape}, expected {tuple(out_shape)}.")
+    if array.ndim == 1 or n_jobs == 1:
+        function(array, out, *channel_arrays)
+        return out
+
+    channel_axis = 1 if axis == 0 else 0
+    n_channels = array.shape[channel_axis]
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    bounds = np.linspace(0, n_channels, max(1, min(n_jobs, n_channels)) + 1).astype(int)
+
+    def run_chunk(start: int, stop: int) -> None:
+        chunk = [slice(None)] * array.ndim
+        chunk[channel_axis] = slice(start, stop)
+        function(array[tuple(chunk)], out[tuple(chunk)], *[values[tuple(chunk)] for values in channel_arrays])
+
+    with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+        # list() propagates exceptions raised in the threads
+        list(executor.map(run_chunk, bounds[:-1], bounds[1:]))
+    return out
+
+class LazyRawArray:
+    """
+    Read-only array-like view, shaped (channels, times), of channels of a Raw that is not
+    preloaded (e.g. mne.io.read_raw_bdf(..., preload=False)). Slicing the time axis reads
+    only those channels and samples from disk; slicing the channel axis alone returns a
+    narrower view. The blockwise filters (fir_filter_decimate, fir_filter with block_size)
+    can thus stream a recording without loading it. Reads are serialized by a lock shared
+    between views, so the channels can be filtered by a thread pool.
+
+    Parameters
+    ----------
+    raw : mne.io.BaseRaw
+        The recording.
+    picks : Union[list, np.ndarray, None], optional
+        Channel names or indices of the view. Default is None (all channels).
+    """
+    ndim = 2
+    dtype = np.dtype(np.float64)
+
+    def __init__(
+        self,
+        raw: mne.io.BaseRaw,
+        picks: Union[list, np.ndarray, None] = None,
+        _lock: Union[threading.Lock, None] = None
+    ) -> None:
+        self.raw = raw
+        if picks is None:
+            picks = range(len(raw.ch_names))
+        self.picks = np.array([raw.ch_names.index(pick) if isinstance(pick, str) else int(pick) for pick in picks], dtype=int)
+        self.shape = (len(self.picks), raw.n_times)
+        self._lock = threading.Lock() if _lock is None else _lock
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(
+        self,
+        key: Union[slice, tuple]
+    ) -> Union['LazyRawArray', np.ndarray]:
+        channels, times = (key + (slice(None),))[:2] if isinstance(key, tuple) else (key, slice(None))
+        if not isinstance(channels, slice) or not isinstance(times, slice):
+            raise TypeError(f"LazyRawArray only supports slicing, got {key}.")
+        if times == slice(None):
+            return LazyRawArray(self.raw, self.picks[channels], _lock=self._lock)
+        start, stop, step = times.indices(self.shape[1])
+        with self._lock:
+            data = self.raw.get_data(
+                picks=self.picks[channels], start=start, stop=max(start, stop), verbose='ERROR'
+            )
+        return data[:, ::step]
+
+    def __array__(
+        self,
+        dtype: Union[np.dtype, None] = None,
+        copy: Union[bool, None] = None
+    ) -> np.ndarray:
+        return self[:, 0:self.shape[1]].astype(dtype or self.dtype, copy=False)
+
+def design_fir_filter(
+    sfreq: float, 
+    l_freq: Union[float, None] = None, 
+    h_freq: Union[float, None] = None,
+    transition_ratio: float = 0.25,
+    min_transition_bandwidth: float = 0.5,
+    pass_zero: Union[bool, str] = "bandpass",
+    store_cache: Union[Path, str, None] = None
+) -> np.ndarray:
+    """
+    Design the windowed (Hamming) FIR filter used by fir_filter, following the "Two-Stage" (Cascade) logic
+    of EEGLAB: the band-pass kernel is the convolution of a high-pass (sharp transition, long kernel)
+    and a low-pass (soft transition, short kernel) kernel.
+
+    Designs are cached in memory (per process) and, if store_cache is given, on disk, keyed on every
+    design parameter.
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    l_freq : float, optional
+        High-pass cutoff frequency (e.g., 1 Hz). If None, no high-pass filtering is applied.
+    h_freq : float, optional
+        Low-pass cutoff frequency (e.g., 40 Hz). If None, no low-pass filtering is applied.
+    transition_ratio : float, optional
+        Ratio of transition bandwidth to cutoff.
+    min_transition_bandwidth : float, optional
+        Minimum transition bandwidth in Hz.
+    pass_zero : Union[bool, str], optional
+        Type of filter, see scipy.signal.firwin. Default is "bandpass".
+    store_cache : Union[Path, str, None], optional
+        Directory of the on-disk filter cache. Default is None (memory only).
+
+    Returns
+    -------
+    np.ndarray
+        The filter taps (read-only).
+    """
+    # Validate inputs
+    if l_freq is None and h_freq is None:
+        raise ValueError("At least one of l_freq or h_freq must be provided.")
+    if l_freq is not None:
+        assert l_freq >= 0.1, "l_freq must be >= 0.1 Hz."
+    if l_freq is None and pass_zero == 'bandpass':
+        print("Warning: Changing pass_zero from 'bandpass' to 'lowpass' for single low-pass filter.")
+        pass_zero = 'lowpass'
+
+    return _cached_filter_design(
+        'fir_filter',
+        _fir_filter_taps,
+        store_cache,
+        sfreq=float(sfreq),
+        l_freq=None if l_freq is None else float(l_freq),
+        h_freq=None if h_freq is None else float(h_freq),
+        transition_ratio=float(transition_ratio),
+        min_transition_bandwidth=float(min_transition_bandwidth),
+        window='hamming',
+        pass_zero=pass_zero
     )
 
+def _fir_filter_taps(
+    sfreq: float,
+    l_freq: Union[float, None],
+    h_freq: Union[float, None],
+    transition_ratio: float,
+    min_transition_bandwidth: float,
+    window: str,
+    pass_zero: Union[bool, str]
+) -> np.ndarray:
+    """Taps of design_fir_filter (uncached)."""
+    # High-Pass Transition (if l_freq exists)
+    if l_freq is not None:
+        if l_freq <= 2.0:
+            l_trans = min_transition_bandwidth 
+        else:
+            l_trans = min(
+                max(l_freq * transition_ratio, 2.0), 
+                l_freq
+            )
+        # Ballanger/Kaiser formula for transition width
+        numtaps_hp = int(3.3 / (l_trans / sfreq))
+        if numtaps_hp % 2 == 0: numtaps_hp += 1
+
+    # Low-Pass Transition (if h_freq exists)
+    if h_freq is not None:
+        nyquist = sfreq / 2.0
+        h_trans = min(
+            max(h_freq * transition_ratio, 2.0), 
+            nyquist - h_freq
+        )
+        # Ballanger/Kaiser formula for transition width
+        numtaps_lp = int(3.3 / (h_trans / sfreq))
+        if numtaps_lp % 2 == 0: numtaps_lp += 1
+
+    if l_freq is not None and h_freq is not None:
+        taps_hp = signal.firwin(
+            numtaps=numtaps_hp, 
+            cutoff=l_freq, 
+            pass_zero='highpass',  # Blocks DC
+            window=window, 
+            fs=sfreq
+        )
+        taps_lp = signal.firwin(
+            numtaps=numtaps_lp, 
+            cutoff=h_freq, 
+            pass_zero='lowpass', # Blocks Nyquist
+            window=window,  
+            fs=sfreq
+        )
+        # Convolve to create Bandpass
+        return signal.convolve(taps_hp, taps_lp)
+    elif l_freq is not None:
+        return signal.firwin(numtaps=numtaps_hp, cutoff=l_freq, pass_zero=pass_zero, window=window, fs=sfreq)
+    else:
+        return signal.firwin(numtaps=numtaps_lp, cutoff=h_freq, pass_zero=pass_zero, window=window, fs=sfreq)
+
+def _cached_filter_design(
+    name: str,
+    design: Callable[..., np.ndarray],
+    store_cache: Union[Path, str, None],
+    **params
+) -> np.ndarray:
+    """
+    Looks up a filter design in the in-process LRU cache, then in the on-disk cache
+    (store_cache directory, one .npy file per parameter hash), and designs it otherwise.
+    """
+    if store_cache is not None:
+        store_cache = Path(store_cache)
+        if store_cache.suffix == '.npy':
+            # legacy single-file cache: keep its directory, the file name would ignore the parameters
+            store_cache = store_cache.parent
+        store_cache = store_cache.as_posix()
+    return _filter_design_lru(name, design, store_cache, tuple(sorted(params.items())))
+
+@lru_cache(maxsize=64)
+def _filter_design_lru(
+    name: str,
+    design: Callable[..., np.ndarray],
+    store_cache: Union[str, None],
+    params: tuple
+) -> np.ndarray:
+    """In-process cache of _cached_filter_design. The taps are returned read-only as they are shared."""
+    if store_cache is None:
+        taps = design(**dict(params))
+    else:
+        key = hash_params({'design': name, **dict(params)})
+        cache_path = Path(store_cache) / f'{name}-{key[:16]}.npy'
+        try:
+            taps = np.load(cache_path)
+        except (FileNotFoundError, ValueError, OSError):
+            taps = design(**dict(params))
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_name(f'{cache_path.stem}.{os.getpid()}.tmp.npy')
+            np.save(temp_path, taps)
+            os.replace(temp_path, cache_path)
+    taps = np.asarray(taps, dtype=np.float64)
+    taps.setflags(write=False)
+    return taps
+
 def fir_filter(
     array: np.ndarray, 
     sfreq: float, 
@@ -267,7 +1045,11 @@ def fir_filter(
     transition_ratio: float = 0.25,
     min_transition_bandwidth: float = 0.5,
     use_fourier: bool = True,
-    pass_zero: Union[bool, str] = "bandpass"
+    pass_zero: Union[bool, str] = "bandpass",
+    out: Union[np.ndarray, None] = None,
+    block_size: Union[int, None] = None,
+    n_jobs: int = 1,
+    dtype: Union[np.dtype, str] = np.float64
 ) -> np.ndarray:
     """
     Apply a FIR filter using the "Two-Stage" (Cascade) logic, standard in EEGLAB.
@@ -294,7 +1076,7 @@ def fir_filter(
     call_type : str, optional
         Filtering method.
     store_cache : Union[Path, str, None], optional
-        Path to store filter taps.
+        Directory of the on-disk filter cache, see design_fir_filter.
     transition_ratio : float, optional
         Ratio of transition bandwidth to cutoff.
     min_transition_bandwidth : float, optional
@@ -307,16 +1089,67 @@ def fir_filter(
         Toggles the zero frequency bin (or DC gain) to be in the passband (True) or in the stopband (False).
         'bandstop', 'lowpass' are synonyms for True and 'bandpass', 'highpass' are synonyms for False.
         'lowpass', 'highpass' additionally require cutoff to be a scalar value or a length-one array.
+    out : np.ndarray, optional
+        Preallocated output (e.g. a np.memmap), with the shape of array (less the delay along axis
+        for the "forward_compensated_cut" mode). Implies block processing in the reflected mode.
+    block_size : int, optional
+        Only for the reflected mode: filter block_size samples at a time (overlap-save), so that
+        peak memory scales with the block size instead of the recording length. The array may then
+        be a np.memmap. Default is None (whole array at once, unless out is given: 2**16).
+    n_jobs : int, optional
+        Number of threads the channels are split across (-1: all CPUs), each thread writing its
+        channels into the output. Default is 1.
+    dtype : np.dtype, optional
+        Floating point precision of the output (e.g. np.float32 to halve its memory): the values are
+        rounded to it and out, if not given, is allocated with it. The filters are designed and applied
+        in float64. Default is np.float64.
 
     Returns
     -------
     np.ndarray
-        The filtered data.
+        The filtered data (out, if given).
 
     """
-    # Ensure array is float64 for precision
-    if array.dtype != np.float64:
-        array = array.astype(np.float64)
+    taps = design_fir_filter(
+        sfreq=sfreq,
+        l_freq=l_freq,
+        h_freq=h_freq,
+        transition_ratio=transition_ratio,
+        min_transition_bandwidth=min_transition_bandwidth,
+        pass_zero=pass_zero,
+        store_cache=store_cache
+    )
+
+    # Split the channels across threads
+    if n_jobs != 1 and array.ndim > 1:
+        if l_freq is None and pass_zero == 'bandpass':
+            pass_zero = 'lowpass' # already warned by design_fir_filter
+        def filter_channels(channels: np.ndarray, out_channels: np.ndarray) -> None:
+            fir_filter(
+                channels, sfreq, l_freq, h_freq, axis, call_type, store_cache, transition_ratio,
+                min_transition_bandwidth, use_fourier, pass_zero, out=out_channels, block_size=block_size,
+                dtype=dtype
+            )
+        n_out = array.shape[axis]
+        if call_type == "forward_compensated_cut":
+            n_out -= int((len(taps) - 1) // 2)
+        return _map_channels(filter_channels, array, axis, n_jobs, out, out_length=n_out, dtype=dtype)
+
+    # Stream the reflected mode block by block (out-of-core friendly)
+    if call_type == "forward_compensated_reflected" and (block_size is not None or out is not None):
+        return _reflected_fir_blockwise(
+            array=array,
+            taps=taps,
+            axis=axis,
+            restore_dc=l_freq is None,
+            out=out,
+            block_size=block_size if block_size is not None else 2**16,
+            use_fourier=use_fourier,
+            dtype=dtype
+        )
+
+    # Ensure array is float64 for precision (array-likes such as LazyRawArray are read whole)
+    array = np.asarray(array, dtype=np.float64)
     
     # Demean to avoid edge artifacts
     dc_offset = array.mean(axis=axis, keepdims=True)
@@ -324,100 +1157,6 @@ def fir_filter(
     
     number_of_dims = array.ndim
 
-    # Validate inputs
-    if l_freq is None and h_freq is None:
-        raise ValueError("At least one of l_freq or h_freq must be provided.")
-    if l_freq is not None:
-        assert l_freq >= 0.1, "l_freq must be >= 0.1 Hz."
-    is_bandpass = (l_freq is not None) and (h_freq is not None)
-
-    # High-Pass Transition (if l_freq exists)
-    if l_freq is not None:
-        if l_freq <= 2.0:
-            l_trans = min_transition_bandwidth 
-        else:
-            l_trans = min(
-                max(l_freq * transition_ratio, 2.0), 
-                l_freq
-            )
-        # Ballanger/Kaiser formula for transition width
-        numtaps_hp = int(3.3 / (l_trans / sfreq))
-        if numtaps_hp % 2 == 0: numtaps_hp += 1
-
-    # Low-Pass Transition (if h_freq exists)
-    if h_freq is not None:
-        nyquist = sfreq / 2.0
-        h_trans = min(
-            max(h_freq * transition_ratio, 2.0), 
-            nyquist - h_freq
-        )
-        # Ballanger/Kaiser formula for transition width
-        numtaps_lp = int(3.3 / (h_trans / sfreq))
-        if numtaps_lp % 2 == 0: numtaps_lp += 1
-
-    if store_cache:
-        store_cache = Path(store_cache)
-        if store_cache.exists():
-            taps = np.load(store_cache)
-        else:
-            if is_bandpass:
-                taps_hp = signal.firwin(
-                    numtaps=numtaps_hp, 
-                    cutoff=l_freq, 
-                    pass_zero='highpass',  # Blocks DC
-                    window='hamming', 
-                    fs=sfreq
-                )
-                
-                taps_lp = signal.firwin(
-                    numtaps=numtaps_lp, 
-                    cutoff=h_freq, 
-                    pass_zero='lowpass', # Blocks Nyquist
-                    window='hamming',  
-                    fs=sfreq
-                )
-                # Convolve to create Bandpass
-                taps = signal.convolve(taps_hp, taps_lp)
-            elif l_freq is not None:
-                taps = signal.firwin(
-                    numtaps=numtaps_hp, 
-                    cutoff=l_freq, 
-                    pass_zero=pass_zero, 
-                    window='hamming', 
-                    fs=sfreq
-                )
-            elif h_freq is not None:
-                # Single Low-Pass
-                if pass_zero == 'bandpass':
-                    pz = 'lowpass'
-                    print("Warning: Changing pass_zero from 'bandpass' to 'lowpass' for single low-pass filter.")
-                else:
-                    pz = pass_zero
-
-                taps = signal.firwin(
-                    numtaps=numtaps_lp, 
-                    cutoff=h_freq, 
-                    pass_zero=pz, 
-                    window='hamming', 
-                    fs=sfreq
-                )
-            
-            np.save(store_cache, taps)
-    else:
-        if is_bandpass:
-            taps_hp = signal.firwin(numtaps=numtaps_hp, cutoff=l_freq, pass_zero='highpass', window='hamming', fs=sfreq)
-            taps_lp = signal.firwin(numtaps=numtaps_lp, cutoff=h_freq, pass_zero='lowpass', window='hamming', fs=sfreq)
-            taps = signal.convolve(taps_hp, taps_lp)
-        elif l_freq is not None:
-            taps = signal.firwin(numtaps=numtaps_hp, cutoff=l_freq, pass_zero=pass_zero, window='hamming', fs=sfreq)
-        elif h_freq is not None:
-            if pass_zero == 'bandpass':
-                print("Warning: Changing pass_zero from 'bandpass' to 'lowpass' for single low-pass filter.")
-                pz = 'lowpass'
-            else:
-                pz = pass_zero
-            taps = signal.firwin(numtaps=numtaps_lp, cutoff=h_freq, pass_zero=pz, window='hamming', fs=sfreq)
-    
     # Effective delay
     numtaps = len(taps)
     delay = int((numtaps - 1) // 2)
@@ -484,5 +1223,309 @@ def fir_filter(
     else:
         # The DC offset has been removed by the high-pass filter
         pass
+    filtered = filtered.astype(dtype, copy=False)
+
+    if out is not None:
+        out[...] = filtered
+        return out
+    return filtered    
 
-    return filtered    
\ No newline at end of file
+def fir_filter_decimate(
+    array: np.ndarray, 
+    sfreq: float, 
+    target_sr: float,
+    l_freq: Union[float, None] = None, 
+    h_freq: Union[float, None] = None,
+    axis: int = 0,
+    store_cache: Union[Path, str, None] = None,
+    transition_ratio: float = 0.25,
+    min_transition_bandwidth: float = 0.5,
+    pass_zero: Union[bool, str] = "bandpass",
+    out: Union[np.ndarray, None] = None,
+    block_size: int = 2**16,
+    n_jobs: int = 1,
+    dtype: Union[np.dtype, str] = np.float64,
+    cals: Union[np.ndarray, None] = None
+) -> np.ndarray:
+    """
+    Fused equivalent of fir_filter(call_type="forward_compensated_reflected") followed by
+    custom_resample to target_sr. The band-pass and anti-aliasing kernels are convolved into a single
+    kernel, which is applied in polyphase form: only the retained output samples are computed and each
+    input sample is read once, block by block (see the block_size parameter of fir_filter).
+
+    Only integer decimation factors are fused; otherwise it falls back to the two-pass path
+    (blockwise filtering at the original rate, then resampling).
+    The output matches the two-pass path up to the padding at the edges (reflection here,
+    'line' in custom_resample) and floating point rounding.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The input data to be filtered (may be a np.memmap).
+    sfreq : float
+        The sampling frequency.
+    target_sr : float
+        The target sampling rate.
+    l_freq : float, optional
+        High-pass cutoff frequency (e.g., 1 Hz). If None, no high-pass filtering is applied.
+    h_freq : float, optional
+        Low-pass cutoff frequency (e.g., 40 Hz). If None, no low-pass filtering is applied.
+    axis : int, optional
+        Axis to filter.
+    store_cache : Union[Path, str, None], optional
+        Directory of the on-disk filter cache, see design_fir_filter.
+    transition_ratio : float, optional
+        Ratio of transition bandwidth to cutoff.
+    min_transition_bandwidth : float, optional
+        Minimum transition bandwidth in Hz.
+    pass_zero : Union[bool, str], optional
+        Type of filter to apply. Default is "bandpass".
+    out : np.ndarray, optional
+        Preallocated output, with ceil(n_samples / decimation factor) samples along axis.
+    block_size : int, optional
+        Number of input samples processed at a time. Default is 2**16.
+    n_jobs : int, optional
+        Number of threads the channels are split across (-1: all CPUs). Default is 1.
+    dtype : np.dtype, optional
+        Floating point precision of the output (e.g. np.float32 to halve its memory): the values are
+        rounded to it and out, if not given, is allocated with it. The filters are designed and applied
+        in float64. Default is np.float64.
+    cals : np.ndarray, optional
+        Calibration factor of each channel, shaped as array with a single sample along axis (e.g.
+        (n_channels, 1)). With a dtype below float64, the values are rounded to dtype in units of
+        cals, as FIF files store data / cals, so a float64 out holds exactly what a single precision
+        FIF file would. Only with an integer decimation factor. Default is None.
+
+    Returns
+    -------
+    np.ndarray
+        The filtered and resampled data (out, if given).
+    """
+    gcd = np.gcd(int(sfreq), int(target_sr))
+    up = int(target_sr // gcd)
+    down = int(sfreq // gcd)
+    if up != 1 or sfreq != int(sfreq):
+        if cals is not None:
+            raise ValueError(f"cals needs an integer decimation factor, got {sfreq} Hz -> {target_sr} Hz.")
+        filtered = fir_filter(
+            array=array, sfreq=sfreq, l_freq=l_freq, h_freq=h_freq, axis=axis,
+            call_type="forward_compensated_reflected", store_cache=store_cache,
+            transition_ratio=transition_ratio, min_transition_bandwidth=min_transition_bandwidth,
+            pass_zero=pass_zero, block_size=block_size, n_jobs=n_jobs, dtype=dtype
+        )
+        return custom_resample(
+            filtered, sfreq, target_sr, axis=axis, store_cache=store_cache, n_jobs=n_jobs, out=out, dtype=dtype
+        )
+
+    taps = design_fir_filter(
+        sfreq=sfreq,
+        l_freq=l_freq,
+        h_freq=h_freq,
+        transition_ratio=transition_ratio,
+        min_transition_bandwidth=min_transition_bandwidth,
+        pass_zero=pass_zero,
+        store_cache=store_cache
+    )
+    if down > 1:
+        taps = signal.convolve(
+            taps, 
+            get_antialiasing_filter(sfreq, target_sr, cutoff_ratio=0.9, gstop_db=53, store_cache=store_cache)
+        )
+
+    def filter_channels(channels: np.ndarray, out_channels: np.ndarray, *channel_cals: np.ndarray) -> None:
+        _reflected_fir_blockwise(
+            array=channels,
+            taps=taps,
+            axis=axis,
+            restore_dc=l_freq is None,
+            out=out_channels,
+            block_size=block_size,
+            use_fourier=True,
+            down=down,
+            dtype=dtype,
+            cals=channel_cals[0] if channel_cals else None
+        )
+    return _map_channels(
+        filter_channels, array, axis, n_jobs, out, out_length=-(-array.shape[axis] // down), dtype=dtype,
+        channel_arrays=() if cals is None else (np.asarray(cals, dtype=np.float64),)
+    )
+
+def _reflected_fir_blockwise(
+    array: np.ndarray,
+    taps: np.ndarray,
+    axis: int,
+    restore_dc: bool,
+    out: Union[np.ndarray, None],
+    block_size: int,
+    use_fourier: bool,
+    down: int = 1,
+    dtype: Union[np.dtype, str] = np.float64,
+    cals: Union[np.ndarray, None] = None
+) -> np.ndarray:
+    """
+    Overlap-save equivalent of the "forward_compensated_reflected" mode of fir_filter, keeping
+    every down-th output sample. Each output block is the 'valid' convolution of the input block
+    extended by the filter history on both sides, the reflection padding being gathered at the edges
+    of the recording. When decimating, the kernel and the block are split into down polyphase
+    components that are convolved at the output rate. The input is read and the output written
+    one block at a time; each block is filtered in float64 and rounded to dtype (in units of cals,
+    if given) when written.
+    """
+    axis = axis % array.ndim
+    n_samples = array.shape[axis]
+    numtaps = len(taps)
+    pad_len = numtaps - 1
+    delay = int((numtaps - 1) // 2)
+    if n_samples <= pad_len:
+        raise ValueError(f"Block processing needs more than {pad_len} samples along axis {axis}, got {n_samples}.")
+    out_shape = list(array.shape)
+    out_shape[axis] = -(-n_samples // down)
+    if out is None:
+        out = np.empty(out_shape, dtype=dtype)
+    elif list(out.shape) != out_shape:
+        raise ValueError(f"out has shape {out.shape}, expected {tuple(out_shape)}.")
+
+    def axis_slice(start: Union[int, None], stop: Union[int, None], step: int = 1) -> tuple:
+        slices = [slice(None)] * array.ndim
+        slices[axis] = slice(start, stop, step)
+        return tuple(slices)
+
+    # First pass: DC offset, accumulated in float64
+    dc_offset = 0.
+    for start in range(0, n_samples, block_size):
+        dc_offset = dc_offset + array[axis_slice(start, start + block_size)].sum(axis=axis, keepdims=True, dtype=np.float64)
+    dc_offset = dc_offset / n_samples
+
+    # Polyphase components of the kernel (zero-padded to a multiple of down)
+    n_phase_taps = -(-numtaps // down)
+    shape_taps = [1] * array.ndim
+    shape_taps[axis] = -1
+    taps_padded = np.zeros(n_phase_taps * down)
+    taps_padded[:numtaps] = taps
+    phase_taps = [taps_padded[r::down].reshape(shape_taps) for r in range(down)]
+
+    # Second pass: output samples [start, stop) need the input from
+    # start * down + delay - (n_phase_taps * down - 1) to (stop - 1) * down + delay
+    out_block = max(1, block_size // down)
+    for start in range(0, out_shape[axis], out_block):
+        stop = min(start + out_block, out_shape[axis])
+        first = start * down + delay - (n_phase_taps * down - 1)
+        last = stop * down + delay - down + 1
+        if first < 0 or last > n_samples:
+            # reflect (without repeating the edge sample) as np.pad(mode='reflect')
+            indices = np.arange(first, last)
+            indices = np.abs(indices)
+            indices = np.where(indices >= n_samples, 2 * (n_samples - 1) - indices, indices)
+            # read the contiguous span covering the reflected indices, not the whole array
+            low, high = indices.min(), indices.max() + 1
+            segment = np.take(np.asarray(array[axis_slice(low, high)]), indices - low, axis=axis).astype(np.float64)
+        else:
+            segment = np.array(array[axis_slice(first, last)], dtype=np.float64)
+        segment -= dc_offset
+
+        filtered = 0.
+        for r in range(down):
+            filtered = filtered + signal.convolve(
+                segment[axis_slice(down - 1 - r, None, down)], 
+                phase_taps[r], 
+                mode='valid', 
+                method='auto' if use_fourier else 'direct'
+            )
+        if restore_dc:
+            filtered += dc_offset
+        if cals is not None and np.dtype(dtype) != np.float64:
+            # rounded in calibrated units, out keeps the precision it was allocated with
+            out[axis_slice(start, stop)] = (filtered / cals).astype(dtype) * cals
+        else:
+            out[axis_slice(start, stop)] = filtered.astype(dtype, copy=False)
+    return out
+
+# ===
+# ICA
+ICA_FIT_PARAMS = {
+    'infomax': {'extended': True}, # extended infomax handles sub-Gaussian sources (e.g. line noise)
+    'picard': {'extended': True, 'ortho': False}, # same model as extended infomax, faster convergence
+    'fastica': {}
+}
+
+def fit_ica(
+    raw: mne.io.Raw,
+    n_components: Union[int, float, None] = 0.98,
+    method: str = 'infomax',
+    random_state: Union[int, None] = None,
+    decim: Union[int, None] = None,
+    segment_fraction: Union[float, None] = None,
+    segment_seconds: float = 2.0,
+    picks: str = 'eeg',
+    verbose: Union[str, bool, None] = None
+) -> mne.preprocessing.ICA:
+    """
+    Fit an ICA on the channels of picks, rejecting 'bad' annotated spans. By default the
+    fit uses every sample of the recording; the fast-fit options train on less data:
+    a decimated copy (decim) and/or a random subset of clean fixed-length segments
+    (segment_fraction). A PCA pre-reduction is set through n_components.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The continuous EEG data, with 'bad' annotations on the spans to reject.
+    n_components : Union[int, float, None]
+        Components kept by the PCA step before ICA: a fraction of explained variance (float)
+        or a fixed number of components (int, pre-reduction).
+    method : str
+        'infomax' (extended), 'picard' (extended, requires python-picard) or 'fastica'
+        (requires scikit-learn).
+    random_state : Union[int, None]
+        Seed of the ICA and of the segment subset.
+    decim : Union[int, None]
+        Fit on every decim-th sample only. None uses every sample.
+    segment_fraction : Union[float, None]
+        Fit on this random fraction (0, 1] of the clean segments. None uses the whole recording.
+    segment_seconds : float
+        Length of the segments in seconds.
+    picks : str
+        Channels to decompose.
+    verbose : Union[str, bool, None]
+        MNE verbosity.
+
+    Returns
+    -------
+    mne.preprocessing.ICA
+        The fitted ICA.
+    """
+    if method not in ICA_FIT_PARAMS:
+        raise ValueError(f"method must be one of {list(ICA_FIT_PARAMS)}, got '{method}'.")
+    ica = mne.preprocessing.ICA(
+        n_components=n_components, 
+        method=method, 
+        random_state=random_state,
+        fit_params=ICA_FIT_PARAMS[method],
+        verbose=verbose
+    )
+    if segment_fraction is None:
+        return ica.fit(
+            raw, 
+            picks=picks, 
+            decim=decim,
+            reject_by_annotation=True, # reject 'bad' annotations
+            verbose=verbose
+        )
+
+    # Random subset of the segments that don't overlap 'bad' annotations
+    epochs = mne.make_fixed_length_epochs(
+        raw,
+        duration=segment_seconds,
+        reject_by_annotation=True,
+        preload=False,
+        verbose=verbose
+    )
+    epochs.drop_bad(verbose=verbose)
+    n_segments = max(1, int(round(len(epochs) * segment_fraction)))
+    rng = np.random.default_rng(random_state)
+    selected = np.sort(rng.choice(len(epochs), size=min(n_segments, len(epochs)), replace=False))
+    return ica.fit(
+        epochs[selected],
+        picks=picks,
+        decim=decim,
+        verbose=verbose
+    )